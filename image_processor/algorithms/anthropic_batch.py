@@ -0,0 +1,74 @@
+# image_processor/algorithms/anthropic_batch.py
+import json
+import logging
+import requests
+
+from algorithms.anthropic_fallback import AnthropicExtractor, error_result
+
+logger = logging.getLogger('AnthropicBatch')
+
+class AnthropicBatchClient:
+    """Cliente de la API de lotes de mensajes (Message Batches) de Anthropic.
+
+    Reutiliza la configuración de AnthropicExtractor (clave, modelo, URL base)
+    y sus parámetros de solicitud, de modo que un trabajo por lote produce el
+    mismo resultado que la solicitud interactiva equivalente.
+    """
+
+    def __init__(self, extractor=None):
+        self.extractor = extractor or AnthropicExtractor()
+        self.batches_url = f"{self.extractor.api_base}/v1/messages/batches"
+
+    def submit(self, requests_by_id):
+        """Crea un lote a partir de {custom_id: params} y devuelve su id"""
+        response = requests.post(
+            self.batches_url,
+            headers=self.extractor.headers(),
+            json={
+                'requests': [
+                    {'custom_id': custom_id, 'params': params}
+                    for custom_id, params in requests_by_id.items()
+                ]
+            },
+            timeout=60
+        )
+        response.raise_for_status()
+        batch = response.json()
+        logger.info(f"Lote {batch['id']} creado con {len(requests_by_id)} solicitudes")
+        return batch['id']
+
+    def status(self, batch_id):
+        """Devuelve el estado del lote ('in_progress', 'canceling' o 'ended')"""
+        response = requests.get(
+            f"{self.batches_url}/{batch_id}",
+            headers=self.extractor.headers(),
+            timeout=30
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def results(self, batch):
+        """Descarga los resultados de un lote terminado: {custom_id: resultado de la API}"""
+        results_url = batch.get('results_url') or f"{self.batches_url}/{batch['id']}/results"
+        response = requests.get(results_url, headers=self.extractor.headers(), timeout=120)
+        response.raise_for_status()
+
+        results = {}
+        for line in response.text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            results[entry['custom_id']] = entry['result']
+        return results
+
+    def parse_result(self, entry, kind, field_ids=None):
+        """Convierte el resultado de una solicitud del lote al formato de AnthropicExtractor"""
+        if entry.get('type') != 'succeeded':
+            error = entry.get('error', {})
+            return error_result(f"Solicitud de lote {entry.get('type', 'desconocido')}: {error}")
+        try:
+            if kind == 'mosaic':
+                return self.extractor.parse_mosaic_response(entry['message'], field_ids)
+            return self.extractor.parse_page_response(entry['message'])
+        except Exception as e:
+            return error_result(str(e))
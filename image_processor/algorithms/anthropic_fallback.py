@@ -6,28 +6,26 @@ import requests
 import os
 import re
 
-class AnthropicExtractor:
-    def __init__(self):
-        self.api_key = os.environ.get('ANTHROPIC_API_KEY', '')
-        self.model = os.environ.get('ANTHROPIC_MODEL', 'claude-3-7-sonnet-20250219')
-        self.api_url = 'https://api.anthropic.com/v1/messages'
-        self.confidence_threshold = 0.7
-    
-    def extract_data_from_image(self, image_buffer):
-        """Extrae datos de un acta electoral usando Anthropic API"""
-        if not self.api_key:
-            return {
-                'results': None,
-                'error': 'Anthropic API key no configurada',
-                'confidence': 0,
-                'source': 'anthropic_error'
-            }
+from algorithms.resilience import (
+    ResilientCaller, CircuitOpenError, UpstreamUnavailableError, CONNECT_TIMEOUT_SECONDS
+)
 
-        # Convertir imagen a base64
-        base64_image = base64.b64encode(image_buffer).decode('utf-8')
+# Contenido de cada casilla, para los prompts de mosaico
+FIELD_DESCRIPTIONS = {
+    'codigo_mesa': 'código de mesa (alfanumérico)',
+    'numero_mesa': 'número de mesa',
+    'departamento': 'departamento',
+    'provincia': 'provincia',
+    'municipio': 'municipio',
+    'localidad': 'localidad',
+    'recinto': 'recinto electoral',
+    'votos_validos': 'total de votos válidos (número)',
+    'votos_blancos': 'votos blancos (número)',
+    'votos_nulos': 'votos nulos (número)',
+}
 
-        # Crear prompt para la extracción
-        prompt = """
+# Crear prompt para la extracción
+PAGE_PROMPT = """
         Por favor, extrae la siguiente información de esta imagen:
 
         1. Información de mesa:
@@ -82,90 +80,213 @@ class AnthropicExtractor:
         Sea honesto con este valor para identificar cuando se requiere verificación humana.
         """
 
+# Prompt de lectura de un mosaico; {field_lines} lista las etiquetas a leer
+MOSAIC_PROMPT = """
+        La imagen es un mosaico de recortes de un acta electoral boliviana. Cada fila
+        tiene a la izquierda una etiqueta y a la derecha el recorte de la casilla.
+        Lee el contenido de cada casilla:
+
+{field_lines}
+
+        Responde solo con JSON con la siguiente estructura, usando las etiquetas como claves:
+
+        {{
+        "fields": {{"<etiqueta>": "valor leído"}},
+        "confidence": number
+        }}
+
+        Para casillas de votos devuelve solo dígitos ("0" si está vacía). El campo
+        "confidence" es un valor entre 0 y 1 con tu confianza en la lectura.
+        """
+
+# Llamadas a la API compartidas por todo el proceso (circuito, plazos y cobertura)
+ANTHROPIC_CALLER = ResilientCaller('anthropic')
+
+class AnthropicExtractor:
+    def __init__(self):
+        self.api_key = os.environ.get('ANTHROPIC_API_KEY', '')
+        self.model = os.environ.get('ANTHROPIC_MODEL', 'claude-3-7-sonnet-20250219')
+        # URL base configurable para poder apuntar a un stub local
+        self.api_base = os.environ.get('ANTHROPIC_API_BASE_URL', 'https://api.anthropic.com').rstrip('/')
+        self.api_url = f"{self.api_base}/v1/messages"
+        self.confidence_threshold = 0.7
+    
+    def headers(self):
+        return {
+            'Content-Type': 'application/json',
+            'x-api-key': self.api_key,
+            'anthropic-version': '2023-06-01'
+        }
+    
+    def extract_data_from_image(self, image_buffer):
+        """Extrae datos de un acta electoral usando Anthropic API"""
+        if not self.api_key:
+            return error_result('Anthropic API key no configurada')
+
         try:
-            # Hacer solicitud a la API
-            response = requests.post(
-                self.api_url,
-                headers={
-                    'Content-Type': 'application/json',
-                    'x-api-key': self.api_key,
-                    'anthropic-version': '2023-06-01'
-                },
-                json={
-                    "model": self.model,
-                    "max_tokens": 4096,
-                    "messages": [
+            data = self._post_message(self.page_request_params(image_buffer))
+            return self.parse_page_response(data)
+        except (CircuitOpenError, UpstreamUnavailableError) as e:
+            logging.getLogger('AnthropicExtractor').warning(f"Servicio no disponible: {str(e)}")
+            return error_result(str(e), retryable=True, circuit_open=isinstance(e, CircuitOpenError))
+        except requests.exceptions.HTTPError as e:
+            logger = logging.getLogger('AnthropicExtractor')
+            error_msg = f"{e.response.status_code} {e.response.reason} for url: {e.response.url}"
+            logger.error(f"Error HTTP: {error_msg}")
+            logger.error(f"Response content: {e.response.text}")
+            
+            return error_result(error_msg)
+
+        except Exception as e:
+            logger = logging.getLogger('AnthropicEXtractor')
+            logger.error(f"Error general: {str(e)}")
+            return error_result(str(e))
+
+    def extract_fields_from_mosaic(self, image_buffer, field_ids):
+        """Lee solo los campos dudosos a partir de un mosaico de recortes etiquetados
+
+        Devuelve los valores por id de campo para combinarlos con el resultado
+        del OCR local, o un diccionario de error con el mismo formato que
+        extract_data_from_image.
+        """
+        if not self.api_key:
+            return error_result('Anthropic API key no configurada')
+
+        try:
+            data = self._post_message(self.mosaic_request_params(image_buffer, field_ids))
+            return self.parse_mosaic_response(data, field_ids)
+        except (CircuitOpenError, UpstreamUnavailableError) as e:
+            logging.getLogger('AnthropicExtractor').warning(f"Servicio no disponible: {str(e)}")
+            return error_result(str(e), retryable=True, circuit_open=isinstance(e, CircuitOpenError))
+        except Exception as e:
+            logger = logging.getLogger('AnthropicExtractor')
+            logger.error(f"Error en extracción por mosaico: {str(e)}")
+            return error_result(str(e))
+
+    def page_request_params(self, image_buffer):
+        """Parámetros de la solicitud de extracción de página completa"""
+        # Convertir imagen a base64
+        base64_image = base64.b64encode(image_buffer).decode('utf-8')
+        return self._message_params(PAGE_PROMPT, base64_image, 'image/jpeg', max_tokens=4096)
+
+    def mosaic_request_params(self, image_buffer, field_ids):
+        """Parámetros de la solicitud de lectura de un mosaico de casillas"""
+        base64_image = base64.b64encode(image_buffer).decode('utf-8')
+        field_lines = '\n'.join(f"        - {field_id}: {describe_field(field_id)}" for field_id in field_ids)
+        prompt = MOSAIC_PROMPT.format(field_lines=field_lines)
+        return self._message_params(prompt, base64_image, 'image/png', max_tokens=1024)
+
+    def parse_page_response(self, data):
+        """Convierte la respuesta de una extracción de página completa en resultado"""
+        extracted_data = response_json(data)
+        confidence = extracted_data.get('confidence', 0.5)
+        
+        if 'confidence' in extracted_data:
+            del extracted_data['confidence']
+
+        return {
+            'results': extracted_data,
+            'confidence': float(confidence),  # Alta confianza para respuestas de Anthropic
+            'source': 'anthropic',
+            'needsHumanVerification': float(confidence) < self.confidence_threshold
+        }
+
+    def parse_mosaic_response(self, data, field_ids):
+        """Convierte la respuesta de un mosaico en valores por id de campo"""
+        extracted_data = response_json(data)
+        values = extracted_data.get('fields', {})
+        confidence = float(extracted_data.get('confidence', 0.5))
+        return {
+            'results': {field_id: str(values[field_id]) for field_id in field_ids if field_id in values},
+            'confidence': confidence,
+            'source': 'anthropic_mosaic',
+            'needsHumanVerification': confidence < self.confidence_threshold
+        }
+
+    def _message_params(self, prompt, base64_image, media_type, max_tokens):
+        return {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
                         {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": prompt},
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": "image/jpeg",
-                                        "data": base64_image
-                                    }
-                                }
-                            ]
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": media_type,
+                                "data": base64_image
+                            }
                         }
                     ]
-                },
-                timeout=60
+                }
+            ]
+        }
+
+    def _post_message(self, params):
+        """Envía una solicitud a la API de mensajes y devuelve la respuesta JSON"""
+        logger = logging.getLogger('AnthropicExtractor')
+
+        def send(timeout):
+            # Hacer solicitud a la API con el plazo del intento
+            response = requests.post(
+                self.api_url,
+                headers=self.headers(),
+                json=params,
+                timeout=(CONNECT_TIMEOUT_SECONDS, timeout)
             )
 
-            logger = logging.getLogger('AnthropicExtractor')
             logger.info(f"Status Code: {response.status_code}")
             logger.info(f"Response headers: {response.headers}")
             if response.status_code != 200:
                 logger.error(f"Error Body: {response.text}")
 
             response.raise_for_status()
-            data = response.json()
-            logger.info(f"Response JSON: {data}")
+            return response.json()
 
-            # Extraer y parsear la respuesta JSON
-            if not data or 'content' not in data or not data['content']:
-                raise ValueError("Respuesta de Anthropic incompleta")
+        data = ANTHROPIC_CALLER.call(send)
+        logger.info(f"Response JSON: {data}")
+        return data
 
-            # Buscar el JSON en la respuesta de texto
-            text_response = data['content'][0]['text']
-            json_match = re.search(r'({[\s\S]*})', text_response)
+def response_json(data):
+    """Extrae el JSON del texto de una respuesta de la API de mensajes"""
+    # Extraer y parsear la respuesta JSON
+    if not data or 'content' not in data or not data['content']:
+        raise ValueError("Respuesta de Anthropic incompleta")
 
-            if not json_match:
-                raise ValueError("No se encontró JSON en la respuesta")
+    # Buscar el JSON en la respuesta de texto
+    text_response = data['content'][0]['text']
+    json_match = re.search(r'({[\s\S]*})', text_response)
 
-            extracted_data = json.loads(json_match.group(1))
-            confidence = extracted_data.get('confidence', 0.5)
-            
-            if 'confidence' in extracted_data:
-                del extracted_data['confidence']
-
-            return {
-                'results': extracted_data,
-                'confidence': float(confidence),  # Alta confianza para respuestas de Anthropic
-                'source': 'anthropic',
-                'needsHumanVerification': float(confidence) < self.confidence_threshold
-            }
-        except requests.exceptions.HTTPError as e:
-            logger = logging.getLogger('AnthropicExtractor')
-            error_msg = f"{e.response.status_code} {e.response.reason} for url: {e.response.url}"
-            logger.error(f"Error HTTP: {error_msg}")
-            logger.error(f"Response content: {e.response.text}")
-            
-            return {
-                'results': None,
-                'error': error_msg,
-                'confidence': 0,
-                'source': 'anthropic_error'
-            }
+    if not json_match:
+        raise ValueError("No se encontró JSON en la respuesta")
 
-        except Exception as e:
-            logger = logging.getLogger('AnthropicEXtractor')
-            logger.error(f"Error general: {str(e)}")
-            return {
-                'results': None,
-                'error': str(e),
-                'confidence': 0,
-                'source': 'anthropic_error'
-            }
\ No newline at end of file
+    return json.loads(json_match.group(1))
+
+def error_result(error, retryable=False, circuit_open=False):
+    """Resultado de error común a todas las extracciones con Anthropic.
+
+    `retryable` indica que el fallo es del servicio (circuito abierto, plazos
+    agotados) y el mensaje debe reintentarse más tarde en lugar de descartarse.
+    `circuit_open` indica que ni siquiera se llamó al servicio (circuito
+    abierto o semiabierto con la prueba en curso): el mensaje se aparca.
+    """
+    result = {
+        'results': None,
+        'error': error,
+        'confidence': 0,
+        'source': 'anthropic_error'
+    }
+    if retryable:
+        result['retryable'] = True
+    if circuit_open:
+        result['circuitOpen'] = True
+    return result
+
+def describe_field(field_id):
+    """Descripción del contenido esperado de una casilla para el prompt"""
+    if field_id.startswith('partido_'):
+        return f"votos del partido {field_id.replace('partido_', '')} (número)"
+    return FIELD_DESCRIPTIONS.get(field_id, field_id)
@@ -1,132 +1,340 @@
 # image_processor/data_extraction.py
+import os
+import time
 import cv2
 import numpy as np
 import pytesseract
 import re
-from algorithms.processing import preprocess_image
+import threading
+from algorithms.processing import preprocess_image, normalize_page, enhance_region
 from algorithms.template_matching import identify_acta_structure
 
-def extract_data_from_ballot(image):
-    """Extrae datos de un acta electoral procesada"""
-    # 1. Preprocesar la imagen
-    processed_image = preprocess_image(image)
-    
-    # 2. Identificar la estructura y obtener regiones de interés
-    roi_map = identify_acta_structure(processed_image)
-    
-    # 3. Extraer datos de cada región
-    data = {}
-    confidence_scores = {}
-    
-    # 3.1 Extraer código de mesa
-    code_roi = extract_roi(processed_image, roi_map['codigo_mesa'])
-    table_code = extract_text_from_region(code_roi, 'alphanumeric')
-    data['tableCode'] = table_code
-    confidence_scores['tableCode'] = calculate_confidence(code_roi)
-    
-    # 3.1.2 extraer numero de mesa
-    mesa_roi = extract_roi(processed_image, roi_map['numero_mesa'])
-    table_number = extract_text_from_region(mesa_roi, 'alphanumeric')
-    data['tableNumber'] = table_number
-    confidence_scores['tableNumber'] = calculate_confidence(mesa_roi)
-    
-    #  3.2 Extraer información de ubicación
-    department_roi = extract_roi(processed_image, roi_map['departamento'])
-    department = extract_text_from_region(department_roi, 'text')
-    confidence_scores['departamento'] = calculate_confidence(department_roi)
-    
-    province_roi = extract_roi(processed_image, roi_map['provincia'])
-    province = extract_text_from_region(province_roi, 'text')
-    confidence_scores['provincia'] = calculate_confidence(province_roi)
-    
-    
-    municipality_roi = extract_roi(processed_image, roi_map['municipio'])
-    municipality = extract_text_from_region(municipality_roi, 'text')
-    confidence_scores['municipio'] = calculate_confidence(municipality_roi)
-    
-    locality_roi = extract_roi(processed_image, roi_map['localidad'])
-    locality = extract_text_from_region(locality_roi, 'text')
-    confidence_scores['localidad'] = calculate_confidence(locality_roi)
-    
-    polling_place_roi = extract_roi(processed_image, roi_map['recinto'])
-    polling_place = extract_text_from_region(polling_place_roi, 'text')
-    confidence_scores['recinto'] = calculate_confidence(polling_place_roi)
-    
-    # 3.3 Extraer votos por partido
-    party_votes = []
-    party_keys = [key for key in roi_map.keys() if key.startswith('partido_')]
-    
-    for key in party_keys:
-        party_id = key.replace('partido_', '')
-        party_roi = extract_roi(processed_image, roi_map[key])
-        votes = extract_text_from_region(party_roi, 'numeric')
-        confidence = calculate_confidence(party_roi)
-        
-        try:
-            votes_int = int(votes) if votes.strip() else 0
-        except ValueError:
-            votes_int = 0
-            
-        party_votes.append({
-            'partyId': party_id,
-            'votes': votes_int,
-            'confidence': confidence
+# Modo de extracción: 'roi' procesa solo las celdas, 'full' la página completa
+OCR_EXTRACTION_MODE = os.environ.get('OCR_EXTRACTION_MODE', 'roi').lower()
+
+# Margen en píxeles alrededor de cada celda en modo 'roi'. Cubre la ventana de
+# búsqueda del NL-means (21 px) y el bloque del umbral adaptativo (11 px), de
+# modo que el borde de la celda se procesa igual que en la página completa.
+ROI_MARGIN_PX = int(os.environ.get('OCR_ROI_MARGIN_PX', '16'))
+
+# Origen de la confianza por campo: 'tesseract' (confianza del reconocedor) o
+# 'image' (heurística de intensidad y contraste de la región)
+OCR_CONFIDENCE_SOURCE = os.environ.get('OCR_CONFIDENCE_SOURCE', 'tesseract').lower()
+
+# Regiones de cabecera, ubicación y totales con su modo de OCR. Los votos por
+# partido se toman de las regiones 'partido_*' del mapa de regiones.
+FIELD_MODES = {
+    'codigo_mesa': 'alphanumeric',
+    'numero_mesa': 'alphanumeric',
+    'departamento': 'text',
+    'provincia': 'text',
+    'municipio': 'text',
+    'localidad': 'text',
+    'recinto': 'text',
+    'votos_validos': 'numeric',
+    'votos_blancos': 'numeric',
+    'votos_nulos': 'numeric',
+}
+
+# Configuración de Tesseract por modo de OCR
+OCR_CONFIGS = {
+    # Configuración específica para dígitos
+    'numeric': r'--oem 1 --psm 7 -c tessedit_char_whitelist=0123456789 -l spa',
+    # Nueva configuración para códigos alfanuméricos
+    'alphanumeric': r'--oem 1 --psm 7 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ-/ -l spa',
+    # Optimizar para texto general
+    'text': r'--oem 1 --psm 6 -l spa',
+}
+
+# Escalamiento local: los campos con confianza menor al umbral se vuelven a leer
+# con variantes de preprocesado, modo de segmentación (PSM) y margen de recorte,
+# dentro de un presupuesto de tiempo por acta (0 lo desactiva)
+FIELD_CONFIDENCE_THRESHOLD = float(os.environ.get('FIELD_CONFIDENCE_THRESHOLD', '0.8'))
+OCR_ESCALATION_BUDGET_MS = int(os.environ.get('OCR_ESCALATION_BUDGET_MS', '1500'))
+
+# Preprocesar las celdas de cada modo juntas en un atlas (una llamada por filtro
+# y por acta) en lugar de una a una: 'false' vuelve al preprocesado por celda
+OCR_BATCH_CELLS = os.environ.get('OCR_BATCH_CELLS', 'true').lower() == 'true'
+
+# Configuración que cambia el resultado del OCR (parte de la clave de la caché de etapas)
+OCR_SETTINGS = ','.join(str(value) for value in (
+    ROI_MARGIN_PX, OCR_CONFIDENCE_SOURCE, FIELD_CONFIDENCE_THRESHOLD, OCR_ESCALATION_BUDGET_MS, OCR_BATCH_CELLS
+))
+
+# Ampliación de las celdas antes del OCR
+DIGIT_SCALE = 4
+TEXT_SCALE = 2
+
+# Núcleos morfológicos compartidos por todas las celdas
+DIGIT_KERNEL = np.ones((2, 2), np.uint8)
+DIGIT_CLOSE_KERNEL = np.ones((3, 3), np.uint8)
+TEXT_KERNEL = np.ones((1, 1), np.uint8)
+
+# Separación entre celdas del atlas, en píxeles ya ampliados. Cubre el radio
+# del filtro bilateral (4) y del umbral adaptativo (10): el interior de cada
+# celda se filtra igual que si se procesara sola
+ATLAS_GUTTER = 12
+
+# Variantes en orden de coste: (preprocesado, psm, píxeles de margen extra)
+ESCALATION_VARIANTS = [
+    ('otsu', None, 0),
+    ('default', 8, 0),
+    ('default', None, 6),
+    ('otsu', 13, 6),
+    ('plain', None, 0),
+    ('default', None, -3),
+]
+
+def extract_data_from_ballot(image, mode=None, normalized=False):
+    """Extrae datos de un acta electoral procesada
+
+    En modo 'roi' la página solo se alinea (tamaño y perspectiva) y la reducción
+    de ruido y binarización se aplican únicamente a las celdas que se leen.
+    Si `normalized` es True la imagen ya viene alineada con normalize_page.
+    """
+    mode = mode or OCR_EXTRACTION_MODE
+    
+    # 1. Preparar la imagen e identificar la estructura y regiones de interés
+    if mode == 'roi':
+        page = image if normalized else normalize_page(image)
+        roi_map = identify_acta_structure(page)
+        get_region = lambda key, pad=0: extract_enhanced_roi(page, pad_roi(roi_map[key], pad))
+    else:
+        processed_image = preprocess_image(image)
+        roi_map = identify_acta_structure(processed_image)
+        get_region = lambda key, pad=0: extract_roi(processed_image, pad_roi(roi_map[key], pad))
+    
+    # 2. Leer cada región con su modo de OCR. Las celdas de cada modo se
+    # preprocesan juntas y solo el reconocimiento se hace celda por celda
+    field_ids = list(FIELD_MODES) + [key for key in roi_map.keys() if key.startswith('partido_')]
+    regions = {field_id: get_region(field_id) for field_id in field_ids}
+    prepared = prepare_regions(regions) if OCR_BATCH_CELLS else {}
+    readings = {}
+    for field_id in field_ids:
+        mode = field_mode(field_id)
+        if field_id in prepared:
+            text, confidence = recognize_region(prepared[field_id], OCR_CONFIGS[mode], regions[field_id], mode)
+        else:
+            text, confidence = read_region(regions[field_id], mode)
+        readings[field_id] = {'text': text, 'confidence': confidence}
+    
+    result = build_ballot_result(readings)
+    
+    # 3. Reintentar localmente solo los campos débiles antes de recurrir al fallback
+    if OCR_ESCALATION_BUDGET_MS > 0:
+        result = escalate_weak_fields(readings, result, get_region, OCR_ESCALATION_BUDGET_MS / 1000.0)
+    
+    return result
+
+def readings_from_result(ocr_result):
+    """Reconstruye las lecturas por región a partir de un resultado ya estructurado"""
+    results = ocr_result['results']
+    location = results.get('location', {})
+    votes = results.get('votes', {})
+    texts = {
+        'codigo_mesa': results.get('tableCode', ''),
+        'numero_mesa': results.get('tableNumber', ''),
+        'departamento': location.get('department', ''),
+        'provincia': location.get('province', ''),
+        'municipio': location.get('municipality', ''),
+        'localidad': location.get('locality', ''),
+        'recinto': location.get('pollingPlace', ''),
+        'votos_validos': str(votes.get('validVotes', 0)),
+        'votos_blancos': str(votes.get('blankVotes', 0)),
+        'votos_nulos': str(votes.get('nullVotes', 0)),
+    }
+    for party_vote in votes.get('partyVotes', []):
+        texts[f"partido_{party_vote['partyId']}"] = str(party_vote['votes'])
+    
+    field_confidences = ocr_result.get('fieldConfidences', {})
+    return {
+        field_id: {'text': text, 'confidence': field_confidences.get(field_id, 0.0)}
+        for field_id, text in texts.items()
+    }
+
+def uncertain_fields(ocr_result, threshold=FIELD_CONFIDENCE_THRESHOLD):
+    """Ids de región cuya confianza quedó bajo el umbral, de la más débil a la más fuerte"""
+    field_confidences = ocr_result.get('fieldConfidences', {})
+    weak = [field_id for field_id, confidence in field_confidences.items() if confidence < threshold]
+    return sorted(weak, key=field_confidences.get)
+
+def merge_field_values(ocr_result, values, confidence):
+    """Sustituye en el resultado OCR los campos leídos externamente y lo recalcula"""
+    readings = readings_from_result(ocr_result)
+    for field_id, text in values.items():
+        if field_id in readings:
+            mode = field_mode(field_id)
+            readings[field_id] = {'text': clean_text(text, mode), 'confidence': confidence}
+    return build_ballot_result(readings)
+
+def escalate_weak_fields(readings, result, get_region, budget_seconds):
+    """Vuelve a leer los campos de baja confianza con variantes, dentro del presupuesto
+
+    Los campos bajo FIELD_CONFIDENCE_THRESHOLD se reintentan hasta superar el
+    umbral y se conserva su lectura de mayor confianza. Si la suma de votos no
+    cuadra, las celdas de votos se leen además con todas las variantes aunque
+    su confianza ya sea alta (una lectura segura también puede estar mal) y se
+    eligen las lecturas que restauran vote_sum_consistency. La penalización
+    del número de mesa no depende de las celdas de votos y no las relee.
+    """
+    started = time.monotonic()
+    deadline = started + budget_seconds
+    weak_fields = [
+        field_id for field_id, reading in readings.items()
+        if reading['confidence'] < FIELD_CONFIDENCE_THRESHOLD
+    ]
+    vote_fields = [
+        field_id for field_id in readings
+        if field_id.startswith('partido_') or field_id == 'votos_validos'
+    ] if vote_sum_consistency(result['results']['votes']) < 1.0 else []
+    if not weak_fields and not vote_fields:
+        return result
+    
+    # Lecturas alternativas por campo y variante ya probada
+    alternatives = {}
+    
+    def read_variant(field_id, index):
+        variant, psm, pad = ESCALATION_VARIANTS[index]
+        text, confidence = read_region(get_region(field_id, pad), field_mode(field_id), variant, psm)
+        alternatives.setdefault(field_id, {})[index] = {'text': text, 'confidence': confidence}
+        return alternatives[field_id][index]
+    
+    # 1. Campos débiles, empezando por los de menor confianza
+    weak_fields.sort(key=lambda field_id: readings[field_id]['confidence'])
+    changed = set()
+    for field_id in weak_fields:
+        best = readings[field_id]
+        for index in range(len(ESCALATION_VARIANTS)):
+            if time.monotonic() >= deadline or best['confidence'] >= FIELD_CONFIDENCE_THRESHOLD:
+                break
+            reading = read_variant(field_id, index)
+            if reading['confidence'] > best['confidence']:
+                best = reading
+        if best is not readings[field_id]:
+            readings[field_id] = best
+            changed.add(field_id)
+        if time.monotonic() >= deadline:
+            break
+    
+    # 2. Si la suma sigue sin cuadrar, todas las variantes de las celdas de
+    # votos (variante por variante, para repartir el presupuesto entre celdas)
+    if vote_fields and vote_sum_consistency(build_ballot_result(readings)['results']['votes']) < 1.0:
+        for index in range(len(ESCALATION_VARIANTS)):
+            for field_id in vote_fields:
+                if time.monotonic() >= deadline:
+                    break
+                if index not in alternatives.get(field_id, {}):
+                    read_variant(field_id, index)
+        changed |= restore_consistency(readings, {
+            field_id: list(alternatives.get(field_id, {}).values()) for field_id in vote_fields
         })
     
-    # 3.4 Extraer totales
-    valid_roi = extract_roi(processed_image, roi_map['votos_validos'])
-    valid_votes = extract_text_from_region(valid_roi, 'numeric')
-    valid_confidence = calculate_confidence(valid_roi)
-    
-    blank_roi = extract_roi(processed_image, roi_map['votos_blancos'])
-    blank_votes = extract_text_from_region(blank_roi, 'numeric')
-    blank_confidence = calculate_confidence(blank_roi)
-    
-    null_roi = extract_roi(processed_image, roi_map['votos_nulos'])
-    null_votes = extract_text_from_region(null_roi, 'numeric')
-    null_confidence = calculate_confidence(null_roi)
-    
-    # 4. Estructurar datos
-    data['location'] = {
-        'department': department,
-        'province': province,
-        'municipality': municipality,
-        'locality': locality,
-        'pollingPlace': polling_place
+    escalated = build_ballot_result(readings)
+    escalated['escalation'] = {
+        'weakFields': len(set(weak_fields) | set(vote_fields)),
+        'improvedFields': len(changed),
+        'elapsedMs': int((time.monotonic() - started) * 1000)
     }
-    data['votes'] = {
-        'partyVotes': party_votes,
-        'validVotes': int(valid_votes) if valid_votes.strip() and valid_votes.isdigit() else 0,
-        'blankVotes': int(blank_votes) if blank_votes.strip() and blank_votes.isdigit() else 0,
-        'nullVotes': int(null_votes) if null_votes.strip() and null_votes.isdigit() else 0
+    return escalated
+
+def restore_consistency(readings, alternatives):
+    """Sustituye lecturas por alternativas mientras mejore la suma de votos.
+
+    En cada paso se aplica el cambio de una celda que más sube
+    vote_sum_consistency (a igualdad, el de mayor confianza). Una alternativa
+    solo se acepta si su confianza supera FIELD_CONFIDENCE_THRESHOLD o la de
+    la lectura original, y nunca una que deja sin votos válidos a una acta
+    con votos por partido. Devuelve los ids de los campos cambiados.
+    """
+    original = dict(readings)
+    
+    def acceptable(field_id, candidate, votes):
+        if candidate['text'] == readings[field_id]['text']:
+            return False
+        if candidate['confidence'] < min(FIELD_CONFIDENCE_THRESHOLD, original[field_id]['confidence']):
+            return False
+        if field_id == 'votos_validos' and parse_votes(candidate['text']) == 0:
+            return not any(party_vote['votes'] for party_vote in votes['partyVotes'])
+        return True
+    
+    changed = set()
+    consistency = vote_sum_consistency(build_ballot_result(readings)['results']['votes'])
+    while consistency < 1.0:
+        best = None
+        for field_id, candidates in alternatives.items():
+            for candidate in candidates:
+                votes = build_ballot_result({**readings, field_id: candidate})['results']['votes']
+                if not acceptable(field_id, candidate, votes):
+                    continue
+                score = vote_sum_consistency(votes)
+                if score > consistency and (best is None or (score, candidate['confidence']) > best[0]):
+                    best = ((score, candidate['confidence']), field_id, candidate)
+        if best is None:
+            break
+        (consistency, _), field_id, candidate = best
+        readings[field_id] = candidate
+        changed.add(field_id)
+    return changed
+
+def field_mode(field_id):
+    """Modo de OCR de una región: los votos por partido son siempre numéricos"""
+    if field_id.startswith('partido_'):
+        return 'numeric'
+    return FIELD_MODES[field_id]
+
+def parse_votes(text):
+    """Convierte el texto numérico de una celda a votos (0 si está vacío)"""
+    return int(text) if text.strip() and text.isdigit() else 0
+
+def build_ballot_result(readings):
+    """Estructura las lecturas por región y calcula la confianza general
+
+    `readings` asocia cada id de región (codigo_mesa, partido_MAS, ...) con su
+    texto y confianza. La confianza de cada campo es la del reconocedor; la
+    general es su promedio ponderado por la consistencia lógica de los datos.
+    """
+    text = lambda field_id: readings[field_id]['text']
+    
+    # 1. Estructurar datos
+    party_votes = [
+        {
+            'partyId': field_id.replace('partido_', ''),
+            'votes': parse_votes(reading['text']),
+            'confidence': reading['confidence']
+        }
+        for field_id, reading in readings.items() if field_id.startswith('partido_')
+    ]
+    data = {
+        'tableCode': text('codigo_mesa'),
+        'tableNumber': text('numero_mesa'),
+        'location': {
+            'department': text('departamento'),
+            'province': text('provincia'),
+            'municipality': text('municipio'),
+            'locality': text('localidad'),
+            'pollingPlace': text('recinto')
+        },
+        'votes': {
+            'partyVotes': party_votes,
+            'validVotes': parse_votes(text('votos_validos')),
+            'blankVotes': parse_votes(text('votos_blancos')),
+            'nullVotes': parse_votes(text('votos_nulos'))
+        }
     }
     
-    confidence_scores['validVotes'] = valid_confidence
-    confidence_scores['blankVotes'] = blank_confidence
-    confidence_scores['nullVotes'] = null_confidence
-    
-    # 5. Verificar consistencia lógica y calcular confianza general
+    # 2. Verificar consistencia lógica y calcular confianza general
+    field_confidences = {field_id: reading['confidence'] for field_id, reading in readings.items()}
     consistency_score = verify_data_consistency(data)
-    avg_confidence = sum([
-        confidence_scores['tableCode'],
-        confidence_scores['tableNumber'],
-        confidence_scores['departamento'],
-        confidence_scores['provincia'],
-        confidence_scores['municipio'],
-        confidence_scores['localidad'],
-        confidence_scores['recinto'],
-        valid_confidence,
-        blank_confidence,
-        null_confidence,
-        *[pv['confidence'] for pv in party_votes]
-    ]) / (10 + len(party_votes))
+    avg_confidence = sum(field_confidences.values()) / len(field_confidences)
     
     overall_confidence = avg_confidence * consistency_score
     
     return {
         'results': data,
         'confidence': overall_confidence,
-        'needsHumanVerification': overall_confidence < 0.7
+        'needsHumanVerification': overall_confidence < 0.7,
+        'fieldConfidences': field_confidences,
+        'consistency': consistency_score
     }
 
 def extract_roi(image, roi_info):
@@ -134,46 +342,123 @@ def extract_roi(image, roi_info):
     x, y, w, h = roi_info['x'], roi_info['y'], roi_info['w'], roi_info['h']
     return image[y:y+h, x:x+w]
 
+def pad_roi(roi_info, pad):
+    """Amplía (o reduce, con pad negativo) una región sin salir del origen"""
+    if not pad:
+        return roi_info
+    x, y = max(0, roi_info['x'] - pad), max(0, roi_info['y'] - pad)
+    return {
+        'x': x,
+        'y': y,
+        'w': max(1, roi_info['x'] + roi_info['w'] + pad - x),
+        'h': max(1, roi_info['y'] + roi_info['h'] + pad - y)
+    }
+
+def extract_enhanced_roi(page, roi_info, margin=ROI_MARGIN_PX):
+    """Recorta una celda con margen a resolución nativa y la procesa solo a ella"""
+    page_height, page_width = page.shape[:2]
+    x, y, w, h = roi_info['x'], roi_info['y'], roi_info['w'], roi_info['h']
+    
+    # 1. Recortar con margen, limitado a los bordes de la página
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(page_width, x + w + margin), min(page_height, y + h + margin)
+    crop = page[y0:y1, x0:x1]
+    if crop.size == 0:
+        return crop
+    
+    # 2. Reducir ruido y binarizar solo el recorte
+    enhanced = enhance_region(crop)
+    
+    # 3. Descartar el margen
+    return enhanced[y - y0:y - y0 + h, x - x0:x - x0 + w]
+
 def extract_text_from_region(roi, mode='text'):
     """Extrae texto de una región usando OCR con configuración optimizada"""
+    text, _ = read_region(roi, mode)
+    return text
+
+def read_region(roi, mode='text', variant='default', psm=None):
+    """Lee una región y devuelve (texto, confianza)
+
+    La confianza proviene del reconocedor: promedio de la confianza por palabra
+    de Tesseract, ponderado por la longitud de cada palabra. Con
+    OCR_CONFIDENCE_SOURCE=image se usa la heurística de intensidad anterior.
+    """
     if roi.size == 0:
-        return ""
+        return "", 0.0
+    
+    processed_roi, config = prepare_region(roi, mode, variant, psm)
+    return recognize_region(processed_roi, config, roi, mode)
 
-    # Aplicar optimizaciones según el tipo de texto
-    if mode == 'numeric':
-        # Configuración específica para dígitos
+def recognize_region(processed_roi, config, roi, mode='text'):
+    """OCR de una región ya preprocesada; `roi` es la región original (para
+    la confianza por imagen)
+    """
+    if OCR_CONFIDENCE_SOURCE == 'image':
+        text = pytesseract.image_to_string(processed_roi, config=config)
+        return clean_text(text, mode), calculate_confidence(roi)
+    
+    # Realizar OCR con datos por palabra
+    ocr_data = pytesseract.image_to_data(processed_roi, config=config,
+                                         output_type=pytesseract.Output.DICT)
+    text, confidence = combine_word_confidences(ocr_data)
+    
+    # Limpiar resultado
+    return clean_text(text, mode), confidence
+
+def combine_word_confidences(ocr_data):
+    """Une las palabras reconocidas y calcula su confianza (0-1)"""
+    words = []
+    weighted_confidence = 0.0
+    total_chars = 0
+    for word, conf in zip(ocr_data['text'], ocr_data['conf']):
+        word = str(word).strip()
+        conf = float(conf)
+        # Tesseract marca con -1 las filas que no son palabras (bloques, líneas)
+        if not word or conf < 0:
+            continue
+        words.append(word)
+        weighted_confidence += conf * len(word)
+        total_chars += len(word)
+    
+    if not total_chars:
+        return "", 0.0
+    return ' '.join(words), max(0.0, min(weighted_confidence / total_chars / 100.0, 1.0))
+
+def prepare_region(roi, mode='text', variant='default', psm=None):
+    """Preprocesa la región y elige la configuración de Tesseract según el modo
+
+    `variant` selecciona un preprocesado alternativo para el escalamiento
+    ('otsu': umbral global, 'plain': solo ampliación) y `psm` reemplaza el modo
+    de segmentación de página de la configuración.
+    """
+    scale_factor = 4 if mode == 'numeric' else 2
+    if variant == 'otsu':
+        processed_roi = preprocess_otsu(roi, scale_factor)
+    elif variant == 'plain':
+        processed_roi = upscale(roi, scale_factor)
+    elif mode == 'numeric':
+        # Preprocesado específico para dígitos
         processed_roi = preprocess_digits(roi)
-        config = r'--oem 1 --psm 7 -c tessedit_char_whitelist=0123456789 -l spa'
-    elif mode == 'alphanumeric':
-        # Nueva configuración para códigos alfanuméricos
-        processed_roi = preprocess_text(roi)
-        config = r'--oem 1 --psm 7 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ-/ -l spa'
     else:
-        # Optimizar para texto general
+        # Códigos alfanuméricos y texto general
         processed_roi = preprocess_text(roi)
-        config = r'--oem 1 --psm 6 -l spa'
-    
-    # Realizar OCR
-    text = pytesseract.image_to_string(processed_roi, config=config)
     
-    # Limpiar resultado
-    text = clean_text(text, mode)
-    
-    return text
+    config = OCR_CONFIGS.get(mode, OCR_CONFIGS['text'])
+    if psm is not None:
+        config = re.sub(r'--psm \d+', f'--psm {psm}', config)
+    return processed_roi, config
 
 def preprocess_digits(image):
     """Optimiza una imagen para reconocimiento de dígitos"""
     # 1. Redimensionar (ampliar) para mejor reconocimiento
-    height, width = image.shape
-    scale_factor = 4  # Aumentar el factor de escala
-    resized = cv2.resize(image, (width*scale_factor, height*scale_factor), interpolation=cv2.INTER_CUBIC)
+    resized = upscale(image, DIGIT_SCALE)
     
     # 2. Aplicar filtro bilateral para reducir ruido pero mantener bordes
     denoised = cv2.bilateralFilter(resized, 9, 75, 75)
     
     # 3. Mejorar contraste
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    enhanced = clahe.apply(denoised)
+    enhanced = get_digit_clahe().apply(denoised)
 
     # 4. Binarizar con umbral de Otsu
     _, otsu = cv2.threshold(enhanced, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
@@ -186,23 +471,45 @@ def preprocess_digits(image):
     # 6. Combinar ambos resultados para mayor robustez
     combined = cv2.bitwise_or(otsu, adaptive)
     
+    return clean_digit_strokes(combined)
+
+def clean_digit_strokes(binary):
+    """Limpieza morfológica de los dígitos binarizados"""
     # 7. Eliminar ruido pequeño
-    kernel = np.ones((2, 2), np.uint8)
-    cleaned = cv2.morphologyEx(combined, cv2.MORPH_OPEN, kernel)
+    cleaned = cv2.morphologyEx(binary, cv2.MORPH_OPEN, DIGIT_KERNEL)
     
     # 8. Dilatar ligeramente para conectar partes de dígitos
-    dilated = cv2.dilate(cleaned, kernel, iterations=1)
+    dilated = cv2.dilate(cleaned, DIGIT_KERNEL, iterations=1)
     
     # 9. Aplicar cierre morfológico para llenar huecos dentro de los dígitos
-    closed = cv2.morphologyEx(dilated, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
-    
-    return closed
+    return cv2.morphologyEx(dilated, cv2.MORPH_CLOSE, DIGIT_CLOSE_KERNEL)
+
+_local = threading.local()
+
+def get_digit_clahe():
+    """CLAHE de los dígitos, creado una vez por hilo"""
+    clahe = getattr(_local, 'clahe', None)
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+        _local.clahe = clahe
+    return clahe
+
+def upscale(image, scale_factor):
+    """Amplía una región para el reconocimiento"""
+    height, width = image.shape
+    return cv2.resize(image, (width*scale_factor, height*scale_factor), interpolation=cv2.INTER_CUBIC)
+
+def preprocess_otsu(image, scale_factor):
+    """Variante de escalamiento: ampliación, suavizado y umbral global de Otsu"""
+    resized = upscale(image, scale_factor)
+    blurred = cv2.GaussianBlur(resized, (3, 3), 0)
+    _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return binary
 
 def preprocess_text(image):
     """Optimiza una imagen para reconocimiento de texto general"""
     # Similar a preprocess_digits pero con parámetros ajustados para texto
-    height, width = image.shape
-    resized = cv2.resize(image, (width*2, height*2), interpolation=cv2.INTER_CUBIC)
+    resized = upscale(image, TEXT_SCALE)
     
     # Umbral adaptativo con parámetros para texto
     binary = cv2.adaptiveThreshold(
@@ -210,11 +517,105 @@ def preprocess_text(image):
     )
     
     # Eliminar ruido
-    kernel = np.ones((1, 1), np.uint8)
-    cleaned = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+    cleaned = cv2.morphologyEx(binary, cv2.MORPH_OPEN, TEXT_KERNEL)
     
     return cleaned
 
+def prepare_regions(regions):
+    """Preprocesa por lotes las regiones no vacías ({id: región}) con la
+    variante por defecto de su modo. Devuelve {id: región preprocesada}.
+    """
+    digits = [field_id for field_id, roi in regions.items() if roi.size and field_mode(field_id) == 'numeric']
+    texts = [field_id for field_id, roi in regions.items() if roi.size and field_mode(field_id) != 'numeric']
+    prepared = {}
+    if digits:
+        prepared.update(zip(digits, preprocess_digits_batch([regions[field_id] for field_id in digits])))
+    if texts:
+        prepared.update(zip(texts, preprocess_text_batch([regions[field_id] for field_id in texts])))
+    return prepared
+
+def stack_cells(cells, scale_factor, border):
+    """Amplía las celdas y las apila en un atlas de ancho común.
+
+    Cada celda ocupa una franja rodeada por ATLAS_GUTTER píxeles rellenados
+    con `border` (el borde que usaría el filtro sobre la celda sola). Devuelve
+    el atlas y la posición (y, alto, ancho) de cada celda en él.
+    """
+    resized = [upscale(cell, scale_factor) for cell in cells]
+    gutter = ATLAS_GUTTER
+    width = max(cell.shape[1] for cell in resized) + 2 * gutter
+    slots, strips, top = [], [], 0
+    for cell in resized:
+        height, cell_width = cell.shape
+        strips.append(cv2.copyMakeBorder(cell, gutter, gutter, gutter, width - gutter - cell_width, border))
+        slots.append((top + gutter, height, cell_width))
+        top += height + 2 * gutter
+    return np.vstack(strips), slots
+
+def unstack_cells(atlas, slots):
+    """Recorta del atlas cada celda (sin separación) como imagen independiente"""
+    gutter = ATLAS_GUTTER
+    return [np.ascontiguousarray(atlas[y:y + height, gutter:gutter + width]) for y, height, width in slots]
+
+def otsu_thresholds(histograms):
+    """Umbral de Otsu de cada fila de `histograms` (N x 256), como cv2.threshold"""
+    histograms = histograms.astype(np.float64)
+    probabilities = histograms / histograms.sum(axis=1, keepdims=True)
+    levels = np.arange(histograms.shape[1], dtype=np.float64)
+    q1 = np.cumsum(probabilities, axis=1)
+    q2 = 1.0 - q1
+    partial_mean = np.cumsum(probabilities * levels, axis=1)
+    mean = partial_mean[:, -1:]
+    epsilon = np.finfo(np.float32).eps
+    valid = (np.minimum(q1, q2) >= epsilon) & (np.maximum(q1, q2) <= 1.0 - epsilon)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu1 = partial_mean / q1
+        mu2 = (mean - partial_mean) / q2
+        sigma = np.where(valid, q1 * q2 * (mu1 - mu2) ** 2, 0.0)
+    # Primer máximo estrictamente positivo; 0 si no hay ninguno
+    return np.where(sigma.max(axis=1) > 0, sigma.argmax(axis=1), 0)
+
+def preprocess_digits_batch(cells):
+    """preprocess_digits sobre varias celdas a la vez.
+
+    El filtro bilateral y el umbral adaptativo se aplican una sola vez sobre
+    el atlas. El CLAHE (reutilizado) y el umbral de Otsu dependen de los
+    valores de cada celda y se calculan por celda, igual que la morfología:
+    su borde (neutro para la erosión y para la dilatación) no se puede
+    reproducir con un único relleno de la separación.
+    """
+    gutter = ATLAS_GUTTER
+    atlas, slots = stack_cells(cells, DIGIT_SCALE, cv2.BORDER_REFLECT_101)
+    enhanced = cv2.bilateralFilter(atlas, 9, 75, 75)
+    
+    clahe = get_digit_clahe()
+    width = atlas.shape[1]
+    row_thresholds = np.zeros(atlas.shape[0], np.int32)
+    histograms = []
+    for y, height, cell_width in slots:
+        cell = clahe.apply(enhanced[y:y + height, gutter:gutter + cell_width])
+        # La franja se rellena como el borde replicado del umbral adaptativo
+        enhanced[y - gutter:y + height + gutter] = cv2.copyMakeBorder(
+            cell, gutter, gutter, gutter, width - gutter - cell_width, cv2.BORDER_REPLICATE
+        )
+        histograms.append(np.bincount(cell.ravel(), minlength=256))
+    for (y, height, _), threshold in zip(slots, otsu_thresholds(np.array(histograms))):
+        row_thresholds[y - gutter:y + height + gutter] = threshold
+    
+    otsu = np.where(enhanced > row_thresholds[:, None], 0, 255).astype(np.uint8)
+    adaptive = cv2.adaptiveThreshold(
+        enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 21, 10
+    )
+    return [clean_digit_strokes(cell) for cell in unstack_cells(cv2.bitwise_or(otsu, adaptive), slots)]
+
+def preprocess_text_batch(cells):
+    """preprocess_text sobre varias celdas a la vez (un umbral y una morfología por lote)"""
+    atlas, slots = stack_cells(cells, TEXT_SCALE, cv2.BORDER_REPLICATE)
+    binary = cv2.adaptiveThreshold(
+        atlas, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 15, 8
+    )
+    return unstack_cells(cv2.morphologyEx(binary, cv2.MORPH_OPEN, TEXT_KERNEL), slots)
+
 def clean_text(text, mode='text'):
     """Limpia y normaliza el texto extraído"""
     # Eliminar espacios y saltos de línea
@@ -251,21 +652,30 @@ def calculate_confidence(roi):
     
     return max(0.0, min(confidence, 1.0))  # Limitar entre 0 y 1
 
-def verify_data_consistency(data):
-    """Verifica la consistencia lógica de los datos extraídos"""
-    # 1. Verificar que la suma de votos por partido = votos válidos
-    party_votes_sum = sum(pv['votes'] for pv in data['votes']['partyVotes'])
-    valid_votes = data['votes']['validVotes']
-
-    consistency_score = 1.0  # Perfecto por defecto
-
+def vote_sum_consistency(votes):
+    """Factor de consistencia entre la suma de votos por partido y los votos
+    válidos (1.0 si cuadran)
+    """
+    party_votes_sum = sum(pv['votes'] for pv in votes['partyVotes'])
+    valid_votes = votes['validVotes']
+    
     if valid_votes > 0:
         # Calcular diferencia porcentual
         difference = abs(party_votes_sum - valid_votes) / valid_votes
-
+        
         # Reducir score basado en la diferencia
         if difference > 0.1:  # Más del 10% de diferencia
-            consistency_score *= (1.0 - min(difference, 0.5))
+            return 1.0 - min(difference, 0.5)
+        return 1.0
+    
+    # Votos por partido sin votos válidos: la celda de válidos está vacía o mal
+    # leída, la suma no se puede dar por buena
+    return 0.5 if party_votes_sum > 0 else 1.0
+
+def verify_data_consistency(data):
+    """Verifica la consistencia lógica de los datos extraídos"""
+    # 1. Verificar que la suma de votos por partido = votos válidos
+    consistency_score = vote_sum_consistency(data['votes'])
 
     # 2. Verificar que el número de mesa es válido
     if not data['tableNumber'].isdigit() or len(data['tableNumber']) < 2:
@@ -0,0 +1,150 @@
+# image_processor/algorithms/decoding.py
+import os
+import struct
+import cv2
+import numpy as np
+from algorithms.memory import MAX_IMAGE_PIXELS, check_pixel_budget, fit_pixel_budget
+
+# Lado corto mínimo que debe conservar la imagen usada para validación
+VALIDATION_MIN_DIMENSION = int(os.environ.get('VALIDATION_MIN_DIMENSION', '1000'))
+
+# Marcadores SOF de JPEG que contienen las dimensiones del frame
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Formato propio para imágenes binarizadas: magic + alto/ancho + filas de bits
+PACKED_MAGIC = b'BPK1'
+PACKED_HEADER = struct.Struct('>4sII')
+
+GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+COLOR_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def sniff_image_header(image_data):
+    """Lee formato y dimensiones desde la cabecera sin decodificar la imagen.
+
+    Devuelve (formato, ancho, alto) o None si la cabecera no es reconocida.
+    """
+    if image_data[:4] == PACKED_MAGIC and len(image_data) >= PACKED_HEADER.size:
+        _, height, width = PACKED_HEADER.unpack_from(image_data)
+        return ('packbits', width, height)
+    if image_data[:2] == b'\xff\xd8':
+        return _sniff_jpeg(image_data)
+    if image_data[:8] == PNG_SIGNATURE and len(image_data) >= 24:
+        width, height = struct.unpack('>II', image_data[16:24])
+        return ('png', width, height)
+    return None
+
+def _sniff_jpeg(image_data):
+    """Recorre los segmentos JPEG hasta encontrar el marcador SOF"""
+    offset = 2
+    size = len(image_data)
+    while offset + 4 <= size:
+        if image_data[offset] != 0xFF:
+            return None
+        marker = image_data[offset + 1]
+        # Bytes de relleno entre segmentos
+        if marker == 0xFF:
+            offset += 1
+            continue
+        # Marcadores sin longitud (RSTn, TEM)
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            offset += 2
+            continue
+        segment_length = struct.unpack('>H', image_data[offset + 2:offset + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > size:
+                return None
+            height, width = struct.unpack('>HH', image_data[offset + 5:offset + 9])
+            return ('jpeg', width, height)
+        # Inicio de datos comprimidos sin haber visto SOF
+        if marker == 0xDA:
+            return None
+        offset += 2 + segment_length
+    return None
+
+def choose_reduction_factor(width, height, min_short_side=0, min_long_side=0, max_pixels=0):
+    """Elige el mayor factor de reducción (8, 4, 2) que respeta los tamaños mínimos.
+
+    Si se indica `max_pixels`, el factor nunca es menor que el necesario para
+    respetar ese presupuesto (el presupuesto prevalece sobre los mínimos).
+    """
+    short_side = min(width, height)
+    long_side = max(width, height)
+    factor = 1
+    if min_short_side or min_long_side:
+        for candidate in (8, 4, 2):
+            if short_side // candidate >= min_short_side and long_side // candidate >= min_long_side:
+                factor = candidate
+                break
+    if max_pixels:
+        for candidate in (1, 2, 4, 8):
+            if candidate >= factor and (width // candidate) * (height // candidate) <= max_pixels:
+                return candidate
+        return 8
+    return factor
+
+def decode_image(image_data, grayscale=False, min_short_side=0, min_long_side=0):
+    """Decodifica la imagen, a escala reducida si la cabecera lo permite.
+
+    Sin tamaños mínimos se realiza una decodificación completa. Para JPEG la
+    reducción se aplica en el propio decodificador (escalado DCT), por lo que
+    se evita reconstruir la imagen a resolución completa. Con MAX_IMAGE_PIXELS
+    configurado la imagen se reduce hasta el presupuesto o se rechaza con
+    ImageTooLargeError, según OVERSIZE_IMAGE_ACTION.
+    """
+    if image_data[:4] == PACKED_MAGIC:
+        return unpack_binary_image(image_data)
+    
+    factor = 1
+    if min_short_side or min_long_side or MAX_IMAGE_PIXELS:
+        header = sniff_image_header(image_data)
+        if header is not None:
+            _, width, height = header
+            max_pixels = check_pixel_budget(width, height)
+            factor = choose_reduction_factor(width, height, min_short_side, min_long_side, max_pixels)
+
+    flags = GRAYSCALE_FLAGS[factor] if grayscale else COLOR_FLAGS[factor]
+    img_array = np.frombuffer(image_data, np.uint8)
+    image = cv2.imdecode(img_array, flags)
+    
+    # Formatos sin cabecera reconocida o que siguen excediendo el presupuesto
+    if image is not None and MAX_IMAGE_PIXELS:
+        image = fit_pixel_budget(image)
+    return image
+
+def decode_for_validation(image_data):
+    """Decodifica en escala de grises reducida, suficiente para validar el acta"""
+    return decode_image(image_data, grayscale=True, min_short_side=VALIDATION_MIN_DIMENSION)
+
+def pack_binary_image(binary):
+    """Empaqueta una imagen binarizada (0/255) a 1 bit por píxel sin pérdida"""
+    height, width = binary.shape
+    bits = np.packbits(binary > 0, axis=1)
+    return PACKED_HEADER.pack(PACKED_MAGIC, height, width) + bits.tobytes()
+
+def unpack_binary_image(packed_data):
+    """Reconstruye la imagen binarizada (uint8 0/255) desde el formato empaquetado.
+
+    Las filas empaquetadas se leen sin copia sobre el buffer recibido; solo se
+    reserva memoria para la imagen desempaquetada.
+    """
+    _, height, width = PACKED_HEADER.unpack_from(packed_data)
+    row_bytes = (width + 7) // 8
+    bits = np.frombuffer(packed_data, np.uint8, count=height * row_bytes,
+                         offset=PACKED_HEADER.size).reshape(height, row_bytes)
+    binary = np.unpackbits(bits, axis=1, count=width)
+    binary *= 255
+    return binary
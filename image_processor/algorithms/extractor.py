@@ -1,51 +1,180 @@
 # image_processor/algorithms/extractor.py
 import logging
+import os
+import time
 import cv2
-import numpy as np
 import hashlib
 import re
 import base64
 
 # Importar funciones de los otros módulos
-from algorithms.processing import check_if_ballot, preprocess_image
+from algorithms.processing import check_if_ballot, normalize_page, enhance_region
 from algorithms.template_matching import identify_acta_structure
-from algorithms.anthropic_fallback import AnthropicExtractor
-from algorithms.data_extraction import extract_data_from_ballot
+from algorithms.data_extraction import extract_data_from_ballot, OCR_EXTRACTION_MODE, OCR_SETTINGS
+from algorithms.decoding import decode_image
+from algorithms.results import BallotResults
+from algorithms.quality import QUALITY_GATE_ENABLED, QUALITY_SETTINGS, assess_image_quality, quality_reason
+from algorithms.stage_cache import cached_stage, get_stage_cache, stage_key
+from algorithms.orientation import ORIENTATION_SETTINGS
 
 
+class StagedImage:
+    """Etapas de imagen de un archivo: gris, página alineada y página binarizada.
+
+    Cada etapa se lee de la caché de etapas si tiene su artefacto o se calcula
+    a partir de la anterior; el archivo solo se decodifica si alguna etapa
+    pedida no está en la caché. Sin caché (cache=None) todo se calcula.
+    """
+
+    def __init__(self, image_buffer, image_hash=None, cache=None):
+        self.image_buffer = image_buffer
+        self.image_hash = image_hash or hashlib.sha256(image_buffer).hexdigest()
+        self.cache = cache
+        self.keys = {'decode': stage_key(self.image_hash, 'decode')}
+        self.keys['page'] = stage_key(self.keys['decode'], 'page', ORIENTATION_SETTINGS)
+        self.keys['binary'] = stage_key(self.keys['page'], 'binary')
+        self._gray = None
+        self._page = None
+        self._binary = None
+        self._orientation = None
+
+    @classmethod
+    def from_page(cls, page, image_hash, cache=None):
+        """Etapas a partir de la página ya alineada por otra etapa (la cola de
+        OCR la recibe de la validación); `image_hash` es el del archivo original
+        """
+        staged = cls(None, image_hash, cache)
+        staged._page = page
+        return staged
+
+    def _stage(self, stage, compute):
+        return cached_stage(self.cache, self.keys[stage], 'array', compute, stage)
+
+    def gray(self):
+        """Imagen decodificada directamente en escala de grises"""
+        if self._gray is None:
+            self._gray = self._stage('decode', lambda: decode_image(self.image_buffer, grayscale=True))
+            if self._gray is None:
+                raise ValueError("No se pudo decodificar la imagen")
+        return self._gray
+
+    def quality(self):
+        return self.derived('quality', 'decode', lambda: assess_image_quality(self.gray()), QUALITY_SETTINGS)
+
+    def page(self):
+        """Página en gris con tamaño, perspectiva y orientación corregidos"""
+        if self._page is None:
+            self._page = self._stage('page', self._normalize)
+        return self._page
+
+    def _normalize(self):
+        self._orientation = {}
+        return normalize_page(self.gray(), self._orientation)
+
+    def orientation(self):
+        """Rotación aplicada a la página ({'rotation', 'confidence', 'scores'}).
+
+        Se llama después de page() o binary(): se registra al calcular la
+        página o se lee de la caché junto a ella. None si no se conoce.
+        """
+        return self.derived('orientation', 'page', lambda: self._orientation or None)
+
+    def binary(self, pool=None):
+        """Página filtrada y binarizada (equivale a preprocess_image)"""
+        if self._binary is None:
+            self._binary = self._stage('binary', lambda: enhance_region(self.page(), pool))
+        return self._binary
+
+    def derived(self, stage, parent, compute, params=''):
+        """Resultado JSON de una etapa de análisis sobre la etapa de imagen `parent`"""
+        return cached_stage(self.cache, stage_key(self.keys[parent], stage, params), 'json', compute, stage)
+
 class BallotExtractor:
     def __init__(self):
-        import os
         self.anthropic_enabled = os.environ.get('ENABLE_ANTHROPIC_FALLBACK', 'true').lower() == 'true'
         self.confidence_threshold = float(os.environ.get('OCR_CONFIDENCE_THRESHOLD', '0.8'))
-        self.anthropic_extractor = AnthropicExtractor() if self.anthropic_enabled else None
+        self._anthropic_extractor = None
+        self.extraction_mode = OCR_EXTRACTION_MODE
+        # Imagen binarizada de página completa en la respuesta (solo depuración en modo 'roi')
+        self.debug_images = os.environ.get('OCR_DEBUG_IMAGES', 'false').lower() == 'true'
+    
+    @property
+    def anthropic_extractor(self):
+        """Cliente de Anthropic, creado solo cuando se usa por primera vez"""
+        if self._anthropic_extractor is None and self.anthropic_enabled:
+            from algorithms.anthropic_fallback import AnthropicExtractor
+            self._anthropic_extractor = AnthropicExtractor()
+        return self._anthropic_extractor
     
-    def extract_data(self, image_buffer):
-        """Extrae datos de un acta electoral usando el método óptimo"""
+    def extract_data(self, image_buffer, timings=None, quality_gate=QUALITY_GATE_ENABLED):
+        """Extrae datos de un acta electoral usando el método óptimo
+
+        Si se pasa `timings` (diccionario), se registra en él la duración en
+        segundos de cada etapa: decode, quality, preprocess, validation y ocr.
+        `quality_gate=False` omite el control de calidad (imágenes ya
+        validadas o binarizadas, en las que no tiene sentido medirlo).
+        """
+        return self.extract_staged(StagedImage(image_buffer, cache=get_stage_cache()), timings, quality_gate)
+    
+    def extract_staged(self, staged, timings=None, quality_gate=QUALITY_GATE_ENABLED):
+        """Como extract_data, a partir de una StagedImage (por ejemplo, las
+        etapas que ya calculó la validación en el mismo proceso)
+        """
+        timings = {} if timings is None else timings
+        stage_started = time.monotonic()
+        
+        def end_stage(stage):
+            nonlocal stage_started
+            now = time.monotonic()
+            timings[stage] = now - stage_started
+            stage_started = now
+        
         try:
-            # 1. Convertir buffer a imagen
             logger = logging.getLogger('Extractor OCR')
             
-            img_array = np.frombuffer(image_buffer, np.uint8)
-            image = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+            # 1. Hash del archivo: identifica la acta y es la raíz de las claves
+            # de la caché de etapas (STAGE_CACHE_DIR)
+            image_hash = staged.image_hash
             
-            if image is None:
-                raise ValueError("No se pudo decodificar la imagen")
+            # 2. Convertir buffer a imagen. Con la caché solo se decodifica si
+            # alguna etapa no tiene su artefacto (y nunca si ya se recibió la página)
+            if staged.cache is None and staged.image_buffer is not None:
+                staged.gray()
+            end_stage('decode')
             
-            # 2. Generar hash para identificación única
-            image_hash = hashlib.sha256(image_buffer).hexdigest()
+            # Fotos borrosas, mal expuestas o mal encuadradas: no vale la pena
+            # procesarlas, es mejor pedir que se vuelva a tomar la foto
+            if quality_gate:
+                quality = staged.quality()
+                end_stage('quality')
+                if not quality['passed']:
+                    return {
+                        'success': False,
+                        'errorMessage': quality_reason(quality),
+                        'qualityIssues': quality['issues'],
+                        'qualityMetrics': quality['metrics'],
+                        'confidence': 0.0
+                    }
             
-            # 3. Convertir a escala de grises
-            if len(image.shape) == 3:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            # 3. Preprocesar imagen. En modo 'roi' solo se alinea la página; el
+            # filtrado se hace sobre cada celda durante la extracción
+            if self.extraction_mode == 'roi':
+                page = staged.page()
+                processed_img = enhance_region(page) if self.debug_images else None
+                analysis_stage = 'page'
             else:
-                gray = image.copy()
+                page = None
+                processed_img = staged.binary()
+                analysis_stage = 'binary'
+            orientation = staged.orientation()
+            end_stage('preprocess')
             
-            # 4. Preprocesar imagen
-            processed_img = preprocess_image(gray)
-            
-            # 5. Verificar si es un acta electoral
-            is_valid, confidence, reason = check_if_ballot(processed_img)
+            # 4. Verificar si es un acta electoral
+            is_valid, confidence, reason = staged.derived(
+                'validation', analysis_stage,
+                lambda: check_if_ballot(page if page is not None else processed_img)
+            )
+            end_stage('validation')
             
             if not is_valid and not self.anthropic_enabled:
                 return {
@@ -54,57 +183,61 @@ class BallotExtractor:
                     'confidence': confidence
                 }
             
-            # 6. Extraer imagen procesada para la respuesta
-            _, buffer = cv2.imencode('.jpg', processed_img)
-            processed_image_base64 = base64.b64encode(buffer).decode('utf-8')
-            height, width = processed_img.shape
+            # 5. Extraer imagen procesada para la respuesta
+            processed_image_base64 = None
+            if processed_img is not None:
+                _, buffer = cv2.imencode('.jpg', processed_img)
+                processed_image_base64 = base64.b64encode(buffer).decode('utf-8')
+            height, width = (page if page is not None else processed_img).shape
             
-            # 7. Intentar extracción con OCR
-            ocr_result = extract_data_from_ballot(processed_img)
+            # 6. Intentar extracción con OCR
+            if page is not None:
+                ocr_result = staged.derived(
+                    'ocr', 'page',
+                    lambda: extract_data_from_ballot(page, mode='roi', normalized=True),
+                    OCR_SETTINGS
+                )
+            else:
+                ocr_result = staged.derived(
+                    'ocr', 'binary',
+                    lambda: extract_data_from_ballot(processed_img, mode='full'),
+                    OCR_SETTINGS
+                )
+            end_stage('ocr')
             
             logger.info(f"Resultado OCR: confianza={ocr_result.get('confidence', 0)}, threshold={self.confidence_threshold}")
             
-            # 8. Respuesta completa para NestJS (independientemente de la confianza del OCR)
-            # Esta respuesta se envía al cliente HTTP y no afecta el procesamiento asíncrono
-            response = {
+            # 7. Respuesta para NestJS y para el pipeline asíncrono. Los valores se
+            # convierten a tipos nativos al construirla (sin recorrer el árbol después)
+            confidence_ocr = float(ocr_result.get('confidence', 0))
+            return {
                 'success': True,
                 'imageHash': image_hash,
-                'tableCode': ocr_result['results'].get('tableCode', ''),
-                'tableNumber': ocr_result['results'].get('tableNumber', ''),
-                'votes': ocr_result['results'].get('votes', {}),
-                'location': ocr_result['results'].get('location', {}),
-                'confidence': ocr_result.get('confidence', 0),
+                'results': BallotResults.from_dict(ocr_result['results']).to_dict(),
+                'confidence': confidence_ocr,
+                'fieldConfidences': {
+                    field_id: float(field_confidence)
+                    for field_id, field_confidence in ocr_result.get('fieldConfidences', {}).items()
+                },
                 'source': 'ocr',  # Siempre reportamos 'ocr' en la respuesta HTTP
-                'needsVerification': ocr_result.get('confidence', 0) < self.confidence_threshold,
+                'needsHumanVerification': confidence_ocr < self.confidence_threshold,
                 'processedImage': processed_image_base64,
                 'dimensions': {
-                    'width': width,
-                    'height': height
+                    'width': int(width),
+                    'height': int(height)
                 },
+                # Rotación aplicada para enderezar la página (grados, sentido horario)
+                'orientation': {
+                    'rotation': orientation['rotation'],
+                    'confidence': orientation['confidence']
+                } if orientation else None,
                 'validation': {
-                    'isValid': is_valid,
-                    'confidence': confidence,
+                    'isValid': bool(is_valid),
+                    'confidence': float(confidence),
                     'reason': reason if not is_valid else None
                 }
             }
 
-            return {
-            'success': True,
-            'imageHash': image_hash,
-            'results': {
-                'tableCode': response['tableCode'],
-                'tableNumber': response['tableNumber'],
-                'location': response['location'],
-                'votes': response['votes']
-            },
-            'confidence': response['confidence'],
-            'source': response['source'],
-            'needsHumanVerification': response['needsVerification'],
-            'processedImage': processed_image_base64,
-            'dimensions': response['dimensions'],
-            'validation': response['validation']
-        }
-
         except Exception as e:
             import traceback
             error_details = traceback.format_exc()
@@ -0,0 +1,144 @@
+# image_processor/algorithms/memory.py
+import math
+import os
+import resource
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+# Modo de memoria acotada: reutiliza buffers por worker y aplica un presupuesto de píxeles
+MEMORY_BUDGET_MODE = os.environ.get('MEMORY_BUDGET_MODE', 'false').lower() == 'true'
+
+# Máximo de píxeles decodificados por imagen (0 desactiva el límite)
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', '12000000' if MEMORY_BUDGET_MODE else '0'))
+
+# Qué hacer con imágenes que superan el presupuesto: 'downscale' o 'reject'
+OVERSIZE_IMAGE_ACTION = os.environ.get('OVERSIZE_IMAGE_ACTION', 'downscale').lower()
+
+# Número máximo de buffers preasignados que conserva cada worker
+BUFFER_POOL_SIZE = int(os.environ.get('BUFFER_POOL_SIZE', '6'))
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+class ImageTooLargeError(ValueError):
+    """La imagen supera el presupuesto de píxeles configurado"""
+
+def current_rss_bytes():
+    """Memoria residente actual del proceso"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # Sin /proc solo está disponible el pico histórico (KB en Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak_rss():
+    """Reinicia el pico de memoria residente que lleva el kernel (VmHWM) a la
+    memoria actual. Devuelve False si no está disponible (sin /proc, Linux < 4.0)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_bytes():
+    """Pico de memoria residente del proceso desde el último reset_peak_rss"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    # Pico histórico del proceso (KB en Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RssTracker:
+    """Registra la memoria residente en cada etapa de una acta y su pico.
+
+    El pico es el del kernel (VmHWM), reiniciado al empezar la acta: incluye
+    los máximos dentro de una etapa (NL-means, decodificación), no solo los
+    valores al terminar cada una. Es el pico del proceso mientras se procesa
+    la acta, también con otras actas en paralelo. Si el kernel no permite
+    reiniciarlo solo se cuentan las muestras de cada etapa.
+    """
+
+    def __init__(self):
+        self.kernel_peak = reset_peak_rss()
+        self.start = current_rss_bytes()
+        self.last = self.start
+        self.peak = self.start
+        self.stages = {}
+
+    def sample(self, stage):
+        rss = current_rss_bytes()
+        self.stages[stage] = rss
+        self.last = rss
+        self.peak = max(self.peak, rss, peak_rss_bytes() if self.kernel_peak else 0)
+        return rss
+
+    def report(self, registry, stage_label):
+        """Publica el pico y el incremento de RSS de la acta como métricas"""
+        registry.observe('ballot_peak_rss_bytes', self.peak, stage=stage_label)
+        registry.observe('ballot_rss_growth_bytes', self.peak - self.start, stage=stage_label)
+        registry.set_gauge('process_rss_bytes', self.last)
+
+class BufferPool:
+    """Buffers preasignados por forma y tipo, reutilizados entre actas.
+
+    Cada buffer se identifica además por una etiqueta, de modo que una misma
+    etapa pueda pedir varios buffers intermedios del mismo tamaño.
+    """
+
+    def __init__(self, max_buffers=BUFFER_POOL_SIZE):
+        self.max_buffers = max_buffers
+        self._buffers = OrderedDict()
+
+    def get(self, tag, shape, dtype=np.uint8):
+        key = (tag, tuple(shape), np.dtype(dtype).str)
+        buffer = self._buffers.pop(key, None)
+        if buffer is None:
+            buffer = np.empty(shape, dtype)
+        self._buffers[key] = buffer
+        # Descartar los buffers menos usados recientemente
+        while len(self._buffers) > self.max_buffers:
+            self._buffers.popitem(last=False)
+        return buffer
+
+    def clear(self):
+        self._buffers.clear()
+
+_local = threading.local()
+
+def get_buffer_pool():
+    """Pool de buffers del hilo actual, o None si el modo de memoria acotada está desactivado"""
+    if not MEMORY_BUDGET_MODE:
+        return None
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        pool = BufferPool()
+        _local.pool = pool
+    return pool
+
+def check_pixel_budget(width, height, max_pixels=MAX_IMAGE_PIXELS):
+    """Devuelve el número máximo de píxeles a decodificar, o lanza ImageTooLargeError"""
+    if not max_pixels or width * height <= max_pixels:
+        return 0
+    if OVERSIZE_IMAGE_ACTION == 'reject':
+        raise ImageTooLargeError(
+            f"Imagen demasiado grande ({width}x{height}, {width * height} píxeles; máximo {max_pixels})"
+        )
+    return max_pixels
+
+def fit_pixel_budget(image, max_pixels=MAX_IMAGE_PIXELS):
+    """Reduce una imagen ya decodificada hasta el presupuesto de píxeles"""
+    height, width = image.shape[:2]
+    budget = check_pixel_budget(width, height, max_pixels)
+    if not budget:
+        return image
+    scale = math.sqrt(budget / float(width * height))
+    new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
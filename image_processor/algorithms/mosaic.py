@@ -0,0 +1,59 @@
+# image_processor/algorithms/mosaic.py
+import cv2
+import numpy as np
+
+# Alto común de cada recorte dentro del mosaico
+MOSAIC_CELL_HEIGHT = 96
+
+# Ancho de la columna de etiquetas a la izquierda de cada recorte
+MOSAIC_LABEL_WIDTH = 260
+
+# Contexto alrededor de cada celda, en fracción de su alto
+MOSAIC_CONTEXT = 0.3
+
+def crop_with_context(page, roi_info, context=MOSAIC_CONTEXT):
+    """Recorta una celda con algo de contexto para que sea legible por sí sola"""
+    page_height, page_width = page.shape[:2]
+    x, y, w, h = roi_info['x'], roi_info['y'], roi_info['w'], roi_info['h']
+    pad = int(h * context)
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    x1, y1 = min(page_width, x + w + pad), min(page_height, y + h + pad)
+    return page[y0:y1, x0:x1]
+
+def build_field_mosaic(page, roi_map, field_ids, cell_height=MOSAIC_CELL_HEIGHT):
+    """Compone un mosaico vertical de los recortes de `field_ids`, etiquetados con su id
+
+    Cada fila lleva a la izquierda el id del campo sobre fondo blanco y a la
+    derecha el recorte escalado al alto común. Devuelve la imagen en gris.
+    """
+    rows = []
+    for field_id in field_ids:
+        crop = crop_with_context(page, roi_map[field_id])
+        if crop.size == 0:
+            continue
+        if len(crop.shape) == 3:
+            crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+
+        # 1. Escalar el recorte al alto común manteniendo el aspecto
+        scale = cell_height / float(crop.shape[0])
+        crop = cv2.resize(crop, (max(1, int(crop.shape[1] * scale)), cell_height),
+                          interpolation=cv2.INTER_CUBIC if scale > 1 else cv2.INTER_AREA)
+
+        # 2. Etiqueta con el id del campo
+        label = np.full((cell_height, MOSAIC_LABEL_WIDTH), 255, np.uint8)
+        cv2.putText(label, field_id, (6, cell_height // 2 + 8), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.7, 0, 2, cv2.LINE_AA)
+        rows.append(np.hstack([label, crop]))
+
+    if not rows:
+        return None
+
+    # 3. Igualar anchos y separar filas con una línea para que no se confundan
+    width = max(row.shape[1] for row in rows)
+    separator = np.full((4, width), 128, np.uint8)
+    padded = []
+    for row in rows:
+        if row.shape[1] < width:
+            row = np.hstack([row, np.full((cell_height, width - row.shape[1]), 255, np.uint8)])
+        padded.extend([row, separator])
+    return np.vstack(padded[:-1])
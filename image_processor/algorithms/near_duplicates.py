@@ -0,0 +1,283 @@
+# image_processor/algorithms/near_duplicates.py
+import base64
+import json
+import os
+import threading
+import zlib
+from itertools import combinations
+import cv2
+import numpy as np
+
+from algorithms.data_extraction import FIELD_MODES
+
+# Qué hacer con una acta casi idéntica a otra ya recibida: 'off', 'flag'
+# (marcarla con la acta original) o 'reuse' (reutilizar su resultado si ya existe)
+NEAR_DUPLICATE_MODE = os.environ.get('NEAR_DUPLICATE_MODE', 'flag').lower()
+
+# Distancia de Hamming máxima (sobre 64 bits) para que una acta previa sea
+# candidata. El hash de la página completa lo domina el formulario impreso:
+# solo preselecciona, cada candidata se confirma con su firma de contenido
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_MAX_DISTANCE', '6'))
+
+# Confirmación: píxeles de tinta distintos tolerados en cada celda que lee el
+# OCR (página llevada a SIGNATURE_PAGE_WIDTH) y diferencia máxima de tinta en
+# cada bloque de la grilla de la página
+NEAR_DUPLICATE_MAX_CELL_PIXELS = int(os.environ.get('NEAR_DUPLICATE_MAX_CELL_PIXELS', '4'))
+NEAR_DUPLICATE_MAX_GRID_DIFFERENCE = float(os.environ.get('NEAR_DUPLICATE_MAX_GRID_DIFFERENCE', '0.3'))
+
+# Archivo JSONL donde se persiste el índice ('' lo mantiene solo en memoria).
+# Varios procesos pueden compartirlo: cada uno lee las líneas nuevas al consultar
+PHASH_INDEX_PATH = os.environ.get('PHASH_INDEX_PATH', '')
+
+HASH_BITS = 64
+
+# Firma de contenido: ancho al que se lleva la página, desplazamiento tolerado
+# al comparar celdas (fotos distintas de la misma acta no quedan alineadas al
+# píxel), líneas del formulario (largo de la ventana y contraste mínimo frente
+# a las filas vecinas) y grilla de bloques de la página completa
+SIGNATURE_PAGE_WIDTH = 1000
+SIGNATURE_CELL_SHIFT = 2
+SIGNATURE_LINE_WINDOW = 61
+SIGNATURE_LINE_CONTRAST = 60
+SIGNATURE_GRID_SIZE = (96, 128)
+SIGNATURE_GRID_LEVELS = 15
+
+def dhash(gray, hash_size=8):
+    """Hash perceptual por diferencias (dHash) de 64 bits.
+
+    Compara la intensidad de píxeles vecinos en una miniatura de 9x8; es
+    estable frente a recompresión, cambios de escala y de brillo.
+    """
+    if len(gray.shape) == 3:
+        gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def _thin_lines(gray, axis):
+    """Líneas finas del formulario a lo largo de `axis` (0 horizontales, 1 verticales).
+
+    Promedia cada píxel con la ventana SIGNATURE_LINE_WINDOW en la dirección
+    de la línea: una línea, aun cortada por el umbral, queda más oscura que las
+    filas a pocos píxeles; los dígitos se diluyen en la ventana y su tinta
+    ocupa también las filas vecinas.
+    """
+    window = (SIGNATURE_LINE_WINDOW, 1) if axis == 0 else (1, SIGNATURE_LINE_WINDOW)
+    profile = cv2.blur(gray.astype(np.float32), window)
+    neighbours = np.minimum(np.roll(profile, 4, axis), np.roll(profile, -4, axis))
+    lines = (profile < neighbours - SIGNATURE_LINE_CONTRAST).astype(np.uint8)
+    return cv2.dilate(lines, np.ones((3, 1) if axis == 0 else (1, 3), np.uint8))
+
+def ink_mask(gray):
+    """Tinta (1) sobre papel (0) sin las líneas del formulario.
+
+    El umbral es local para tolerar sombras. Las líneas de la tabla son
+    iguales en todas las actas y las que más cambian con un desalineamiento
+    de pocos píxeles, así que no forman parte del contenido.
+    """
+    ink = cv2.adaptiveThreshold(gray, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+    # Sin motas de ruido o de compresión: cambian entre dos copias de la misma foto
+    ink = cv2.morphologyEx(ink, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+    return ink & ~(_thin_lines(gray, 0) | _thin_lines(gray, 1))
+
+def _encode_bytes(array):
+    return base64.b64encode(zlib.compress(array.tobytes())).decode('ascii')
+
+def _decode_bytes(text):
+    return np.frombuffer(zlib.decompress(base64.b64decode(text)), np.uint8)
+
+def content_signature(page, roi_map):
+    """Firma de lo que distingue a una acta de otra con el mismo formulario.
+
+    `page` es la página alineada en gris y `roi_map` sus regiones
+    (identify_acta_structure). Guarda la tinta de cada celda que lee el OCR y
+    la proporción de tinta por bloque de la página completa. La página se
+    lleva antes a un ancho fijo: la misma foto a otra resolución da la misma
+    firma.
+    """
+    scale = SIGNATURE_PAGE_WIDTH / page.shape[1]
+    page = cv2.resize(page, (SIGNATURE_PAGE_WIDTH, max(1, round(page.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+    ink = ink_mask(page)
+    grid = cv2.resize(ink.astype(np.float32), SIGNATURE_GRID_SIZE, interpolation=cv2.INTER_AREA)
+    fields = sorted(field_id for field_id in roi_map if field_id in FIELD_MODES or field_id.startswith('partido_'))
+    shapes, cells = [], []
+    for field_id in fields:
+        x, y, w, h = (round(roi_map[field_id][key] * scale) for key in ('x', 'y', 'w', 'h'))
+        crop = ink[y:y + h, x:x + w]
+        shapes.append(list(crop.shape))
+        cells.append(crop.flatten())
+    cell_bits = np.packbits(np.concatenate(cells)) if cells else np.zeros(0, np.uint8)
+    return {
+        'fields': fields,
+        'shapes': shapes,
+        'grid': _encode_bytes(np.round(grid * SIGNATURE_GRID_LEVELS).astype(np.uint8)),
+        'cells': _encode_bytes(cell_bits),
+    }
+
+def _signature_cells(signature):
+    sizes = [height * width for height, width in signature['shapes']]
+    bits = np.unpackbits(_decode_bytes(signature['cells']), count=sum(sizes))
+    offsets = np.cumsum([0] + sizes)
+    return [
+        bits[start:start + size].reshape(shape)
+        for start, size, shape in zip(offsets, sizes, signature['shapes'])
+    ]
+
+def _cell_difference(a, b, shift=SIGNATURE_CELL_SHIFT):
+    """Píxeles de tinta distintos entre dos celdas con el mejor desplazamiento.
+
+    Solo cuentan las diferencias de al menos 2x2 píxeles: el borde de un trazo
+    que se corre un píxel no cambia el contenido, un trazo agregado sí.
+    """
+    height, width = min(a.shape[0], b.shape[0]), min(a.shape[1], b.shape[1])
+    a = a[:height, :width]
+    pad = np.pad(b[:height, :width], shift)
+    kernel = np.ones((2, 2), np.uint8)
+    return min(
+        int(np.count_nonzero(cv2.morphologyEx(
+            a ^ pad[shift + dy:shift + dy + height, shift + dx:shift + dx + width], cv2.MORPH_OPEN, kernel
+        )))
+        for dy in range(-shift, shift + 1) for dx in range(-shift, shift + 1)
+    )
+
+def same_content(a, b):
+    """Indica si dos firmas de contenido corresponden a la misma acta"""
+    if not a or not b or a['fields'] != b['fields']:
+        return False
+    grid_a = _decode_bytes(a['grid']).astype(np.int16)
+    grid_b = _decode_bytes(b['grid']).astype(np.int16)
+    if grid_a.shape != grid_b.shape:
+        return False
+    if np.abs(grid_a - grid_b).max() > NEAR_DUPLICATE_MAX_GRID_DIFFERENCE * SIGNATURE_GRID_LEVELS:
+        return False
+    return all(
+        _cell_difference(cell_a, cell_b) <= NEAR_DUPLICATE_MAX_CELL_PIXELS
+        for cell_a, cell_b in zip(_signature_cells(a), _signature_cells(b))
+    )
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def format_hash(value):
+    return f"{value:016x}"
+
+class PerceptualIndex:
+    """Índice de hashes de 64 bits con búsqueda por distancia de Hamming.
+
+    Multi-index hashing: el hash se divide en `chunks` bloques de 16 bits con
+    una tabla por bloque. Si dos hashes están a distancia <= r, al menos un
+    bloque difiere en <= r // chunks bits, así que basta con consultar en cada
+    tabla los valores a esa distancia del bloque buscado y verificar los
+    candidatos. El coste depende de los candidatos, no del tamaño del índice.
+    """
+
+    def __init__(self, path=PHASH_INDEX_PATH, chunks=4):
+        self.chunks = chunks
+        self.chunk_bits = HASH_BITS // chunks
+        self.tables = [{} for _ in range(chunks)]
+        # hash -> {ballotId: {'ballotId', 'signature', 'result'}}: actas distintas
+        # con el mismo formulario pueden compartir hash
+        self.entries = {}
+        self.path = path
+        self._offset = 0
+        self._lock = threading.Lock()
+        if path:
+            self.refresh()
+
+    def _chunk_values(self, value):
+        mask = (1 << self.chunk_bits) - 1
+        return [(value >> (i * self.chunk_bits)) & mask for i in range(self.chunks)]
+
+    def _variants(self, chunk, radius):
+        """Valores del bloque a distancia <= radius"""
+        yield chunk
+        for distance in range(1, radius + 1):
+            for positions in combinations(range(self.chunk_bits), distance):
+                variant = chunk
+                for position in positions:
+                    variant ^= 1 << position
+                yield variant
+
+    def _insert(self, value, entry):
+        if value not in self.entries:
+            for table, chunk in zip(self.tables, self._chunk_values(value)):
+                table.setdefault(chunk, []).append(value)
+        by_ballot = self.entries.setdefault(value, {})
+        by_ballot[entry['ballotId']] = {**by_ballot.get(entry['ballotId'], {}), **entry}
+
+    def add(self, value, ballot_id, result=None, signature=None):
+        """Registra el hash de una acta con su firma de contenido (y su
+        resultado, si ya se conoce)
+        """
+        entry = {'ballotId': ballot_id}
+        if signature is not None:
+            entry['signature'] = signature
+        if result is not None:
+            entry['result'] = result
+        with self._lock:
+            self._insert(value, entry)
+            if self.path:
+                with open(self.path, 'a') as index_file:
+                    index_file.write(json.dumps({'hash': format_hash(value), **entry}) + '\n')
+
+    def query(self, value, max_distance=NEAR_DUPLICATE_MAX_DISTANCE):
+        """Entradas a distancia <= max_distance: [(distancia, hash, entrada)] de menor a mayor"""
+        if self.path:
+            self.refresh()
+        radius = max_distance // self.chunks
+        candidates = set()
+        with self._lock:
+            for table, chunk in zip(self.tables, self._chunk_values(value)):
+                for variant in self._variants(chunk, radius):
+                    candidates.update(table.get(variant, ()))
+            matches = []
+            for candidate in candidates:
+                distance = hamming(value, candidate)
+                if distance <= max_distance:
+                    matches.extend((distance, candidate, entry) for entry in self.entries[candidate].values())
+        return sorted(matches, key=lambda match: match[0])
+
+    def refresh(self):
+        """Incorpora las entradas añadidas al archivo por otros procesos"""
+        if not os.path.exists(self.path):
+            return
+        with self._lock:
+            with open(self.path, 'rb') as index_file:
+                index_file.seek(self._offset)
+                for line in index_file:
+                    if not line.endswith(b'\n'):
+                        # Línea a medio escribir: se leerá en la próxima consulta
+                        break
+                    self._offset += len(line)
+                    record = json.loads(line)
+                    value = int(record.pop('hash'), 16)
+                    self._insert(value, record)
+
+    def __len__(self):
+        return sum(len(by_ballot) for by_ballot in self.entries.values())
+
+def find_near_duplicate(index, value, ballot_id, signature, max_distance=NEAR_DUPLICATE_MAX_DISTANCE):
+    """Acta previa más parecida a `value` (distinta de `ballot_id`) cuya firma
+    de contenido coincide con `signature`, o None.
+
+    Se prefiere la más cercana con resultado conocido: una copia de una copia
+    aún en proceso no aporta nada que reutilizar. Las entradas sin firma
+    (índices anteriores) no se confirman nunca.
+    """
+    matches = [
+        (distance, entry) for distance, _, entry in index.query(value, max_distance)
+        if entry['ballotId'] != ballot_id and same_content(signature, entry.get('signature'))
+    ]
+    if not matches:
+        return None
+    distance, entry = next(((d, e) for d, e in matches if e.get('result')), matches[0])
+    return {'ballotId': entry['ballotId'], 'distance': distance, 'result': entry.get('result')}
+
+_index = None
+
+def get_near_duplicate_index():
+    """Índice compartido por el proceso"""
+    global _index
+    if _index is None:
+        _index = PerceptualIndex()
+    return _index
@@ -0,0 +1,207 @@
+# image_processor/algorithms/orientation.py
+import os
+import cv2
+import numpy as np
+
+# Detectar y corregir actas subidas de lado o invertidas: 'false' lo desactiva
+ORIENTATION_DETECTION = os.environ.get('ORIENTATION_DETECTION', 'true').lower() == 'true'
+
+# Lado largo de la miniatura sobre la que se decide la orientación
+ORIENTATION_THUMBNAIL_SIDE = int(os.environ.get('ORIENTATION_THUMBNAIL_SIDE', '800'))
+
+# Ventaja mínima de la mejor rotación sobre 0° para aplicarla: ante la duda
+# la página se deja como llegó
+ORIENTATION_MIN_MARGIN = float(os.environ.get('ORIENTATION_MIN_MARGIN', '0.15'))
+
+# Peso de cada indicio en la puntuación de una rotación. Las líneas de texto y
+# las barras del código distinguen el eje (vertical u horizontal); el logo y
+# los ascendentes distinguen arriba de abajo
+ORIENTATION_WEIGHTS = {
+    'textLines': 1.0,
+    'barcode': 1.0,
+    'logo': 0.6,
+    'ascenders': 0.6,
+}
+
+# Configuración que cambia el resultado (parte de la clave de la caché de etapas)
+ORIENTATION_SETTINGS = ','.join(str(value) for value in (
+    ORIENTATION_DETECTION, ORIENTATION_THUMBNAIL_SIDE, ORIENTATION_MIN_MARGIN
+))
+
+# Rotación en sentido horario que endereza la página -> código de cv2.rotate
+ROTATIONS = {
+    0: None,
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+# Bloques para buscar franjas de código de barras y transiciones mínimas por
+# línea del bloque para considerarlo franjeado
+STRIPE_BLOCK = 16
+STRIPE_MIN_TRANSITIONS = 4
+
+# Fracción de la página que ocupa cada esquina donde se busca el logo
+LOGO_CORNER = 0.15
+
+def rotate_page(image, rotation):
+    """Rota la imagen `rotation` grados en sentido horario (múltiplo de 90)"""
+    code = ROTATIONS[rotation % 360]
+    return image if code is None else cv2.rotate(image, code)
+
+def make_ink_mask(gray, max_side=ORIENTATION_THUMBNAIL_SIDE):
+    """Miniatura binarizada (tinta = 1) y la misma sin las líneas largas de la tabla"""
+    height, width = gray.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+    if scale < 1:
+        gray = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+                          interpolation=cv2.INTER_AREA)
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    if np.count_nonzero(ink) > ink.size // 2:
+        # Página ya binarizada con el texto en blanco (enhance_region): la
+        # tinta es siempre la minoría de los píxeles
+        ink ^= 1
+
+    # Las líneas de la grilla y el marco son iguales en ambos ejes del texto:
+    # se quitan para que no dominen los perfiles de proyección
+    line_length = max(15, min(ink.shape) // 5)
+    horizontal = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (line_length, 1)))
+    vertical = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, line_length)))
+    text = ink & ~(horizontal | vertical)
+    return ink, text
+
+def _balance(a, b):
+    total = a + b
+    return float((a - b) / total) if total else 0.0
+
+def text_line_score(text):
+    """Positivo si las líneas de texto son horizontales, negativo si verticales.
+
+    Un cierre morfológico une las letras de cada palabra; las palabras de
+    varias letras son más anchas que altas en el sentido de la escritura.
+    """
+    gap = max(3, min(text.shape) // 100)
+    words = cv2.morphologyEx(text, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (gap, gap)))
+    count, _, stats, _ = cv2.connectedComponentsWithStats(words, connectivity=8)
+    widths = stats[1:, cv2.CC_STAT_WIDTH].astype(np.int64)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT].astype(np.int64)
+    # Sin manchas grandes (logo, restos de la grilla) ni ruido de un píxel
+    limit = min(text.shape) // 4
+    keep = (np.maximum(widths, heights) < limit) & (np.minimum(widths, heights) >= 2)
+    widths, heights = widths[keep], heights[keep]
+    return _balance(int(np.maximum(widths - heights, 0).sum()), int(np.maximum(heights - widths, 0).sum()))
+
+def barcode_stripe_score(ink):
+    """Positivo si las barras del código son verticales (código horizontal)"""
+    height = ink.shape[0] // STRIPE_BLOCK * STRIPE_BLOCK
+    width = ink.shape[1] // STRIPE_BLOCK * STRIPE_BLOCK
+    if not height or not width:
+        return 0.0
+    ink = ink[:height, :width].astype(np.int8)
+    # Transiciones tinta/papel a lo largo de cada fila y de cada columna, sumadas por bloque
+    along_rows = np.abs(np.diff(ink, axis=1))[:height, :width - 1]
+    along_cols = np.abs(np.diff(ink, axis=0))[:height - 1, :width]
+    rows = np.pad(along_rows, ((0, 0), (0, 1))).reshape(height // STRIPE_BLOCK, STRIPE_BLOCK, -1, STRIPE_BLOCK)
+    cols = np.pad(along_cols, ((0, 1), (0, 0))).reshape(height // STRIPE_BLOCK, STRIPE_BLOCK, -1, STRIPE_BLOCK)
+    # Transiciones medias por línea del bloque en cada dirección
+    across_x = rows.sum(axis=(1, 3)) / STRIPE_BLOCK
+    across_y = cols.sum(axis=(1, 3)) / STRIPE_BLOCK
+    # Franjas: muchas transiciones en una dirección y casi ninguna en la otra
+    vertical_stripes = np.count_nonzero((across_x >= STRIPE_MIN_TRANSITIONS) & (across_y < 1))
+    horizontal_stripes = np.count_nonzero((across_y >= STRIPE_MIN_TRANSITIONS) & (across_x < 1))
+    return _balance(vertical_stripes, horizontal_stripes)
+
+def _largest_blob(region):
+    # Área de la mancha compacta más grande: un código de barras cerrado
+    # también es una mancha grande, pero alargada
+    if not region.size:
+        return 0
+    _, _, stats, _ = cv2.connectedComponentsWithStats(region, connectivity=8)
+    widths, heights = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT]
+    compact = (2 * widths <= 3 * heights) & (2 * heights <= 3 * widths)
+    areas = stats[1:, cv2.CC_STAT_AREA][compact]
+    return int(areas.max()) if areas.size else 0
+
+def logo_score(text):
+    """Positivo si la mancha más grande de las esquinas está arriba a la izquierda (logo OEP)"""
+    height, width = text.shape
+    corner_height, corner_width = int(height * LOGO_CORNER), int(width * LOGO_CORNER)
+    corners = [
+        text[:corner_height, :corner_width],
+        text[:corner_height, width - corner_width:],
+        text[height - corner_height:, :corner_width],
+        text[height - corner_height:, width - corner_width:],
+    ]
+    closed = [
+        cv2.morphologyEx(corner.astype(np.uint8), cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+        for corner in corners
+    ]
+    blobs = [_largest_blob(corner) for corner in closed]
+    return _balance(blobs[0], max(blobs[1:]))
+
+def ascender_score(text):
+    """Positivo si las líneas de texto tienen más tinta sobre la banda central
+    de las minúsculas (ascendentes) que debajo (descendentes), como en el texto
+    derecho. En mayúsculas y dígitos es cercano a cero.
+    """
+    profile = text.sum(axis=1).astype(np.float64)
+    if not profile.any():
+        return 0.0
+    in_line = profile > 0.1 * profile.max()
+    above = below = 0.0
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], in_line.astype(np.int8), [0]))))
+    for start, end in zip(edges[::2], edges[1::2]):
+        line = profile[start:end]
+        if line.size < 4:
+            continue
+        band = np.flatnonzero(line >= 0.5 * line.max())
+        above += line[:band[0]].sum()
+        below += line[band[-1] + 1:].sum()
+    return _balance(above, below)
+
+def upright_scores(ink, text):
+    """Indicios de que la miniatura está derecha, cada uno entre -1 y 1"""
+    return {
+        'textLines': text_line_score(text),
+        'barcode': barcode_stripe_score(ink),
+        'logo': logo_score(text),
+        'ascenders': ascender_score(text),
+    }
+
+def detect_orientation(gray):
+    """Decide qué rotación (0, 90, 180 o 270 grados en sentido horario)
+    endereza la página, sobre una miniatura.
+
+    Devuelve {'rotation', 'confidence', 'scores'}: `confidence` es la ventaja
+    de la mejor rotación sobre la siguiente. Si la mejor no supera a 0° por
+    ORIENTATION_MIN_MARGIN la rotación es 0.
+    """
+    if min(gray.shape[:2]) < 64:
+        # Demasiado pequeña para decidir: se deja como llegó
+        return {'rotation': 0, 'confidence': 0.0, 'scores': {}}
+    ink, text = make_ink_mask(gray)
+    scores = {}
+    for rotation in ROTATIONS:
+        features = upright_scores(rotate_page(ink, rotation), rotate_page(text, rotation))
+        scores[rotation] = sum(ORIENTATION_WEIGHTS[name] * value for name, value in features.items())
+
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    best = ranked[0]
+    if best != 0 and scores[best] - scores[0] < ORIENTATION_MIN_MARGIN:
+        best = 0
+    return {
+        'rotation': best,
+        'confidence': round(float(scores[ranked[0]] - scores[ranked[1]]), 4),
+        'scores': {str(rotation): round(float(score), 4) for rotation, score in scores.items()},
+    }
+
+def orient_page(gray, orientation=None):
+    """Endereza una página en gris. Si se pasa `orientation` (diccionario), se
+    registra en él el resultado de detect_orientation.
+    """
+    if not ORIENTATION_DETECTION:
+        return gray
+    detected = detect_orientation(gray)
+    if orientation is not None:
+        orientation.update(detected)
+    return rotate_page(gray, detected['rotation'])
@@ -1,11 +1,83 @@
 # image_processor/processing.py
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 import hashlib
 from algorithms.template_matching import locate_table_structure, locate_oep_logo, locate_barcodes
+from algorithms.orientation import orient_page
 
-def preprocess_image(image):
+# Lado máximo de la imagen que se envía a Anthropic
+ANTHROPIC_MAX_DIMENSION = 2000
+
+# Hilos para preprocesar una página por franjas horizontales (OpenCV libera el
+# GIL). Ajustar a los núcleos asignados a cada worker; 1 procesa la imagen entera
+PREPROCESS_THREADS = int(os.environ.get('PREPROCESS_THREADS', '1'))
+
+# Alto mínimo de cada franja: por debajo el solapamiento pesa más que el reparto
+PREPROCESS_MIN_STRIP_ROWS = int(os.environ.get('PREPROCESS_MIN_STRIP_ROWS', '256'))
+
+# Parámetros del filtrado y filas de contexto que cada franja necesita de sus
+# vecinas para que el resultado sea idéntico al de la imagen completa
+NLMEANS_STRENGTH = 10
+NLMEANS_TEMPLATE_WINDOW = 7
+NLMEANS_SEARCH_WINDOW = 21
+NLMEANS_OVERLAP = NLMEANS_SEARCH_WINDOW // 2 + NLMEANS_TEMPLATE_WINDOW // 2
+THRESHOLD_BLOCK_SIZE = 11
+THRESHOLD_OVERLAP = THRESHOLD_BLOCK_SIZE // 2
+
+_strip_executor = None
+_strip_executor_lock = threading.Lock()
+
+def get_strip_executor():
+    """Pool de hilos compartido para el preprocesamiento por franjas"""
+    global _strip_executor
+    with _strip_executor_lock:
+        if _strip_executor is None:
+            _strip_executor = ThreadPoolExecutor(max_workers=PREPROCESS_THREADS, thread_name_prefix='strip')
+        return _strip_executor
+
+def strip_bounds(height, strips, overlap):
+    """Franjas como (inicio, fin, inicio con contexto, fin con contexto)"""
+    step = -(-height // strips)
+    for start in range(0, height, step):
+        end = min(height, start + step)
+        yield start, end, max(0, start - overlap), min(height, end + overlap)
+
+def apply_in_strips(operation, src, dst, overlap, threads=None):
+    """Aplica `operation(imagen, destino)` por franjas en paralelo.
+
+    Cada franja se procesa con `overlap` filas de contexto por arriba y por
+    abajo y solo se copia su parte central a `dst`, así que no hay costuras
+    mientras el solapamiento cubra el alcance del filtro.
+    """
+    threads = PREPROCESS_THREADS if threads is None else threads
+    strips = min(threads, max(1, src.shape[0] // PREPROCESS_MIN_STRIP_ROWS))
+    if strips <= 1:
+        return operation(src, dst)
+    if dst is None:
+        dst = np.empty_like(src)
+    
+    def run(bounds):
+        start, end, top, bottom = bounds
+        dst[start:end] = operation(src[top:bottom], None)[start - top:end - top]
+    
+    # list() propaga las excepciones de los hilos
+    list(get_strip_executor().map(run, strip_bounds(src.shape[0], strips, overlap)))
+    return dst
+
+def preprocess_image(image, pool=None):
     """Preprocesamiento de imagen para mejorar la calidad para OCR"""
+    return enhance_region(normalize_page(image), pool)
+
+def normalize_page(image, orientation=None):
+    """Convierte a gris, ajusta el tamaño, corrige la perspectiva de la página
+    y la endereza si llegó de lado o invertida.
+
+    Si se pasa `orientation` (diccionario), se registra en él la rotación
+    detectada (ver orientation.detect_orientation).
+    """
     # 1. Convertir a escala de grises si es necesario
     if len(image.shape) == 3:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -27,26 +99,50 @@ def preprocess_image(image):
         new_height = int(height * scale)
         gray = cv2.resize(gray, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
     
-    # 3. Corrección de perspectiva si es necesario
+    # 3. Rotación de 0/90/180/270 grados. Se decide sobre la foto completa: el
+    # recorte de la perspectiva puede dejar fuera el logo y el marco, que son
+    # los indicios que distinguen arriba de abajo
+    gray = orient_page(gray, orientation)
+    
+    # 4. Corrección de perspectiva si es necesario
     gray = correct_perspective(gray)
     
-    # 4. reducir ruido antes de mejorar contraste
-    denoised = cv2.fastNlMeansDenoising(gray, None, 10, 7, 21)
+    return gray
+
+def enhance_region(gray, pool=None):
+    """Reduce ruido, mejora contraste y binariza una página o una región en gris
+
+    Con un `pool` (modo de memoria acotada) los resultados intermedios se
+    escriben en buffers reutilizados entre actas en lugar de reservar nuevos.
+    """
+    buffer = (lambda tag: pool.get(tag, gray.shape)) if pool is not None else (lambda tag: None)
+    
+    # 1. Reducir ruido antes de mejorar contraste (por franjas con PREPROCESS_THREADS > 1)
+    denoised = apply_in_strips(
+        lambda strip, out: cv2.fastNlMeansDenoising(strip, out, NLMEANS_STRENGTH,
+                                                    NLMEANS_TEMPLATE_WINDOW, NLMEANS_SEARCH_WINDOW),
+        gray, buffer('denoised'), NLMEANS_OVERLAP
+    )
     
-    # 5. Mejorar contraste con ecualización adaptativa de histograma
+    # 2. Mejorar contraste con ecualización adaptativa de histograma. Se aplica
+    # a la imagen completa: la rejilla de 8x8 depende del tamaño de la imagen
+    # y por franjas cambiaría el resultado (su coste es mínimo frente al filtrado)
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    enhanced = clahe.apply(denoised)
+    enhanced = clahe.apply(denoised, buffer('enhanced'))
     
-    # 6. Ampliar umbralizacion adaptativa para mejorar texto
-    binary = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                  cv2.THRESH_BINARY, 11, 2)
-    
-    #7. Operaciones morfologicas para limpiar ruido menor
+    # 3. Ampliar umbralizacion adaptativa para mejorar texto
+    # 4. Operaciones morfologicas para limpiar ruido menor
+    # 5. Cambiar imagen original con binarizada para mejore resultado
     kernel = np.ones((1, 1), np.uint8)
-    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
     
-    # 8. Cambiar imagen original con binarizada para mejore resultado
-    result = cv2.bitwise_not(binary)
+    def binarize(strip, out):
+        binary = cv2.adaptiveThreshold(strip, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                      cv2.THRESH_BINARY, THRESHOLD_BLOCK_SIZE, 2, out)
+        binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, binary)
+        return cv2.bitwise_not(binary, binary)
+    
+    # El resultado se devuelve al llamador: no usa un buffer reutilizable
+    result = apply_in_strips(binarize, enhanced, None, THRESHOLD_OVERLAP)
     
     return result
 
@@ -59,7 +155,7 @@ def preprocess_image_for_anthropic(image):
         height, width = image.shape
     
     # Solo redimensionar si es necesario, manteniendo aspecto y calidad
-    max_dimension = 2000  # Anthropic puede manejar imágenes grandes
+    max_dimension = ANTHROPIC_MAX_DIMENSION  # Anthropic puede manejar imágenes grandes
     if height > max_dimension or width > max_dimension:
         scale = min(max_dimension/width, max_dimension/height)
         new_width = int(width * scale)
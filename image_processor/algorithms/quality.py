@@ -0,0 +1,128 @@
+# image_processor/algorithms/quality.py
+import os
+import cv2
+import numpy as np
+
+# Control de calidad previo a la validación: 'false' lo desactiva
+QUALITY_GATE_ENABLED = os.environ.get('QUALITY_GATE_ENABLED', 'true').lower() == 'true'
+
+# Lado largo de la miniatura sobre la que se miden todas las métricas
+QUALITY_THUMBNAIL_SIDE = int(os.environ.get('QUALITY_THUMBNAIL_SIDE', '512'))
+
+# Nitidez mínima: varianza del Laplaciano sobre la miniatura
+QUALITY_MIN_SHARPNESS = float(os.environ.get('QUALITY_MIN_SHARPNESS', '60'))
+
+# Exposición: brillo medio del papel admitido y fracción máxima de píxeles
+# recortados en negro
+QUALITY_MIN_BRIGHTNESS = float(os.environ.get('QUALITY_MIN_BRIGHTNESS', '70'))
+QUALITY_MAX_BRIGHTNESS = float(os.environ.get('QUALITY_MAX_BRIGHTNESS', '252'))
+QUALITY_MAX_DARK_CLIPPED = float(os.environ.get('QUALITY_MAX_DARK_CLIPPED', '0.35'))
+
+# Reflejos: fracción máxima de píxeles saturados claramente por encima del papel
+QUALITY_MAX_GLARE = float(os.environ.get('QUALITY_MAX_GLARE', '0.03'))
+
+# Fracción mínima del encuadre ocupada por el documento
+QUALITY_MIN_COVERAGE = float(os.environ.get('QUALITY_MIN_COVERAGE', '0.45'))
+
+# Un píxel saturado es reflejo si supera al papel por este margen
+GLARE_LEVEL = 250
+GLARE_MARGIN = 20
+
+# Configuración que cambia el resultado (parte de la clave de la caché de etapas)
+QUALITY_SETTINGS = ','.join(str(value) for value in (
+    QUALITY_THUMBNAIL_SIDE, QUALITY_MIN_SHARPNESS, QUALITY_MIN_BRIGHTNESS, QUALITY_MAX_BRIGHTNESS,
+    QUALITY_MAX_DARK_CLIPPED, QUALITY_MAX_GLARE, QUALITY_MIN_COVERAGE
+))
+
+QUALITY_MESSAGES = {
+    'blurry': "La foto está desenfocada o movida; vuelva a tomarla con el acta quieta y enfocada",
+    'too_dark': "La foto está muy oscura; tómela con más luz",
+    'overexposed': "La foto está sobreexpuesta; evite la luz directa o el flash",
+    'glare': "Hay reflejos sobre el acta; cambie el ángulo o evite el flash",
+    'document_too_small': "El acta ocupa poco de la foto o está recortada; encuádrela completa y más cerca",
+}
+
+def make_thumbnail(gray, max_side=QUALITY_THUMBNAIL_SIDE):
+    """Reduce la imagen para que su lado largo no exceda `max_side`"""
+    height, width = gray.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return gray
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+def measure_sharpness(thumbnail):
+    """Varianza del Laplaciano: baja cuando no hay bordes nítidos"""
+    return float(cv2.Laplacian(thumbnail, cv2.CV_64F).var())
+
+def find_document_mask(thumbnail):
+    """Máscara de la región clara más grande (el papel), o None si no hay"""
+    blurred = cv2.GaussianBlur(thumbnail, (5, 5), 0)
+    # El umbral papel/fondo se calcula sin los píxeles saturados, que se
+    # consideran papel: así un reflejo no se separa del resto del acta
+    saturated = blurred >= GLARE_LEVEL
+    unsaturated = blurred[~saturated]
+    if unsaturated.size:
+        threshold, _ = cv2.threshold(unsaturated.reshape(-1, 1), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    else:
+        threshold = 0
+    mask = ((blurred > threshold) | saturated).astype(np.uint8) * 255
+    # Cerrar el texto y las líneas de la tabla para que el papel sea una sola región
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    hull = cv2.convexHull(max(contours, key=cv2.contourArea))
+    document = np.zeros_like(thumbnail)
+    cv2.fillConvexPoly(document, hull, 255)
+    return document
+
+def assess_image_quality(gray):
+    """Mide nitidez, exposición, reflejos y encuadre sobre una miniatura.
+
+    Devuelve un diccionario con las métricas, `passed` y la lista de
+    problemas encontrados como {'code', 'message'}.
+    """
+    thumbnail = make_thumbnail(gray)
+    document_mask = find_document_mask(thumbnail)
+    if document_mask is None:
+        document_pixels, coverage = thumbnail.ravel(), 0.0
+    else:
+        document_pixels = thumbnail[document_mask > 0]
+        coverage = document_pixels.size / thumbnail.size
+
+    # Exposición y reflejos se miden sobre el papel, no sobre el fondo
+    paper_level = float(np.percentile(document_pixels, 50))
+    glare_threshold = max(GLARE_LEVEL, paper_level + GLARE_MARGIN)
+
+    metrics = {
+        'sharpness': measure_sharpness(thumbnail),
+        'brightness': paper_level,
+        'darkClipped': float(np.mean(document_pixels <= 5)),
+        'glare': float(np.mean(document_pixels >= glare_threshold)) if glare_threshold <= 255 else 0.0,
+        'coverage': float(coverage),
+    }
+
+    issues = []
+    if metrics['sharpness'] < QUALITY_MIN_SHARPNESS:
+        issues.append('blurry')
+    if metrics['brightness'] < QUALITY_MIN_BRIGHTNESS or metrics['darkClipped'] > QUALITY_MAX_DARK_CLIPPED:
+        issues.append('too_dark')
+    elif metrics['brightness'] > QUALITY_MAX_BRIGHTNESS and metrics['sharpness'] < 2 * QUALITY_MIN_SHARPNESS:
+        # Papel blanco puro solo es problema si además se perdió el contraste
+        issues.append('overexposed')
+    if metrics['glare'] > QUALITY_MAX_GLARE:
+        issues.append('glare')
+    if metrics['coverage'] < QUALITY_MIN_COVERAGE:
+        issues.append('document_too_small')
+
+    return {
+        'passed': not issues,
+        'issues': [{'code': code, 'message': QUALITY_MESSAGES[code]} for code in issues],
+        'metrics': {name: round(value, 4) for name, value in metrics.items()},
+    }
+
+def quality_reason(quality):
+    """Motivo de rechazo legible a partir del resultado de assess_image_quality"""
+    return "; ".join(issue['message'] for issue in quality['issues'])
@@ -0,0 +1,198 @@
+# image_processor/algorithms/resilience.py
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+
+from metrics import percentile, registry as metrics_registry
+
+logger = logging.getLogger('Resilience')
+
+# Tiempo máximo de cada intento y del conjunto de intentos de una llamada
+ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get('ANTHROPIC_ATTEMPT_TIMEOUT', '30'))
+CALL_DEADLINE_SECONDS = float(os.environ.get('ANTHROPIC_DEADLINE_SECONDS', '75'))
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get('ANTHROPIC_CONNECT_TIMEOUT', '5'))
+MAX_ATTEMPTS = int(os.environ.get('ANTHROPIC_MAX_ATTEMPTS', '2'))
+
+# El circuito se abre tras N fallos transitorios consecutivos y vuelve a
+# probar (semiabierto) pasados BREAKER_RESET_SECONDS
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('ANTHROPIC_BREAKER_FAILURES', '5'))
+BREAKER_RESET_SECONDS = float(os.environ.get('ANTHROPIC_BREAKER_RESET_SECONDS', '60'))
+
+# Solicitudes de cobertura (hedging): si un intento supera este percentil de
+# latencia reciente se lanza una segunda solicitud y se usa la primera que
+# responda. 0 lo desactiva
+HEDGE_PERCENTILE = float(os.environ.get('ANTHROPIC_HEDGE_PERCENTILE', '0'))
+HEDGE_MIN_SAMPLES = int(os.environ.get('ANTHROPIC_HEDGE_MIN_SAMPLES', '20'))
+
+# Códigos HTTP que indican un problema pasajero del servicio
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504, 529}
+
+class CircuitOpenError(RuntimeError):
+    """El circuito está abierto y no se permiten llamadas al servicio"""
+
+class UpstreamUnavailableError(RuntimeError):
+    """El servicio no respondió correctamente en ninguno de los intentos"""
+
+def is_transient(error):
+    """Indica si un error de la llamada justifica reintentar más tarde"""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in TRANSIENT_STATUS_CODES
+    return False
+
+class CircuitBreaker:
+    """Circuito cerrado / abierto / semiabierto con una única prueba en semiabierto"""
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    # Valor numérico del estado para la métrica circuit_breaker_state
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        metrics_registry.set_gauge('circuit_breaker_state', 0, breaker=name)
+
+    def allow(self):
+        """Indica si se puede llamar al servicio (en semiabierto, solo una prueba a la vez)"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+                return True
+            return self.state == self.CLOSED
+
+    def is_open(self):
+        """Indica si el circuito rechazará llamadas sin consumir la prueba de semiabierto"""
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probe_in_flight = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self._transition(self.OPEN)
+
+    def _transition(self, state):
+        logger.warning(f"Circuito '{self.name}': {self.state} -> {state}")
+        self.state = state
+        metrics_registry.set_gauge('circuit_breaker_state', self.STATE_VALUES[state], breaker=self.name)
+        metrics_registry.inc('circuit_breaker_transitions_total', breaker=self.name, to=state)
+
+class ResilientCaller:
+    """Ejecuta llamadas a un servicio con plazos por intento, reintentos,
+    circuito y solicitudes de cobertura opcionales.
+
+    `request(timeout)` debe realizar un intento respetando `timeout` y lanzar
+    una excepción si falla. Solo los errores transitorios (ver is_transient)
+    se reintentan y cuentan para el circuito.
+    """
+
+    def __init__(self, name, breaker=None, attempt_timeout=ATTEMPT_TIMEOUT_SECONDS,
+                 deadline=CALL_DEADLINE_SECONDS, max_attempts=MAX_ATTEMPTS,
+                 hedge_percentile=HEDGE_PERCENTILE, hedge_min_samples=HEDGE_MIN_SAMPLES):
+        self.name = name
+        self.breaker = breaker or CircuitBreaker(name)
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=256)
+        # Los consumidores de varios hilos comparten el llamador
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def call(self, request):
+        deadline = time.monotonic() + self.deadline
+        last_error = None
+        for attempt in range(1, self.max_attempts + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"Circuito '{self.name}' abierto")
+
+            started = time.monotonic()
+            try:
+                result = self._attempt(request, min(self.attempt_timeout, remaining))
+            except Exception as e:
+                if not is_transient(e):
+                    # El servicio respondió: el error es de la solicitud, no de disponibilidad
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                metrics_registry.inc('upstream_failures_total', upstream=self.name, error=type(e).__name__)
+                logger.warning(f"Intento {attempt}/{self.max_attempts} a '{self.name}' falló: {e}")
+                last_error = e
+                continue
+
+            self.breaker.record_success()
+            latency = time.monotonic() - started
+            self.latencies.append(latency)
+            metrics_registry.observe('upstream_latency_seconds', latency, upstream=self.name)
+            return result
+
+        raise UpstreamUnavailableError(f"'{self.name}' no disponible: {last_error or 'plazo agotado'}")
+
+    def hedge_delay(self):
+        """Espera antes de lanzar una solicitud de cobertura, o None si no corresponde"""
+        if not self.hedge_percentile or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return percentile(sorted(self.latencies), self.hedge_percentile)
+
+    def _attempt(self, request, timeout):
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is None or hedge_delay >= timeout:
+            return request(timeout)
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix=f"{self.name}-hedge")
+
+        # 1. Solicitud principal; si responde antes del percentil no hay cobertura
+        primary = self._executor.submit(request, timeout)
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        # 2. Solicitud de cobertura: gana la primera respuesta correcta. La
+        # otra sigue en segundo plano hasta su propio timeout
+        metrics_registry.inc('hedged_requests_total', upstream=self.name)
+        hedge = self._executor.submit(request, timeout - hedge_delay)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics_registry.inc('hedge_wins_total', upstream=self.name)
+                    return future.result()
+                error = future.exception()
+        raise error
@@ -0,0 +1,165 @@
+# image_processor/algorithms/results.py
+import json
+import re
+
+# Por debajo de esta confianza el resultado se marca para verificación humana
+HUMAN_VERIFICATION_THRESHOLD = 0.7
+
+class Location:
+    """Ubicación de la mesa de sufragio"""
+    __slots__ = ('department', 'province', 'municipality', 'locality', 'polling_place')
+
+    def __init__(self, department='', province='', municipality='', locality='', polling_place=''):
+        self.department = str(department or '')
+        self.province = str(province or '')
+        self.municipality = str(municipality or '')
+        self.locality = str(locality or '')
+        self.polling_place = str(polling_place or '')
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            data.get('department'),
+            data.get('province'),
+            data.get('municipality'),
+            data.get('locality'),
+            data.get('pollingPlace')
+        )
+
+    def to_dict(self):
+        return {
+            'department': self.department,
+            'province': self.province,
+            'municipality': self.municipality,
+            'locality': self.locality,
+            'pollingPlace': self.polling_place
+        }
+
+def parse_vote_count(value):
+    """Votos de una casilla como entero (0 si está vacía), o None si no es un número.
+
+    Además de los enteros del OCR tolera lo que puede devolver Anthropic:
+    espacios, separadores de miles ('1.200', '1,200') y números en coma flotante.
+    """
+    if value is None or value == '':
+        return 0
+    if isinstance(value, str):
+        digits = re.sub(r'[\s.,]', '', value)
+        if not digits:
+            return 0
+        return int(digits) if digits.isascii() and digits.isdigit() else None
+    try:
+        # int() convierte también los escalares de NumPy
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+class PartyVote:
+    """Votos de un partido, con la confianza de la lectura si se conoce"""
+    __slots__ = ('party_id', 'votes', 'confidence')
+
+    def __init__(self, party_id, votes, confidence=None):
+        self.party_id = str(party_id)
+        count = parse_vote_count(votes)
+        self.votes = count or 0
+        self.confidence = None if confidence is None else float(confidence)
+        if count is None:
+            # Valor ilegible ('N/A', ...): 0 votos, marcados como lectura no confiable
+            self.confidence = 0.0
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['partyId'], data.get('votes'), data.get('confidence'))
+
+    def to_dict(self):
+        data = {'partyId': self.party_id, 'votes': self.votes}
+        if self.confidence is not None:
+            data['confidence'] = self.confidence
+        return data
+
+class BallotResults:
+    """Datos extraídos de una acta: mesa, ubicación y votos"""
+    __slots__ = ('table_code', 'table_number', 'location', 'party_votes',
+                 'valid_votes', 'blank_votes', 'null_votes')
+
+    def __init__(self, table_code, table_number, location, party_votes,
+                 valid_votes=0, blank_votes=0, null_votes=0):
+        self.table_code = str(table_code or '')
+        self.table_number = str(table_number or '')
+        self.location = location
+        self.party_votes = party_votes
+        self.valid_votes = parse_vote_count(valid_votes) or 0
+        self.blank_votes = parse_vote_count(blank_votes) or 0
+        self.null_votes = parse_vote_count(null_votes) or 0
+
+    @classmethod
+    def from_dict(cls, results):
+        """Desde el diccionario de resultados (OCR o Anthropic). El número de
+        mesa y los votos son obligatorios: sin ellos la extracción no sirve.
+        """
+        votes = results['votes']
+        return cls(
+            results.get('tableCode'),
+            results['tableNumber'],
+            Location.from_dict(results.get('location')),
+            [PartyVote.from_dict(party_vote) for party_vote in votes.get('partyVotes', [])],
+            votes.get('validVotes'),
+            votes.get('blankVotes'),
+            votes.get('nullVotes')
+        )
+
+    def to_dict(self):
+        return {
+            'tableCode': self.table_code,
+            'tableNumber': self.table_number,
+            'votes': {
+                'partyVotes': [party_vote.to_dict() for party_vote in self.party_votes],
+                'validVotes': self.valid_votes,
+                'blankVotes': self.blank_votes,
+                'nullVotes': self.null_votes
+            },
+            'location': self.location.to_dict()
+        }
+
+class BallotResult:
+    """Resultado final de una acta tal como se publica en 'results'"""
+    __slots__ = ('ballot_id', 'results', 'confidence', 'source', 'needs_human_verification', 'extra')
+
+    def __init__(self, ballot_id, results, confidence, source, needs_human_verification=None, extra=None):
+        self.ballot_id = ballot_id
+        self.results = results
+        self.confidence = float(confidence)
+        self.source = source
+        if needs_human_verification is None:
+            needs_human_verification = self.confidence < HUMAN_VERIFICATION_THRESHOLD
+        self.needs_human_verification = bool(needs_human_verification)
+        # Campos adicionales del mensaje (hash perceptual, casi-duplicados, ...)
+        self.extra = extra or {}
+
+    @classmethod
+    def from_extraction(cls, ballot_id, extraction, default_source, extra=None):
+        """Desde el resultado de una extracción ({'results', 'confidence', ...})"""
+        return cls(
+            ballot_id,
+            BallotResults.from_dict(extraction['results']),
+            extraction['confidence'],
+            extraction.get('source', default_source),
+            extraction.get('needsHumanVerification'),
+            extra
+        )
+
+    def to_dict(self):
+        return {
+            'ballotId': self.ballot_id,
+            'status': 'COMPLETED',
+            'results': self.results.to_dict(),
+            'confidence': self.confidence,
+            'source': self.source,
+            'needsHumanVerification': self.needs_human_verification,
+            **self.extra
+        }
+
+    def to_json(self):
+        """Formato de la cola 'results'"""
+        return json.dumps(self.to_dict())
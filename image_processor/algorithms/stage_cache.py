@@ -0,0 +1,177 @@
+# image_processor/algorithms/stage_cache.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import numpy as np
+
+from metrics import registry as metrics_registry
+
+logger = logging.getLogger('StageCache')
+
+# Directorio de artefactos por etapa ('' desactiva la caché). Puede compartirse
+# entre workers y ejecuciones de bulk.py en la misma máquina
+STAGE_CACHE_DIR = os.environ.get('STAGE_CACHE_DIR', '')
+
+# Tamaño máximo en disco; al superarlo se borran los artefactos menos usados
+STAGE_CACHE_MAX_MB = int(os.environ.get('STAGE_CACHE_MAX_MB', '2048'))
+
+# Versión del algoritmo de cada etapa. Incrementarla al cambiar su código:
+# la clave de cada artefacto encadena la de la etapa anterior, así que solo se
+# invalidan esa etapa y las posteriores.
+#   decode      decoding.decode_image
+#   page        processing.normalize_page (tamaño, perspectiva y orientación)
+#   orientation rotación detectada por processing.normalize_page
+#   binary      processing.enhance_region (filtrado y binarización)
+#   quality     quality.assess_image_quality
+#   validation  processing.check_if_ballot
+#   ocr         data_extraction.extract_data_from_ballot
+STAGE_VERSIONS = {
+    'decode': 1,
+    'page': 3,
+    'orientation': 2,
+    'binary': 1,
+    'quality': 1,
+    'validation': 1,
+    'ocr': 1,
+}
+
+def stage_key(parent_key, stage, params=''):
+    """Clave del artefacto de `stage` calculado a partir del de `parent_key`.
+
+    La primera etapa parte del hash del archivo de entrada. `params` recoge
+    la configuración que cambia el resultado de la etapa.
+    """
+    material = f"{parent_key}|{stage}:{STAGE_VERSIONS[stage]}|{params}"
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def _json_default(value):
+    """Escalares de NumPy en los resultados guardados como JSON"""
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+class StageCache:
+    """Artefactos por etapa en disco: imágenes como .npy y resultados como JSON.
+
+    Las escrituras son atómicas (archivo temporal + rename), así que un
+    worker que se cae deja como mucho un temporal huérfano, nunca un
+    artefacto a medias. Cada lectura actualiza la fecha de modificación, que
+    se usa para desalojar primero los menos usados.
+    """
+
+    EXTENSIONS = {'array': '.npy', 'json': '.json'}
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key, kind):
+        # Subdirectorios por prefijo para no acumular miles de archivos en uno
+        return os.path.join(self.directory, key[:2], key + self.EXTENSIONS[kind])
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key, kind):
+        path = self._path(key, kind)
+        try:
+            if kind == 'array':
+                value = np.load(path, allow_pickle=False)
+            else:
+                with open(path) as artifact:
+                    value = json.load(artifact)
+            os.utime(path)
+            return value
+        except (FileNotFoundError, ValueError, OSError):
+            # Ausente, o borrado por el desalojo de otro proceso
+            return None
+
+    def put(self, key, kind, value):
+        path = self._path(key, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if kind == 'array':
+            with open(temporary, 'wb') as artifact:
+                np.save(artifact, value, allow_pickle=False)
+        else:
+            with open(temporary, 'w') as artifact:
+                json.dump(value, artifact, default=_json_default)
+        os.replace(temporary, path)
+
+        with self._lock:
+            self._size += os.path.getsize(path)
+            over_budget = self._size > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def fetch(self, key, kind, compute, stage):
+        """Devuelve el artefacto guardado o lo calcula con `compute()` y lo guarda"""
+        value = self.get(key, kind)
+        if value is not None:
+            metrics_registry.inc('stage_cache_hits_total', stage=stage)
+            return value
+        metrics_registry.inc('stage_cache_misses_total', stage=stage)
+        value = compute()
+        if value is not None:
+            try:
+                self.put(key, kind, value)
+            except OSError as e:
+                # Sin espacio o sin permisos: se sigue sin caché
+                logger.warning(f"No se pudo guardar el artefacto de {stage}: {e}")
+        return value
+
+    def evict(self):
+        """Borra los artefactos menos usados hasta quedar en el 80% del límite.
+
+        El tamaño se recalcula desde el disco: otros procesos pueden haber
+        añadido o borrado artefactos en el mismo directorio.
+        """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            size = sum(entry_size for _, entry_size, _ in entries)
+            target = int(self.max_bytes * 0.8)
+            removed = 0
+            for path, entry_size, _ in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+                removed += 1
+            self._size = size
+        if removed:
+            metrics_registry.inc('stage_cache_evictions_total', removed)
+            logger.info(f"Caché de etapas: {removed} artefactos desalojados")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_stage_cache():
+    """Caché del proceso, o None si STAGE_CACHE_DIR no está configurado"""
+    global _cache
+    if not STAGE_CACHE_DIR:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = StageCache(STAGE_CACHE_DIR, STAGE_CACHE_MAX_MB * 1024 * 1024)
+        return _cache
+
+def cached_stage(cache, key, kind, compute, stage):
+    """Como StageCache.fetch, pero sin caché (cache=None) solo calcula"""
+    if cache is None:
+        return compute()
+    return cache.fetch(key, kind, compute, stage)
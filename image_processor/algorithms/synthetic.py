@@ -0,0 +1,40 @@
+# image_processor/algorithms/synthetic.py
+import cv2
+import numpy as np
+
+# Tamaño de la acta sintética (proporción de una hoja carta escaneada)
+SYNTHETIC_WIDTH = 1700
+SYNTHETIC_HEIGHT = 2200
+
+def make_synthetic_ballot(width=SYNTHETIC_WIDTH, height=SYNTHETIC_HEIGHT, seed=0):
+    """Genera una imagen en color con la estructura de una acta: marco, grilla,
+    textos y dígitos, con ruido de escaneo. Sirve para el calentamiento y las
+    pruebas de carga sin usar actas reales.
+    """
+    rng = np.random.default_rng(seed)
+    page = np.full((height, width), 235, np.uint8)
+
+    # 1. Marco y encabezado
+    cv2.rectangle(page, (80, 80), (width - 80, height - 80), 30, 4)
+    cv2.putText(page, 'ACTA ELECTORAL', (int(width * 0.3), 220), cv2.FONT_HERSHEY_SIMPLEX, 2, 20, 4)
+    cv2.putText(page, 'MESA 12345', (120, 340), cv2.FONT_HERSHEY_SIMPLEX, 1.4, 20, 3)
+
+    # 2. Grilla de votos con dígitos en cada fila
+    top, bottom = int(height * 0.25), int(height * 0.75)
+    left, right = int(width * 0.15), int(width * 0.85)
+    for y in range(top, bottom + 1, 80):
+        cv2.line(page, (left, y), (right, y), 40, 2)
+    for x in range(left, right + 1, (right - left) // 5):
+        cv2.line(page, (x, top), (x, bottom), 40, 2)
+    for row, y in enumerate(range(top + 55, bottom, 80)):
+        cv2.putText(page, str(int(rng.integers(0, 300))), (right - 220, y), cv2.FONT_HERSHEY_SIMPLEX, 1.3, 20, 3)
+
+    # 3. Ruido de escaneo
+    noise = rng.normal(0, 8, page.shape).astype(np.int16)
+    page = np.clip(page.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(page, cv2.COLOR_GRAY2BGR)
+
+def encode_synthetic_ballot(quality=90, **kwargs):
+    """Acta sintética codificada en JPEG, como la recibe la API"""
+    _, buffer = cv2.imencode('.jpg', make_synthetic_ballot(**kwargs), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
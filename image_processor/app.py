@@ -1,13 +1,17 @@
 # image_processor/app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import base64
-import numpy as np
 import cv2
-from algorithms.extractor import BallotExtractor
-from algorithms.processing import check_if_ballot
+from algorithms.processing import check_if_ballot, preprocess_image_for_anthropic, ANTHROPIC_MAX_DIMENSION
+from algorithms.decoding import decode_image, decode_for_validation
 from worker import start_worker_thread
+from metrics import registry as metrics_registry
+from lanes import lane_properties
+import profiling
+import warmup
 import logging
 import hashlib
+import time
 
 # Configurar logging
 logging.basicConfig(
@@ -17,12 +21,44 @@ logging.basicConfig(
 logger = logging.getLogger('BallotAPI')
 
 app = Flask(__name__)
-ballot_extractor = BallotExtractor()
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "ok"}), 200
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Listo para recibir tráfico solo después del calentamiento"""
+    status = 200 if warmup.readiness['ready'] else 503
+    return jsonify(warmup.readiness), status
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas del proceso (worker y API) en formato Prometheus o JSON"""
+    if request.args.get('format') == 'json':
+        return jsonify(metrics_registry.snapshot()), 200
+    return Response(metrics_registry.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    """Consulta o cambia el perfilado de mensajes del worker.
+
+    POST acepta {"everyN": 100, "intervalMs": 5, "tracemalloc": false};
+    everyN=0 lo desactiva. GET devuelve la configuración y los últimos perfiles.
+    """
+    if request.method == 'POST':
+        data = request.json or {}
+        try:
+            profiling.configure(data.get('everyN'), data.get('intervalMs'), data.get('tracemalloc'))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"Configuración inválida: {e}"}), 400
+        logger.info(f"Perfilado configurado: {profiling.settings}")
+    return jsonify({
+        "settings": profiling.settings,
+        "directory": profiling.PROFILE_DIR,
+        "recent": profiling.recent_profiles()
+    }), 200
+
 @app.route('/process', methods=['POST'])
 def process_image():
     """Endpoint para procesar imágenes directamente"""
@@ -33,6 +69,7 @@ def process_image():
     # solo para probar
     force_valid = request.json.get('forceValid', False)
         
+    started = time.monotonic()
     try:
         # Decodificar la imagen desde base64
         logger.info("Recibida solicitud de procesamiento de imagen")
@@ -44,30 +81,19 @@ def process_image():
             logger.error(f"Error decodificando imagen base64: {decode_error}")
             return jsonify({"error": f"Error decodificando imagen: {decode_error}"}), 400
         
-        # Verificar los módulos antes de extraer datos
-        try:
-            logger.info("Verificando si los módulos necesarios están disponibles")
-            # Importar los módulos principales para verificar que están disponibles
-            import algorithms
-            from algorithms.extractor import BallotExtractor
-            from algorithms.processing import preprocess_image_for_anthropic
-            from algorithms.template_matching import identify_acta_structure
-            logger.info("Módulos importados correctamente")
-        except ImportError as import_error:
-            logger.error(f"Error importando módulos: {import_error}")
-            return jsonify({"error": f"Error de importación de módulos: {import_error}"}), 500
-        
         # IMPORTANTE: Modificar esta parte para SOLO procesar imagen y validarla,
         # SIN intentar extracción directa con Anthropic
         logger.info("Iniciando procesamiento de imagen")
-        img_array = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+        # Decodificar a color solo hasta el tamaño que conserva el preprocesamiento
+        img = decode_image(image_data, min_long_side=ANTHROPIC_MAX_DIMENSION)
+        if img is None:
+            return jsonify({"error": "No se pudo decodificar la imagen"}), 400
         
         # Usar preprocesamiento mínimo para mantener calidad de imagen
         processed_img = preprocess_image_for_anthropic(img)
 
-        # Verificar si es un acta válida
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
+        # Verificar si es un acta válida (gris a escala reducida)
+        gray = decode_for_validation(image_data)
         is_valid, confidence, reason = check_if_ballot(gray)
 
         # Generar hash para identificación
@@ -99,6 +125,7 @@ def process_image():
             }
         }
 
+        warmup.record_first_request('process', time.monotonic() - started)
         logger.info("Envío de respuesta exitosa")
         return jsonify(response), 200
 
@@ -140,12 +167,12 @@ def manual_retry_dlq():
             
             method, properties, body = message
             
-            # Publicar a la cola destino
+            # Publicar a la cola destino en el carril de reenvíos
             channel.basic_publish(
                 exchange='',
                 routing_key=target_queue,
                 body=body,
-                properties=pika.BasicProperties(delivery_mode=2)
+                properties=lane_properties('replay')
             )
             
             # Confirmar procesamiento
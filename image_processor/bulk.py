@@ -0,0 +1,194 @@
+# image_processor/bulk.py
+"""Procesamiento masivo sin broker: extrae los datos de todas las actas de un
+directorio, tar o zip en paralelo y escribe un resultado JSONL por acta.
+
+    python bulk.py /data/actas.tar -o resultados.jsonl --jobs 16
+
+Se puede interrumpir y volver a lanzar con los mismos argumentos: las actas ya
+registradas en el checkpoint (por defecto <salida>.checkpoint) se omiten.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('BulkProcessor')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp')
+
+# Cada cuántas actas se informa el avance
+PROGRESS_EVERY = 100
+
+def is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+def iter_images(source):
+    """Recorre las imágenes de un directorio, tar o zip: (nombre, bytes), de una en una"""
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                if is_image_name(file_name):
+                    path = os.path.join(root, file_name)
+                    with open(path, 'rb') as image_file:
+                        yield os.path.relpath(path, source), image_file.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_image_name(info.filename):
+                    yield info.filename, archive.read(info)
+    elif tarfile.is_tarfile(source):
+        # Lectura en flujo: no requiere indexar el archivo completo
+        with tarfile.open(source, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and is_image_name(member.name):
+                    yield member.name, archive.extractfile(member).read()
+    else:
+        raise ValueError(f"Origen no soportado (directorio, tar o zip): {source}")
+
+def load_checkpoint(path):
+    """Nombres de las actas ya procesadas"""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as checkpoint:
+        return {line.rstrip('\n') for line in checkpoint if line.strip()}
+
+_extractor = None
+
+def init_process():
+    """Inicializa cada proceso del pool: un hilo por proceso y un extractor propio"""
+    global _extractor
+    # El paralelismo lo da el pool: evitar que OpenCV y Tesseract compitan por los núcleos
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    import cv2
+    cv2.setNumThreads(1)
+    from algorithms.extractor import BallotExtractor
+    _extractor = BallotExtractor()
+
+def process_ballot(name, data):
+    """Extrae una acta y devuelve su registro JSONL"""
+    started = time.monotonic()
+    timings = {}
+    result = _extractor.extract_data(data, timings=timings)
+    timings['total'] = time.monotonic() - started
+
+    record = {
+        'name': name,
+        'imageHash': hashlib.sha256(data).hexdigest(),
+        'success': result.get('success', False),
+        'timings': {stage: round(seconds, 4) for stage, seconds in timings.items()},
+    }
+    if record['success']:
+        record.update({
+            'results': result['results'],
+            'confidence': result['confidence'],
+            'fieldConfidences': result.get('fieldConfidences', {}),
+            'needsHumanVerification': result['needsHumanVerification'],
+            'validation': result['validation'],
+        })
+    else:
+        record['error'] = result.get('errorMessage', 'Error en extracción')
+        if 'qualityIssues' in result:
+            record['qualityIssues'] = [issue['code'] for issue in result['qualityIssues']]
+    return record
+
+def json_default(value):
+    """Tipos NumPy que puedan quedar en el resultado del extractor"""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+def run_bulk(source, output, checkpoint_path, jobs, max_in_flight, max_in_flight_bytes, limit=None):
+    """Procesa el origen con un pool de procesos y a lo sumo `max_in_flight`
+    actas (y `max_in_flight_bytes` de imagen) pendientes en memoria a la vez.
+    """
+    completed = load_checkpoint(checkpoint_path)
+    if completed:
+        logger.info(f"Reanudando: {len(completed)} actas ya procesadas")
+
+    processed = failed = skipped = 0
+    started = time.monotonic()
+    in_flight = {}
+    in_flight_bytes = 0
+
+    with open(output, 'a') as output_file, open(checkpoint_path, 'a') as checkpoint_file, \
+            ProcessPoolExecutor(max_workers=jobs, initializer=init_process) as pool:
+
+        def collect(done):
+            nonlocal processed, failed, in_flight_bytes
+            for future in done:
+                name, size = in_flight.pop(future)
+                in_flight_bytes -= size
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = {'name': name, 'success': False, 'error': str(e)}
+                # Primero el resultado y después el checkpoint: una interrupción
+                # entre ambos solo repite el acta al reanudar
+                output_file.write(json.dumps(record, default=json_default) + '\n')
+                output_file.flush()
+                checkpoint_file.write(name + '\n')
+                checkpoint_file.flush()
+                processed += 1
+                failed += not record['success']
+                if processed % PROGRESS_EVERY == 0:
+                    rate = processed / (time.monotonic() - started)
+                    logger.info(f"{processed} actas ({failed} fallidas), {rate:.1f} actas/s")
+
+        for name, data in iter_images(source):
+            if name in completed:
+                skipped += 1
+                continue
+            if limit is not None and processed + len(in_flight) >= limit:
+                break
+            # Esperar a que termine alguna acta si se alcanzó el límite en memoria
+            while in_flight and (len(in_flight) >= max_in_flight or in_flight_bytes + len(data) > max_in_flight_bytes):
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = pool.submit(process_ballot, name, data)
+            in_flight[future] = (name, len(data))
+            in_flight_bytes += len(data)
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Terminado: {processed} actas en {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.1f} actas/s), "
+        f"{failed} fallidas, {skipped} omitidas por checkpoint"
+    )
+    return {'processed': processed, 'failed': failed, 'skipped': skipped, 'seconds': elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description='Procesamiento masivo de actas sin broker')
+    parser.add_argument('source', help='Directorio, tar o zip con las imágenes')
+    parser.add_argument('-o', '--output', required=True, help='Archivo JSONL de resultados (se añade al final)')
+    parser.add_argument('--checkpoint', help='Archivo de checkpoint (por defecto <salida>.checkpoint)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Procesos en paralelo')
+    parser.add_argument('--max-in-flight', type=int, help='Actas pendientes en memoria (por defecto 2 por proceso)')
+    parser.add_argument('--max-in-flight-mb', type=int, default=512, help='MB de imágenes pendientes en memoria')
+    parser.add_argument('--limit', type=int, help='Procesar como máximo N actas nuevas')
+    args = parser.parse_args()
+
+    run_bulk(
+        args.source,
+        args.output,
+        args.checkpoint or f"{args.output}.checkpoint",
+        jobs=args.jobs,
+        max_in_flight=args.max_in_flight or 2 * args.jobs,
+        max_in_flight_bytes=args.max_in_flight_mb * 1024 * 1024,
+        limit=args.limit
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# image_processor/lanes.py
+import os
+import time
+from collections import deque
+import pika
+
+# Carriles de trabajo: prioridad AMQP con la que se publican y peso en el
+# reparto del worker. Las subidas en vivo van primero; los reintentos,
+# reenvíos desde DLQ y reprocesamientos masivos se reparten el resto
+LANES = {
+    'live': {'priority': 9, 'weight': 8},
+    'retry': {'priority': 6, 'weight': 4},
+    'replay': {'priority': 3, 'weight': 2},
+    'bulk': {'priority': 1, 'weight': 1},
+}
+DEFAULT_LANE = 'live'
+
+# Pesos configurables, p. ej. LANE_WEIGHTS="live:8,retry:4,replay:2,bulk:1"
+for _entry in os.environ.get('LANE_WEIGHTS', '').split(','):
+    if ':' in _entry:
+        _lane, _weight = _entry.split(':', 1)
+        if _lane.strip() in LANES:
+            LANES[_lane.strip()]['weight'] = max(1, int(_weight))
+
+# Prioridad máxima de las colas de procesamiento (0 declara colas sin prioridad)
+QUEUE_MAX_PRIORITY = int(os.environ.get('QUEUE_MAX_PRIORITY', '10'))
+
+LANE_HEADER = 'x-lane'
+ENQUEUED_AT_HEADER = 'x-enqueued-at'
+
+def message_lane(properties):
+    """Carril de un mensaje: cabecera x-lane, o la prioridad si no la tiene"""
+    headers = (properties.headers if properties else None) or {}
+    lane = headers.get(LANE_HEADER)
+    if lane in LANES:
+        return lane
+    priority = properties.priority if properties else None
+    if priority is not None:
+        for name, lane_info in LANES.items():
+            if priority >= lane_info['priority']:
+                return name
+        return 'bulk'
+    # Los mensajes sin carril son subidas del backend
+    return DEFAULT_LANE
+
+def lane_properties(lane, headers=None, **kwargs):
+    """Propiedades de publicación de un mensaje en `lane` (persistente, con prioridad)"""
+    headers = dict(headers or {})
+    headers[LANE_HEADER] = lane
+    headers[ENQUEUED_AT_HEADER] = int(time.time() * 1000)
+    return pika.BasicProperties(
+        delivery_mode=2,
+        priority=LANES[lane]['priority'],
+        headers=headers,
+        **kwargs
+    )
+
+def queue_wait_seconds(properties):
+    """Tiempo que el mensaje pasó en la cola desde su publicación, si se conoce"""
+    headers = (properties.headers if properties else None) or {}
+    enqueued_at = headers.get(ENQUEUED_AT_HEADER)
+    if enqueued_at is None:
+        return None
+    return max(0.0, time.time() - int(enqueued_at) / 1000.0)
+
+class LaneScheduler:
+    """Reparto ponderado (deficit round robin) de los mensajes recibidos por carril.
+
+    Los mensajes se guardan localmente en el orden de llegada de cada carril;
+    en cada turno un carril puede atender tantos mensajes como su peso, de
+    modo que el trabajo masivo avanza sin retrasar a las subidas en vivo.
+    """
+
+    def __init__(self, lanes=LANES):
+        self.lanes = list(lanes)
+        self.weights = {lane: lanes[lane]['weight'] for lane in self.lanes}
+        self.queues = {lane: deque() for lane in self.lanes}
+        self.deficit = {lane: 0 for lane in self.lanes}
+        self._index = len(self.lanes) - 1
+
+    def push(self, lane, item):
+        self.queues[lane].append((time.monotonic(), item))
+
+    def pending(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def pop(self):
+        """Devuelve (carril, instante de llegada, elemento) o None si no hay pendientes"""
+        if not self.pending():
+            return None
+        while True:
+            lane = self.lanes[self._index]
+            queue = self.queues[lane]
+            if queue and self.deficit[lane] >= 1:
+                self.deficit[lane] -= 1
+                return (lane,) + queue.popleft()
+            # Fin del turno: un carril vacío no acumula crédito
+            if not queue:
+                self.deficit[lane] = 0
+            self._index = (self._index + 1) % len(self.lanes)
+            next_lane = self.lanes[self._index]
+            if self.queues[next_lane]:
+                self.deficit[next_lane] += self.weights[next_lane]
@@ -0,0 +1,97 @@
+# image_processor/metrics.py
+import threading
+from collections import deque
+
+# Muestras recientes que se conservan por serie para calcular percentiles
+SUMMARY_WINDOW = 1024
+
+class MetricsRegistry:
+    """Registro de métricas en memoria del proceso (contadores, gauges y resúmenes)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = {'count': 0, 'sum': 0.0, 'max': value, 'samples': deque(maxlen=SUMMARY_WINDOW)}
+                self._summaries[key] = summary
+            summary['count'] += 1
+            summary['sum'] += value
+            summary['max'] = max(summary['max'], value)
+            summary['samples'].append(value)
+
+    def snapshot(self):
+        """Devuelve todas las series en un diccionario serializable a JSON"""
+        with self._lock:
+            return {
+                'counters': [_series(key, value) for key, value in self._counters.items()],
+                'gauges': [_series(key, value) for key, value in self._gauges.items()],
+                'summaries': [_series(key, _summarize(summary)) for key, summary in self._summaries.items()],
+            }
+
+    def render_prometheus(self):
+        """Exporta las métricas en el formato de texto de Prometheus"""
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), summary in sorted(self._summaries.items(), key=lambda item: item[0]):
+                stats = _summarize(summary)
+                for quantile, stat in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+                    quantile_labels = labels + (('quantile', quantile),)
+                    lines.append(f"{name}{_format_labels(quantile_labels)} {stats[stat]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {stats['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {stats['sum']}")
+        return '\n'.join(lines) + '\n'
+
+def percentile(sorted_values, fraction):
+    """Percentil por vecino más cercano sobre una lista ya ordenada"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def _summarize(summary):
+    samples = sorted(summary['samples'])
+    return {
+        'count': summary['count'],
+        'sum': summary['sum'],
+        'max': summary['max'],
+        'p50': percentile(samples, 0.50),
+        'p95': percentile(samples, 0.95),
+        'p99': percentile(samples, 0.99),
+    }
+
+def _series(key, value):
+    name, labels = key
+    return {'name': name, 'labels': dict(labels), 'value': value}
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+# Registro compartido por el worker y la API
+registry = MetricsRegistry()
@@ -0,0 +1,224 @@
+# image_processor/profiling.py
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from metrics import registry as metrics_registry
+
+logger = logging.getLogger('Profiling')
+
+# Perfilar uno de cada N mensajes (0 desactiva). 100 equivale al 1%
+PROFILE_EVERY_N = int(os.environ.get('PROFILE_EVERY_N', '0'))
+
+# Intervalo del muestreador estadístico en milisegundos
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+
+# Registrar también las asignaciones de memoria con tracemalloc (más costoso)
+PROFILE_TRACEMALLOC = os.environ.get('PROFILE_TRACEMALLOC', 'false').lower() == 'true'
+
+# Directorio de los perfiles y número máximo de perfiles que se conservan
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/ballot-profiles')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '200'))
+
+# Líneas con más memoria asignada que se guardan de cada snapshot
+PROFILE_TOP_ALLOCATIONS = 25
+
+# Configuración vigente; puede cambiarse en caliente con configure()
+# (endpoint /admin/profiling de app.py)
+settings = {
+    'everyN': PROFILE_EVERY_N,
+    'intervalMs': PROFILE_INTERVAL_MS,
+    'tracemalloc': PROFILE_TRACEMALLOC,
+}
+
+_lock = threading.Lock()
+_message_count = 0
+_frame_names = {}
+
+def configure(every_n=None, interval_ms=None, trace_allocations=None):
+    """Cambia la configuración de perfilado sin reiniciar el proceso"""
+    with _lock:
+        if every_n is not None:
+            settings['everyN'] = max(0, int(every_n))
+        if interval_ms is not None:
+            settings['intervalMs'] = max(0.5, float(interval_ms))
+        if trace_allocations is not None:
+            settings['tracemalloc'] = bool(trace_allocations)
+        return dict(settings)
+
+def should_profile():
+    """True para uno de cada `everyN` mensajes"""
+    global _message_count
+    every_n = settings['everyN']
+    if not every_n:
+        return False
+    with _lock:
+        _message_count += 1
+        return _message_count % every_n == 0
+
+def _frame_name(code):
+    # Nombre estable por función (no por línea) para no fragmentar el flame graph
+    name = _frame_names.get(code)
+    if name is None:
+        name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        _frame_names[code] = name
+    return name
+
+class StackSampler:
+    """Muestreador estadístico de las pilas de un hilo.
+
+    Un hilo aparte lee la pila del hilo perfilado cada `interval` segundos
+    con sys._current_frames(); el hilo perfilado no se instrumenta, así que
+    el coste es el de leer una pila por muestra. Las muestras se acumulan ya
+    colapsadas ("raíz;...;hoja" -> número de muestras).
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+                self.samples += 1
+            del frame
+
+def top_allocations(snapshot, limit=PROFILE_TOP_ALLOCATIONS):
+    """Líneas con más memoria asignada y aún viva de un snapshot de tracemalloc"""
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ))
+    return [
+        {
+            'location': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            'bytes': stat.size,
+            'count': stat.count,
+        }
+        for stat in snapshot.statistics('lineno')[:limit]
+    ]
+
+class MessageProfile:
+    """Perfil de un mensaje: pilas muestreadas y, opcionalmente, asignaciones.
+
+    Al terminar escribe en PROFILE_DIR un archivo de pilas colapsadas (.folded,
+    entrada de flamegraph.pl o speedscope) y un .json con las etiquetas
+    (ballotId, etapa), la duración y las asignaciones.
+    """
+
+    def __init__(self, ballot_id, stage):
+        self.ballot_id = ballot_id or 'unknown'
+        self.stage = stage
+        self.trace_allocations = settings['tracemalloc']
+        self.sampler = StackSampler(threading.get_ident(), settings['intervalMs'] / 1000.0)
+        self._started_tracing = False
+
+    def __enter__(self):
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.started = time.monotonic()
+        self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.sampler.stop()
+        elapsed = time.monotonic() - self.started
+        metadata = {
+            'ballotId': self.ballot_id,
+            'stage': self.stage,
+            'startedAt': time.time() - elapsed,
+            'seconds': elapsed,
+            'samples': self.sampler.samples,
+            'intervalMs': self.sampler.interval * 1000.0,
+            'error': exc_type.__name__ if exc_type else None,
+        }
+        if self.trace_allocations and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            metadata['allocations'] = {
+                'currentBytes': current,
+                'peakBytes': peak,
+                'top': top_allocations(tracemalloc.take_snapshot()),
+            }
+            if self._started_tracing:
+                tracemalloc.stop()
+        try:
+            self.write(metadata)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar el perfil de {self.ballot_id}: {e}")
+        metrics_registry.inc('profiles_total', stage=self.stage)
+        metrics_registry.observe('profiled_message_seconds', elapsed, stage=self.stage)
+        return False
+
+    def write(self, metadata):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        safe_id = ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(self.ballot_id))
+        base = os.path.join(PROFILE_DIR, f"{int(metadata['startedAt'] * 1000)}-{self.stage}-{safe_id}")
+        with open(base + '.folded', 'w') as folded:
+            for stack, count in self.sampler.stacks.most_common():
+                folded.write(f"{stack} {count}\n")
+        with open(base + '.json', 'w') as meta:
+            json.dump(metadata, meta, indent=2)
+        logger.info(f"Perfil de {self.ballot_id} ({self.stage}): {metadata['samples']} muestras en {base}.folded")
+        prune_profiles()
+
+def prune_profiles(keep=PROFILE_KEEP):
+    """Conserva solo los `keep` perfiles más recientes"""
+    try:
+        names = sorted(name[:-len('.json')] for name in os.listdir(PROFILE_DIR) if name.endswith('.json'))
+    except FileNotFoundError:
+        return
+    for name in names[:max(0, len(names) - keep)]:
+        for extension in ('.folded', '.json'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name + extension))
+            except FileNotFoundError:
+                pass
+
+def recent_profiles(limit=20):
+    """Metadatos de los perfiles más recientes, del más nuevo al más viejo"""
+    try:
+        names = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith('.json')), reverse=True)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as meta:
+                profile = json.load(meta)
+        except (OSError, ValueError):
+            continue
+        profile.pop('allocations', None)
+        profile['file'] = name[:-len('.json')] + '.folded'
+        profiles.append(profile)
+    return profiles
+
+def message_ballot_id(body):
+    """ballotId de un mensaje JSON, si lo tiene (solo se lee en los perfilados)"""
+    try:
+        message = json.loads(body)
+    except (TypeError, ValueError):
+        return None
+    return message.get('ballotId') if isinstance(message, dict) else None
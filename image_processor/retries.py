@@ -0,0 +1,91 @@
+# image_processor/retries.py
+import logging
+import os
+import pika
+import requests
+
+from metrics import registry as metrics_registry
+from algorithms.resilience import is_transient as is_transient_call
+from lanes import lane_properties
+
+logger = logging.getLogger('Retries')
+
+# Espera de cada nivel de reintento, en segundos. Un mensaje con fallo
+# transitorio pasa por {cola}.retry.1, {cola}.retry.2, ... y tras el último
+# nivel va a la DLQ
+RETRY_DELAYS_SECONDS = [
+    int(delay) for delay in os.environ.get('RETRY_DELAYS_SECONDS', '5,30,120').split(',') if delay.strip()
+]
+
+# Cabecera con el número de intento del mensaje (el primero es 1)
+ATTEMPT_HEADER = 'x-attempt'
+
+class TransientError(Exception):
+    """Fallo pasajero (servicio saturado, red, broker) que debe reintentarse"""
+
+def is_transient_error(error):
+    """Indica si un error justifica reintentar el mensaje más tarde"""
+    if isinstance(error, (TransientError, ConnectionError, TimeoutError, MemoryError)):
+        return True
+    if isinstance(error, pika.exceptions.AMQPConnectionError):
+        return True
+    if isinstance(error, requests.exceptions.ChunkedEncodingError):
+        return True
+    # Timeouts, conexión y códigos HTTP: los mismos criterios que las llamadas a Anthropic
+    return is_transient_call(error)
+
+def describe_error(error):
+    return str(error) or type(error).__name__
+
+def retry_queue_name(queue, tier):
+    return f"{queue}.retry.{tier}"
+
+def declare_retry_queues(channel, queue):
+    """Declara los niveles de reintento de una cola.
+
+    Cada nivel retiene los mensajes su tiempo de espera (TTL) y después los
+    devuelve directamente a la cola de origen mediante el exchange por defecto.
+    """
+    for tier, delay in enumerate(RETRY_DELAYS_SECONDS, start=1):
+        channel.queue_declare(queue=retry_queue_name(queue, tier), durable=True,
+            arguments={
+                'x-message-ttl': delay * 1000,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': queue
+            }
+        )
+
+def message_attempt(properties):
+    headers = (properties.headers if properties else None) or {}
+    return int(headers.get(ATTEMPT_HEADER, 1))
+
+def retry_or_dead_letter(ch, method, properties, body, queue, error):
+    """Reenvía un mensaje fallido al siguiente nivel de reintento, o a la DLQ.
+
+    Solo los errores transitorios se reintentan; el resto, y los que agotan
+    los niveles configurados, se rechazan hacia la DLQ de la cola.
+    """
+    attempt = message_attempt(properties)
+    if not is_transient_error(error) or attempt > len(RETRY_DELAYS_SECONDS):
+        logger.error(f"Mensaje de {queue} a DLQ tras {attempt} intento(s): {describe_error(error)}")
+        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+        metrics_registry.inc('messages_dead_lettered_total', queue=queue)
+        return False
+
+    headers = dict((properties.headers if properties else None) or {})
+    headers[ATTEMPT_HEADER] = attempt + 1
+    headers['x-last-error'] = describe_error(error)[:200]
+    ch.basic_publish(
+        exchange='',
+        routing_key=retry_queue_name(queue, attempt),
+        body=body,
+        # Los reintentos van al carril 'retry', por detrás de las subidas en vivo
+        properties=lane_properties('retry', headers, content_type=properties.content_type if properties else None)
+    )
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    metrics_registry.inc('message_retries_total', queue=queue, tier=attempt)
+    logger.warning(
+        f"Mensaje de {queue} reintentará en {RETRY_DELAYS_SECONDS[attempt - 1]}s "
+        f"(intento {attempt + 1}/{len(RETRY_DELAYS_SECONDS) + 1}): {describe_error(error)}"
+    )
+    return True
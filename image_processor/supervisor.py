@@ -0,0 +1,249 @@
+# image_processor/supervisor.py
+"""Supervisor de workers: lanza y retira procesos worker.py por cola según la
+profundidad de la cola, la utilización de los consumidores y la latencia
+objetivo, leídas de la API de administración de RabbitMQ.
+
+    WORKER_POOLS="validation:1:4,ocr:1:8,fallback:1:4,batch:1:1" python supervisor.py
+"""
+import argparse
+import logging
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+from urllib.parse import quote
+import requests
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('WorkerSupervisor')
+
+RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'localhost')
+RABBITMQ_USER = os.environ.get('RABBITMQ_USER', 'user')
+RABBITMQ_PASS = os.environ.get('RABBITMQ_PASS', 'password')
+RABBITMQ_VHOST = os.environ.get('RABBITMQ_VHOST', '/')
+RABBITMQ_MANAGEMENT_URL = os.environ.get('RABBITMQ_MANAGEMENT_URL', f"http://{RABBITMQ_HOST}:15672").rstrip('/')
+
+# Cola que atiende cada grupo de workers (mismas variables que worker.py)
+POOL_QUEUES = {
+    'validation': os.environ.get('IMAGE_PROCESSING_QUEUE', 'image_processing_queue'),
+    'ocr': os.environ.get('OCR_PROCESSING_QUEUE', 'ocr_processing_queue'),
+    'fallback': os.environ.get('ANTHROPIC_FALLBACK_QUEUE', 'anthropic_fallback_queue'),
+    'batch': os.environ.get('ANTHROPIC_BATCH_QUEUE', 'anthropic_batch_queue'),
+}
+
+# Grupos y límites: "grupo:mínimo:máximo" separados por comas
+WORKER_POOLS = os.environ.get('WORKER_POOLS', 'validation:1:4,ocr:1:8,fallback:1:4,batch:1:1')
+
+# Tiempo en que debería vaciarse la cola con el ritmo de atención actual
+TARGET_LATENCY_SECONDS = float(os.environ.get('SUPERVISOR_TARGET_LATENCY_SECONDS', '30'))
+
+# Intervalo entre evaluaciones y espera mínima entre reducciones de un grupo
+CHECK_INTERVAL_SECONDS = float(os.environ.get('SUPERVISOR_INTERVAL_SECONDS', '10'))
+SCALE_DOWN_COOLDOWN_SECONDS = float(os.environ.get('SUPERVISOR_SCALE_DOWN_COOLDOWN', '60'))
+
+# Por debajo de esta utilización y sin cola pendiente sobra un worker
+LOW_UTILIZATION = float(os.environ.get('SUPERVISOR_LOW_UTILIZATION', '0.5'))
+
+# Tiempo que se espera a que un worker retirado termine sus mensajes
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get('SUPERVISOR_DRAIN_TIMEOUT', '120'))
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+def parse_pools(spec):
+    """Convierte "grupo:mín:máx,..." en {grupo: (mín, máx)}"""
+    pools = {}
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        name, minimum, maximum = entry.strip().split(':')
+        if name not in POOL_QUEUES:
+            raise ValueError(f"Grupo de workers desconocido: {name}")
+        pools[name] = (int(minimum), max(int(minimum), int(maximum)))
+    return pools
+
+def fetch_queue_stats(queue_name):
+    """Lee de la API de administración el estado de una cola"""
+    response = requests.get(
+        f"{RABBITMQ_MANAGEMENT_URL}/api/queues/{quote(RABBITMQ_VHOST, safe='')}/{quote(queue_name, safe='')}",
+        auth=(RABBITMQ_USER, RABBITMQ_PASS),
+        timeout=5
+    )
+    response.raise_for_status()
+    data = response.json()
+    message_stats = data.get('message_stats', {})
+    return {
+        'ready': data.get('messages_ready', 0),
+        'unacked': data.get('messages_unacknowledged', 0),
+        'consumers': data.get('consumers', 0),
+        'utilization': data.get('consumer_utilisation'),
+        'ackRate': message_stats.get('ack_details', {}).get('rate', 0.0),
+        'publishRate': message_stats.get('publish_details', {}).get('rate', 0.0),
+    }
+
+def desired_workers(stats, current, minimum, maximum, target_latency=TARGET_LATENCY_SECONDS):
+    """Número de workers necesario para atender la cola dentro de la latencia objetivo.
+
+    Con ritmo de atención conocido se dimensiona para absorber las llegadas y
+    vaciar la cola pendiente en `target_latency`; sin él se añade un worker si
+    hay cola. Se retira un worker cuando no hay cola y los consumidores están
+    poco utilizados.
+    """
+    backlog = stats['ready']
+
+    if stats['ackRate'] > 0 and stats['consumers'] > 0:
+        per_worker_rate = stats['ackRate'] / stats['consumers']
+        needed_rate = stats['publishRate'] + backlog / target_latency
+        desired = math.ceil(needed_rate / per_worker_rate)
+        # Sin cola pendiente no se reduce de golpe: se retira de a uno
+        if desired < current:
+            utilization = stats['utilization']
+            idle = backlog == 0 and (utilization is None or utilization < LOW_UTILIZATION)
+            desired = current - 1 if idle else current
+    elif backlog > 0:
+        desired = current + 1
+    elif stats['unacked'] == 0:
+        desired = current - 1
+    else:
+        desired = current
+
+    return max(minimum, min(maximum, desired))
+
+class WorkerPool:
+    """Procesos worker.py de un grupo, consumiendo solo su cola"""
+
+    def __init__(self, name, minimum, maximum):
+        self.name = name
+        self.queue = POOL_QUEUES[name]
+        self.minimum = minimum
+        self.maximum = maximum
+        self.processes = []
+        self.last_scale_down = 0.0
+
+    def reap(self):
+        """Descarta los procesos terminados (se reponen en la siguiente evaluación)"""
+        alive = []
+        for process in self.processes:
+            if process.poll() is None:
+                alive.append(process)
+            else:
+                logger.warning(f"Worker {self.name} (pid {process.pid}) terminó con código {process.returncode}")
+        self.processes = alive
+
+    def spawn(self):
+        env = dict(os.environ, WORKER_QUEUES=self.name)
+        process = subprocess.Popen([sys.executable, WORKER_SCRIPT], env=env)
+        self.processes.append(process)
+        logger.info(f"Worker {self.name} iniciado (pid {process.pid}), total {len(self.processes)}")
+
+    def retire(self):
+        """Pide al worker más reciente que termine sus mensajes y se detenga"""
+        process = self.processes.pop()
+        process.send_signal(signal.SIGTERM)
+        logger.info(f"Worker {self.name} (pid {process.pid}) retirándose, total {len(self.processes)}")
+        return process
+
+    def scale_to(self, target):
+        """Ajusta el número de procesos; devuelve los que están terminando"""
+        retiring = []
+        while len(self.processes) < target:
+            self.spawn()
+        if len(self.processes) > target:
+            if time.monotonic() - self.last_scale_down < SCALE_DOWN_COOLDOWN_SECONDS:
+                return retiring
+            while len(self.processes) > target:
+                retiring.append(self.retire())
+            self.last_scale_down = time.monotonic()
+        return retiring
+
+class Supervisor:
+    def __init__(self, pools):
+        self.pools = {name: WorkerPool(name, minimum, maximum) for name, (minimum, maximum) in pools.items()}
+        self.retiring = []
+        self.running = True
+
+    def step(self, dry_run=False):
+        """Evalúa cada grupo y ajusta su número de workers"""
+        for pool in self.pools.values():
+            pool.reap()
+            current = len(pool.processes)
+            try:
+                stats = fetch_queue_stats(pool.queue)
+            except Exception as e:
+                # Sin datos del broker solo se garantizan los mínimos
+                logger.warning(f"No se pudo leer el estado de {pool.queue}: {e}")
+                target = max(current, pool.minimum)
+            else:
+                target = desired_workers(stats, current, pool.minimum, pool.maximum)
+                logger.info(
+                    f"{pool.name}: cola={stats['ready']} sin confirmar={stats['unacked']} "
+                    f"consumidores={stats['consumers']} utilización={stats['utilization']} "
+                    f"atención={stats['ackRate']:.2f}/s llegada={stats['publishRate']:.2f}/s "
+                    f"workers={current} -> {target}"
+                )
+            if not dry_run:
+                self.retiring.extend(pool.scale_to(target))
+        self.check_retiring()
+
+    def check_retiring(self):
+        """Fuerza la salida de los workers que superan el plazo de vaciado"""
+        still_retiring = []
+        for process in self.retiring:
+            if process.poll() is not None:
+                continue
+            started = getattr(process, 'retire_started', None)
+            if started is None:
+                process.retire_started = started = time.monotonic()
+            if time.monotonic() - started > DRAIN_TIMEOUT_SECONDS:
+                logger.warning(f"Worker pid {process.pid} no terminó en {DRAIN_TIMEOUT_SECONDS}s, forzando salida")
+                process.kill()
+            else:
+                still_retiring.append(process)
+        self.retiring = still_retiring
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def shutdown(self):
+        """Retira todos los workers esperando a que terminen sus mensajes"""
+        for pool in self.pools.values():
+            while pool.processes:
+                self.retiring.append(pool.retire())
+        deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS
+        for process in self.retiring:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+        logger.info("Supervisor detenido")
+
+    def run(self, interval=CHECK_INTERVAL_SECONDS):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while self.running:
+            self.step()
+            next_check = time.monotonic() + interval
+            while self.running and time.monotonic() < next_check:
+                time.sleep(0.5)
+        self.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Supervisor de workers por profundidad de cola')
+    parser.add_argument('--pools', default=WORKER_POOLS, help='grupo:mín:máx separados por comas')
+    parser.add_argument('--interval', type=float, default=CHECK_INTERVAL_SECONDS)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Solo muestra las decisiones de escalado, sin lanzar workers')
+    args = parser.parse_args()
+
+    supervisor = Supervisor(parse_pools(args.pools))
+    if args.dry_run:
+        supervisor.step(dry_run=True)
+        return
+    supervisor.run(args.interval)
+
+if __name__ == '__main__':
+    main()
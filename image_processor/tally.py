@@ -0,0 +1,339 @@
+# image_processor/tally.py
+"""Cómputo incremental: consume los resultados publicados en 'results' y
+mantiene en memoria los totales por departamento, provincia, municipio y
+partido, sin consultar todas las actas en cada actualización.
+
+    TALLY_SNAPSHOT_PATH=/data/tally.json python tally.py
+
+Cada resultado actualiza los totales en tiempo constante. Las correcciones y
+los duplicados se resuelven por ballotId: se descuenta lo que la acta aportaba
+y se suma su nuevo contenido. El estado se guarda periódicamente en disco para
+reiniciar sin reprocesar la cola, y se sirve por HTTP:
+
+    GET /tally                       totales anidados por departamento
+    GET /tally?department=La%20Paz   solo un departamento
+    GET /metrics                     métricas del consumidor
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pika
+
+from metrics import registry as metrics_registry
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('TallyConsumer')
+
+RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'localhost')
+RABBITMQ_PORT = int(os.environ.get('RABBITMQ_PORT', 5672))
+RABBITMQ_USER = os.environ.get('RABBITMQ_USER', 'user')
+RABBITMQ_PASS = os.environ.get('RABBITMQ_PASS', 'password')
+BALLOT_PROCESSING_EXCHANGE = os.environ.get('BALLOT_PROCESSING_EXCHANGE', 'ballot_processing_exchange')
+
+# Cola propia enlazada a 'results': recibe una copia de cada resultado sin
+# competir con el consumidor principal de results_queue
+TALLY_QUEUE = os.environ.get('TALLY_QUEUE', 'results_tally_queue')
+
+# Archivo de estado ('' solo en memoria) y cada cuánto se guarda
+TALLY_SNAPSHOT_PATH = os.environ.get('TALLY_SNAPSHOT_PATH', 'tally_snapshot.json')
+TALLY_SNAPSHOT_SECONDS = float(os.environ.get('TALLY_SNAPSHOT_SECONDS', '5'))
+
+# Mensajes sin confirmar como máximo: se confirman en bloque después de cada
+# guardado, así un reinicio solo repite los posteriores al último estado
+TALLY_PREFETCH = int(os.environ.get('TALLY_PREFETCH', '2000'))
+
+TALLY_HTTP_PORT = int(os.environ.get('TALLY_HTTP_PORT', '8090'))
+
+# Niveles geográficos acumulados (cada uno incluye a los anteriores en la clave)
+TALLY_LEVELS = ('department', 'province', 'municipality')
+
+# Estados de resultado que aportan votos al cómputo
+COUNTED_STATUSES = ('COMPLETED', 'CORRECTED')
+
+def empty_totals():
+    return {'ballots': 0, 'validVotes': 0, 'blankVotes': 0, 'nullVotes': 0, 'parties': {}}
+
+def ballot_contribution(message):
+    """Claves geográficas y votos que una acta aporta al cómputo"""
+    results = message.get('results') or {}
+    location = results.get('location') or {}
+    votes = results.get('votes') or {}
+
+    path = tuple(str(location.get(level) or '') for level in TALLY_LEVELS)
+    counts = {
+        'validVotes': int(votes.get('validVotes') or 0),
+        'blankVotes': int(votes.get('blankVotes') or 0),
+        'nullVotes': int(votes.get('nullVotes') or 0),
+        'parties': {
+            str(party['partyId']): int(party.get('votes') or 0)
+            for party in votes.get('partyVotes', [])
+        },
+    }
+    return {'path': path, 'counts': counts, 'revision': int(message.get('revision') or 0)}
+
+class Tally:
+    """Totales incrementales con una aportación registrada por acta"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # ballotId -> aportación actual (para descontarla si llega una corrección)
+        self.ballots = {}
+        # Clave geográfica (prefijo de (departamento, provincia, municipio)) -> totales
+        self.totals = {(): empty_totals()}
+        self.version = 0
+        self.updated_at = None
+        # Informes ya serializados para una versión ({'version', departamento: json}).
+        # No se modifica: cada cambio lo reemplaza por otro diccionario bajo el lock
+        self._report_cache = {}
+
+    def _apply(self, path, counts, sign):
+        # Un nodo por nivel: nacional, departamento, provincia y municipio
+        for depth in range(len(TALLY_LEVELS) + 1):
+            node = self.totals.setdefault(path[:depth], empty_totals())
+            node['ballots'] += sign
+            for field in ('validVotes', 'blankVotes', 'nullVotes'):
+                node[field] += sign * counts[field]
+            parties = node['parties']
+            for party_id, votes in counts['parties'].items():
+                parties[party_id] = parties.get(party_id, 0) + sign * votes
+
+    def add_result(self, message):
+        """Incorpora un resultado. Devuelve 'added', 'corrected', 'duplicate',
+        'removed', 'stale' o 'ignored'.
+        """
+        ballot_id = message.get('ballotId')
+        if not ballot_id:
+            return 'ignored'
+        status = message.get('status')
+
+        with self._lock:
+            previous = self.ballots.get(ballot_id)
+            if status not in COUNTED_STATUSES:
+                # Una acta anulada después de contada deja de aportar votos
+                if previous is None or status != 'REJECTED':
+                    return 'ignored'
+                self._apply(previous['path'], previous['counts'], -1)
+                del self.ballots[ballot_id]
+                outcome = 'removed'
+            else:
+                contribution = ballot_contribution(message)
+                if previous is not None:
+                    if contribution['revision'] < previous['revision']:
+                        return 'stale'
+                    if contribution['path'] == previous['path'] and contribution['counts'] == previous['counts']:
+                        return 'duplicate'
+                    self._apply(previous['path'], previous['counts'], -1)
+                self._apply(contribution['path'], contribution['counts'], 1)
+                self.ballots[ballot_id] = contribution
+                outcome = 'added' if previous is None else 'corrected'
+
+            self.version += 1
+            self.updated_at = time.time()
+            return outcome
+
+    def state(self):
+        """Estado completo serializable (para guardar en disco)"""
+        with self._lock:
+            return {
+                'version': self.version,
+                'updatedAt': self.updated_at,
+                'ballots': {
+                    ballot_id: {**contribution, 'path': list(contribution['path'])}
+                    for ballot_id, contribution in self.ballots.items()
+                },
+            }
+
+    @classmethod
+    def from_state(cls, state):
+        """Reconstruye los totales a partir de las aportaciones guardadas"""
+        tally = cls()
+        for ballot_id, contribution in state.get('ballots', {}).items():
+            contribution = {**contribution, 'path': tuple(contribution['path'])}
+            tally._apply(contribution['path'], contribution['counts'], 1)
+            tally.ballots[ballot_id] = contribution
+        tally.version = state.get('version', 0)
+        tally.updated_at = state.get('updatedAt')
+        return tally
+
+    def report(self, department=None):
+        """Totales anidados nacional > departamento > provincia > municipio"""
+        with self._lock:
+            nodes = {path: {**totals, 'parties': dict(totals['parties'])} for path, totals in self.totals.items()}
+            version, updated_at = self.version, self.updated_at
+
+        children_key = {0: 'departments', 1: 'provinces', 2: 'municipalities'}
+        for path in sorted(nodes, key=len):
+            if path:
+                parent = nodes[path[:-1]]
+                parent.setdefault(children_key[len(path) - 1], {})[path[-1]] = nodes[path]
+
+        report = {'version': version, 'updatedAt': updated_at, 'national': nodes[()]}
+        if department is not None:
+            report = {'version': version, 'updatedAt': updated_at,
+                      'department': nodes.get((department,), empty_totals())}
+        return report
+
+    def report_json(self, department=None):
+        """Informe serializado; se regenera solo cuando cambian los totales.
+
+        Lo consultan los hilos del servidor HTTP mientras el consumidor
+        actualiza los totales: el informe se guarda con la versión que leyó
+        report() y solo si sigue siendo la actual.
+        """
+        cache = self._report_cache
+        if cache.get('version') == self.version and department in cache:
+            return cache[department]
+
+        report = self.report(department)
+        serialized = json.dumps(report)
+        with self._lock:
+            if report['version'] == self.version:
+                cache = self._report_cache
+                if cache.get('version') != report['version']:
+                    cache = {'version': report['version']}
+                self._report_cache = {**cache, department: serialized}
+        return serialized
+
+def save_snapshot(tally, path):
+    """Guarda el estado de forma atómica (archivo temporal + rename)"""
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as snapshot_file:
+        json.dump(tally.state(), snapshot_file)
+    os.replace(temporary, path)
+
+def load_snapshot(path):
+    if not path or not os.path.exists(path):
+        return Tally()
+    with open(path) as snapshot_file:
+        tally = Tally.from_state(json.load(snapshot_file))
+    logger.info(f"Estado restaurado: {len(tally.ballots)} actas (versión {tally.version})")
+    return tally
+
+class TallyRequestHandler(BaseHTTPRequestHandler):
+    tally = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/tally':
+            department = parse_qs(url.query).get('department', [None])[0]
+            self.respond(200, 'application/json', self.tally.report_json(department))
+        elif url.path == '/metrics':
+            self.respond(200, 'text/plain; version=0.0.4', metrics_registry.render_prometheus())
+        else:
+            self.respond(404, 'application/json', json.dumps({'error': 'No encontrado'}))
+
+    def respond(self, status, content_type, body):
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(tally, port=TALLY_HTTP_PORT):
+    handler = type('Handler', (TallyRequestHandler,), {'tally': tally})
+    server = ThreadingHTTPServer(('0.0.0.0', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Cómputo disponible en http://0.0.0.0:{port}/tally")
+    return server
+
+def connect():
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+    parameters = pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        credentials=credentials,
+        heartbeat=600,
+        blocked_connection_timeout=300
+    )
+    connection = pika.BlockingConnection(parameters)
+    channel = connection.channel()
+    channel.exchange_declare(exchange=BALLOT_PROCESSING_EXCHANGE, exchange_type='direct', durable=True)
+    channel.queue_declare(queue=TALLY_QUEUE, durable=True)
+    channel.queue_bind(queue=TALLY_QUEUE, exchange=BALLOT_PROCESSING_EXCHANGE, routing_key='results')
+    channel.basic_qos(prefetch_count=TALLY_PREFETCH)
+    return connection, channel
+
+def run_consumer(tally, snapshot_path=TALLY_SNAPSHOT_PATH, stop=None):
+    """Consume resultados hasta que se active `stop`, guardando y confirmando
+    en bloque cada TALLY_SNAPSHOT_SECONDS o al llenarse la ventana de prefetch.
+    """
+    stop = stop or threading.Event()
+    connection, channel = connect()
+    last_tag = None
+    pending = 0
+    next_snapshot = time.monotonic() + TALLY_SNAPSHOT_SECONDS
+
+    def checkpoint():
+        nonlocal last_tag, pending, next_snapshot
+        if snapshot_path:
+            save_snapshot(tally, snapshot_path)
+        if last_tag is not None:
+            channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        last_tag, pending = None, 0
+        next_snapshot = time.monotonic() + TALLY_SNAPSHOT_SECONDS
+
+    try:
+        for method, properties, body in channel.consume(TALLY_QUEUE, inactivity_timeout=1):
+            if method is not None:
+                try:
+                    outcome = tally.add_result(json.loads(body))
+                except Exception as e:
+                    # Un mensaje malformado no debe detener el cómputo
+                    logger.error(f"Resultado no válido descartado: {e}")
+                    outcome = 'invalid'
+                metrics_registry.inc('tally_results_total', outcome=outcome)
+                last_tag = method.delivery_tag
+                pending += 1
+
+            if pending and (pending >= TALLY_PREFETCH // 2 or time.monotonic() >= next_snapshot):
+                checkpoint()
+                metrics_registry.set_gauge('tally_ballots', len(tally.ballots))
+            if stop.is_set():
+                break
+    finally:
+        # Con la conexión perdida se guarda igualmente el estado: los mensajes
+        # sin confirmar se volverán a recibir y se reconocerán como duplicados
+        if snapshot_path:
+            save_snapshot(tally, snapshot_path)
+        if channel.is_open:
+            if last_tag is not None:
+                channel.basic_ack(delivery_tag=last_tag, multiple=True)
+            channel.cancel()
+        if connection.is_open:
+            connection.close()
+        logger.info("Consumidor de cómputo detenido")
+
+def main():
+    parser = argparse.ArgumentParser(description='Cómputo incremental de resultados')
+    parser.add_argument('--snapshot', default=TALLY_SNAPSHOT_PATH, help="Archivo de estado ('' solo en memoria)")
+    parser.add_argument('--port', type=int, default=TALLY_HTTP_PORT)
+    args = parser.parse_args()
+
+    tally = load_snapshot(args.snapshot)
+    start_http_server(tally, args.port)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    while not stop.is_set():
+        try:
+            run_consumer(tally, args.snapshot, stop)
+        except pika.exceptions.AMQPError as e:
+            logger.error(f"Conexión con RabbitMQ perdida: {e}. Reintentando en 5s")
+            stop.wait(5)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+# image_processor/tools/anthropic_stub.py
+"""Servidor local que imita la API de mensajes y de lotes de Anthropic.
+
+Permite probar el fallback (interactivo y por lotes) sin consumir la API real:
+
+    python tools/anthropic_stub.py --port 8089 --batch-delay 30
+    ANTHROPIC_API_BASE_URL=http://localhost:8089 ANTHROPIC_API_KEY=stub python worker.py
+
+Latencia de la API simulada para pruebas de carga: --latency segundos por
+solicitud, más una variación uniforme de hasta --latency-jitter.
+
+Inyección de fallos para probar el circuito y los plazos: --fail-rate con
+--fail-status (p. ej. 529), --slow-rate con --slow-seconds. Los valores pueden
+cambiarse en caliente:
+
+    curl -X POST localhost:8089/_faults -d '{"fail_rate": 1.0}'
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Respuesta fija para la página completa
+PAGE_RESPONSE = {
+    'tableCode': 'STUB-0001',
+    'tableNumber': '1',
+    'location': {
+        'department': 'La Paz',
+        'province': 'Murillo',
+        'municipality': 'La Paz',
+        'locality': 'La Paz',
+        'pollingPlace': 'Recinto de prueba'
+    },
+    'votes': {
+        'validVotes': 100,
+        'nullVotes': 3,
+        'blankVotes': 2,
+        'partyVotes': []
+    },
+    'confidence': 0.9
+}
+
+# Valores fijos por casilla para las consultas de mosaico
+FIELD_VALUES = {
+    'codigo_mesa': 'STUB-0001',
+    'numero_mesa': '1',
+    'votos_validos': '100',
+    'votos_blancos': '2',
+    'votos_nulos': '3',
+}
+
+class StubState:
+    """Lotes creados en memoria y configuración del servidor"""
+
+    def __init__(self, batch_delay, faults):
+        self.batch_delay = batch_delay
+        self.faults = faults
+        self.batches = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+def message_response(params):
+    """Genera una respuesta de mensaje a partir de los parámetros de la solicitud"""
+    prompt = ''.join(
+        block.get('text', '')
+        for message in params.get('messages', [])
+        for block in message.get('content', [])
+        if isinstance(block, dict)
+    )
+    # Los prompts de mosaico enumeran las etiquetas como "- <id>:"
+    field_ids = re.findall(r'^\s*-\s*(\w+):', prompt, re.MULTILINE)
+    if field_ids:
+        payload = {
+            'fields': {field_id: FIELD_VALUES.get(field_id, 'STUB') for field_id in field_ids},
+            'confidence': 0.9
+        }
+    else:
+        payload = PAGE_RESPONSE
+    return {
+        'id': 'msg_stub',
+        'type': 'message',
+        'role': 'assistant',
+        'model': params.get('model', 'stub'),
+        'content': [{'type': 'text', 'text': json.dumps(payload)}],
+        'stop_reason': 'end_turn'
+    }
+
+def make_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload, content_type='application/json'):
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def _batch_view(self, batch):
+            ended = time.monotonic() - batch['created'] >= state.batch_delay
+            base = f"http://{self.headers.get('Host')}/v1/messages/batches/{batch['id']}"
+            return {
+                'id': batch['id'],
+                'type': 'message_batch',
+                'processing_status': 'ended' if ended else 'in_progress',
+                'request_counts': {'succeeded': len(batch['requests']) if ended else 0},
+                'results_url': f"{base}/results" if ended else None
+            }
+
+        def _inject_fault(self):
+            """Aplica los fallos configurados; devuelve True si ya se respondió con error"""
+            faults = state.faults
+            latency = faults['latency'] + random.uniform(0, faults['latency_jitter'])
+            if latency > 0:
+                time.sleep(latency)
+            if random.random() < faults['slow_rate']:
+                time.sleep(faults['slow_seconds'])
+            if random.random() < faults['fail_rate']:
+                self._send_json(faults['fail_status'], {
+                    'type': 'error',
+                    'error': {'type': 'overloaded_error', 'message': 'Fallo inyectado por el stub'}
+                })
+                return True
+            return False
+
+        def do_POST(self):
+            if self.path == '/_faults':
+                state.faults.update(self._read_json())
+                self._send_json(200, state.faults)
+            elif self.path.startswith('/v1/') and self._inject_fault():
+                return
+            elif self.path == '/v1/messages':
+                self._send_json(200, message_response(self._read_json()))
+            elif self.path == '/v1/messages/batches':
+                requests_list = self._read_json().get('requests', [])
+                with state.lock:
+                    batch_id = f"msgbatch_stub_{next(state.ids)}"
+                    state.batches[batch_id] = {
+                        'id': batch_id,
+                        'requests': requests_list,
+                        'created': time.monotonic()
+                    }
+                self._send_json(200, self._batch_view(state.batches[batch_id]))
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_GET(self):
+            if self.path == '/_faults':
+                self._send_json(200, state.faults)
+                return
+            match = re.fullmatch(r'/v1/messages/batches/([\w-]+)(/results)?', self.path)
+            batch = state.batches.get(match.group(1)) if match else None
+            if batch is None:
+                self._send_json(404, {'error': 'not found'})
+            elif not match.group(2):
+                self._send_json(200, self._batch_view(batch))
+            else:
+                lines = [
+                    json.dumps({
+                        'custom_id': entry['custom_id'],
+                        'result': {'type': 'succeeded', 'message': message_response(entry['params'])}
+                    })
+                    for entry in batch['requests']
+                ]
+                self._send_json(200, '\n'.join(lines).encode(), 'application/x-jsonl')
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub local de la API de Anthropic')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--batch-delay', type=float, default=30.0,
+                        help='Segundos hasta que un lote figura como terminado')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Segundos de latencia de cada solicitud')
+    parser.add_argument('--latency-jitter', type=float, default=0.0,
+                        help='Variación aleatoria máxima que se suma a --latency')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='Fracción de solicitudes que responden con error')
+    parser.add_argument('--fail-status', type=int, default=529,
+                        help='Código HTTP de los errores inyectados')
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help='Fracción de solicitudes que se retrasan')
+    parser.add_argument('--slow-seconds', type=float, default=5.0,
+                        help='Retraso de las solicitudes lentas')
+    args = parser.parse_args()
+
+    faults = {
+        'latency': args.latency,
+        'latency_jitter': args.latency_jitter,
+        'fail_rate': args.fail_rate,
+        'fail_status': args.fail_status,
+        'slow_rate': args.slow_rate,
+        'slow_seconds': args.slow_seconds
+    }
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(StubState(args.batch_delay, faults)))
+    print(f"Stub de Anthropic escuchando en http://{args.host}:{args.port}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# image_processor/tools/loadgen.py
+"""Generador de carga: mide cuánto sostiene un nodo de workers de punta a punta.
+
+Publica actas sintéticas en 'image_processing' a un ritmo dado y consume
+'results' con una cola propia (no compite con results_queue). Al terminar
+informa el throughput, la latencia de punta a punta (p50/p95/p99) y la
+proporción de actas resueltas por el fallback de Anthropic.
+
+Todo corre en local: RabbitMQ en un contenedor, el stub de Anthropic con la
+latencia deseada y los workers a medir.
+
+    docker run -d --name rabbitmq -p 5672:5672 -e RABBITMQ_DEFAULT_USER=user \\
+        -e RABBITMQ_DEFAULT_PASS=password rabbitmq:3-management
+    python tools/anthropic_stub.py --latency 1.5 --latency-jitter 0.5
+    ANTHROPIC_API_BASE_URL=http://localhost:8089 ANTHROPIC_API_KEY=stub \\
+        NEAR_DUPLICATE_MODE=off python worker.py
+    python tools/loadgen.py --rate 5 --duration 300 --arrival poisson
+
+Las llegadas son en lazo abierto: cada acta se publica en su instante
+programado aunque las anteriores no hayan terminado, como las subidas reales.
+Con --arrival poisson los intervalos son exponenciales (ráfagas), con
+--arrival fixed son constantes. Las actas sintéticas varían por semilla
+(--variants); conviene desactivar la detección de casi-duplicados y la caché
+de etapas en los workers para no medir reutilizaciones.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+import pika
+
+# Permite ejecutar la herramienta desde image_processor/ o desde tools/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from algorithms.synthetic import encode_synthetic_ballot
+from lanes import LANES, lane_properties
+from metrics import percentile
+
+RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'localhost')
+RABBITMQ_PORT = int(os.environ.get('RABBITMQ_PORT', 5672))
+RABBITMQ_USER = os.environ.get('RABBITMQ_USER', 'user')
+RABBITMQ_PASS = os.environ.get('RABBITMQ_PASS', 'password')
+BALLOT_PROCESSING_EXCHANGE = os.environ.get('BALLOT_PROCESSING_EXCHANGE', 'ballot_processing_exchange')
+
+# Hosts considerados locales; cualquier otro requiere --allow-remote
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1', 'rabbitmq')
+
+# Cada cuántos segundos se informa el avance
+PROGRESS_SECONDS = 10
+
+def connect():
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+    parameters = pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        credentials=credentials,
+        heartbeat=600,
+        blocked_connection_timeout=300
+    )
+    connection = pika.BlockingConnection(parameters)
+    channel = connection.channel()
+    channel.exchange_declare(exchange=BALLOT_PROCESSING_EXCHANGE, exchange_type='direct', durable=True)
+    return connection, channel
+
+def arrival_times(rate, count, arrival, rng):
+    """Instantes de publicación (segundos desde el inicio) de `count` actas"""
+    elapsed = 0.0
+    for _ in range(count):
+        yield elapsed
+        elapsed += rng.expovariate(rate) if arrival == 'poisson' else 1.0 / rate
+
+class RunStats:
+    """Envíos y resultados de la corrida, compartidos entre publicador y consumidor"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent_at = {}
+        self.latencies = []
+        self.statuses = {}
+        self.fallbacks = 0
+        self.first_sent = None
+        self.last_result = None
+
+    def record_sent(self, ballot_id):
+        now = time.monotonic()
+        with self.lock:
+            self.sent_at[ballot_id] = now
+            if self.first_sent is None:
+                self.first_sent = now
+
+    def record_result(self, message):
+        """Registra un resultado; ignora las actas que no son de esta corrida"""
+        now = time.monotonic()
+        with self.lock:
+            sent = self.sent_at.pop(message.get('ballotId'), None)
+            if sent is None:
+                return
+            self.latencies.append(now - sent)
+            status = message.get('status', 'UNKNOWN')
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if 'anthropic' in str(message.get('source', '')):
+                self.fallbacks += 1
+            self.last_result = now
+
+    def pending(self):
+        with self.lock:
+            return len(self.sent_at)
+
+    def report(self, sent):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            received = len(latencies)
+            window = (self.last_result - self.first_sent) if received else 0.0
+            return {
+                'sent': sent,
+                'received': received,
+                'missing': len(self.sent_at),
+                'statuses': dict(self.statuses),
+                'throughputPerSecond': received / window if window else 0.0,
+                'latencySeconds': {
+                    'p50': percentile(latencies, 0.50),
+                    'p95': percentile(latencies, 0.95),
+                    'p99': percentile(latencies, 0.99),
+                    'max': latencies[-1] if latencies else 0.0,
+                },
+                'fallbackRatio': self.fallbacks / received if received else 0.0,
+            }
+
+def consume_results(stats, ready, stop):
+    """Recibe una copia de cada resultado en una cola exclusiva enlazada a 'results'"""
+    connection, channel = connect()
+    result = channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+    channel.queue_bind(queue=result.method.queue, exchange=BALLOT_PROCESSING_EXCHANGE, routing_key='results')
+    ready.set()
+    try:
+        for method, properties, body in channel.consume(result.method.queue, auto_ack=True, inactivity_timeout=0.5):
+            if method is not None:
+                try:
+                    stats.record_result(json.loads(body))
+                except ValueError:
+                    pass
+            if stop.is_set():
+                break
+    finally:
+        channel.cancel()
+        connection.close()
+
+def run_load(rate, count, arrival, variants, lane, drain_seconds, seed=0):
+    """Publica `count` actas a `rate` por segundo y espera sus resultados hasta
+    `drain_seconds` después del último envío. Devuelve el informe de la corrida.
+    """
+    rng = random.Random(seed)
+    images = [
+        base64.b64encode(encode_synthetic_ballot(seed=seed + variant)).decode('utf-8')
+        for variant in range(variants)
+    ]
+    run_id = uuid.uuid4().hex[:8]
+    stats = RunStats()
+
+    ready, stop = threading.Event(), threading.Event()
+    consumer = threading.Thread(target=consume_results, args=(stats, ready, stop), daemon=True)
+    consumer.start()
+    if not ready.wait(30):
+        raise RuntimeError("No se pudo preparar la cola de resultados")
+
+    connection, channel = connect()
+    started = time.monotonic()
+    next_progress = started + PROGRESS_SECONDS
+    sent = 0
+    late = 0.0
+    try:
+        for index, offset in enumerate(arrival_times(rate, count, arrival, rng)):
+            # Lazo abierto: esperar el instante programado, sin mirar los resultados.
+            # process_data_events mantiene vivo el heartbeat durante la espera
+            wait = started + offset - time.monotonic()
+            if wait > 0:
+                connection.process_data_events(time_limit=wait)
+            else:
+                late = max(late, -wait)
+
+            ballot_id = f"loadgen-{run_id}-{index:06d}"
+            body = json.dumps({'ballotId': ballot_id, 'imageBuffer': images[index % variants]})
+            stats.record_sent(ballot_id)
+            channel.basic_publish(
+                exchange=BALLOT_PROCESSING_EXCHANGE,
+                routing_key='image_processing',
+                body=body,
+                properties=lane_properties(lane, content_type='application/json')
+            )
+            sent += 1
+
+            if time.monotonic() >= next_progress:
+                next_progress += PROGRESS_SECONDS
+                print(f"{sent} enviadas, {sent - stats.pending()} resultados, {stats.pending()} pendientes", flush=True)
+    finally:
+        connection.close()
+
+    if late > 1.0:
+        print(f"Aviso: el publicador se atrasó hasta {late:.1f}s; el ritmo real fue menor al pedido")
+
+    deadline = time.monotonic() + drain_seconds
+    while stats.pending() and time.monotonic() < deadline:
+        time.sleep(0.5)
+    stop.set()
+    consumer.join(5)
+    report = stats.report(sent)
+    report.update({'runId': run_id, 'rate': rate, 'arrival': arrival})
+    return report
+
+def print_report(report):
+    latency = report['latencySeconds']
+    print(f"Corrida {report['runId']}: {report['sent']} enviadas a {report['rate']}/s ({report['arrival']})")
+    print(f"  Resultados: {report['received']} ({report['missing']} sin respuesta) {report['statuses']}")
+    print(f"  Throughput: {report['throughputPerSecond']:.2f} actas/s")
+    print(f"  Latencia: p50={latency['p50']:.2f}s p95={latency['p95']:.2f}s "
+          f"p99={latency['p99']:.2f}s max={latency['max']:.2f}s")
+    print(f"  Fallback a Anthropic: {report['fallbackRatio']:.1%}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Generador de carga de punta a punta contra un RabbitMQ local')
+    parser.add_argument('--rate', type=float, default=2.0, help='Actas por segundo')
+    parser.add_argument('--arrival', choices=('fixed', 'poisson'), default='poisson',
+                        help='Intervalos constantes o exponenciales (lazo abierto en ambos casos)')
+    parser.add_argument('--count', type=int, help='Actas a enviar')
+    parser.add_argument('--duration', type=float, default=60.0, help='Segundos de envío si no se indica --count')
+    parser.add_argument('--variants', type=int, default=16, help='Actas sintéticas distintas que se alternan')
+    parser.add_argument('--lane', choices=list(LANES), default='live', help='Carril de publicación')
+    parser.add_argument('--drain', type=float, default=120.0,
+                        help='Segundos de espera de resultados tras el último envío')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Guardar además el informe en este archivo')
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='Permitir un RABBITMQ_HOST que no sea local (no recomendado)')
+    args = parser.parse_args()
+
+    if RABBITMQ_HOST not in LOCAL_HOSTS and not args.allow_remote:
+        parser.error(f"RABBITMQ_HOST={RABBITMQ_HOST} no es local; use --allow-remote si es intencional")
+    if args.rate <= 0:
+        parser.error("--rate debe ser positivo")
+
+    count = args.count or max(1, int(args.rate * args.duration))
+    report = run_load(args.rate, count, args.arrival, max(1, args.variants), args.lane, args.drain, args.seed)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# image_processor/warmup.py
+import logging
+import os
+import time
+
+from metrics import registry as metrics_registry
+
+logger = logging.getLogger('WarmUp')
+
+# Pasar una acta sintética por todas las etapas antes de declararse listo
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', 'true').lower() == 'true'
+
+# Momento de importación del módulo, si no se puede leer el inicio del proceso
+_IMPORTED_AT = time.time()
+
+# Estado de preparación del proceso, expuesto por /ready
+readiness = {
+    'ready': False,
+    'startupSeconds': None,
+    'warmupSeconds': None,
+    'stages': {},
+    'firstRequests': {},
+    'error': None,
+}
+
+_first_requests = set()
+
+def process_uptime_seconds():
+    """Segundos desde que arrancó el proceso (desde la importación si no hay /proc)"""
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # El nombre del proceso puede contener espacios: contar desde ')'
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime_file:
+            system_uptime = float(uptime_file.read().split()[0])
+        started_after_boot = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return system_uptime - started_after_boot
+    except (OSError, IndexError, ValueError):
+        return time.time() - _IMPORTED_AT
+
+def warm_up(extractor):
+    """Pasa una acta sintética por cada etapa para pagar las inicializaciones
+    perezosas (OpenCV, Tesseract, plantillas) antes de recibir tráfico.
+
+    Un fallo del calentamiento se registra pero no impide declararse listo: el
+    proceso atiende igual, solo que la primera acta será más lenta.
+    """
+    if readiness['ready']:
+        return readiness
+
+    started = time.monotonic()
+    if WARMUP_ON_START:
+        try:
+            run_warmup_stages(extractor, readiness['stages'])
+        except Exception as e:
+            logger.error(f"Error en el calentamiento: {e}")
+            readiness['error'] = str(e)
+        readiness['warmupSeconds'] = time.monotonic() - started
+        metrics_registry.set_gauge('warmup_seconds', readiness['warmupSeconds'])
+
+    mark_ready()
+    logger.info(
+        f"Proceso listo en {readiness['startupSeconds']:.2f}s "
+        f"(calentamiento: {readiness['warmupSeconds'] or 0:.2f}s, etapas: {readiness['stages']})"
+    )
+    return readiness
+
+def run_warmup_stages(extractor, stage_timings):
+    """Ejecuta las etapas del pipeline sobre la acta sintética registrando su duración"""
+    from algorithms.synthetic import encode_synthetic_ballot
+    from algorithms.decoding import decode_image, decode_for_validation, pack_binary_image, unpack_binary_image
+    from algorithms.processing import check_if_ballot, preprocess_image, normalize_page, ANTHROPIC_MAX_DIMENSION
+    from algorithms.template_matching import identify_acta_structure
+    from algorithms.mosaic import build_field_mosaic
+    from algorithms.memory import get_buffer_pool
+
+    def timed(stage, function, *args, **kwargs):
+        stage_started = time.monotonic()
+        result = function(*args, **kwargs)
+        stage_timings[stage] = round(time.monotonic() - stage_started, 3)
+        metrics_registry.set_gauge('warmup_stage_seconds', stage_timings[stage], stage=stage)
+        return result
+
+    ballot = encode_synthetic_ballot()
+
+    # 1. Validación: decodificación reducida y detección de la acta
+    gray = timed('decode', decode_for_validation, ballot)
+    timed('validation', check_if_ballot, gray)
+
+    # 2. Preprocesamiento y empaquetado de la imagen para OCR
+    image = decode_image(ballot, min_long_side=ANTHROPIC_MAX_DIMENSION)
+    binary = timed('preprocess', preprocess_image, image, get_buffer_pool())
+    timed('packbits', lambda: unpack_binary_image(pack_binary_image(binary)))
+
+    # 3. Extracción OCR completa (inicializa Tesseract)
+    timed('ocr', extractor.extract_data, ballot)
+
+    # 4. Mosaico del fallback (sin llamar a Anthropic)
+    page = normalize_page(image)
+    roi_map = identify_acta_structure(page)
+    timed('mosaic', build_field_mosaic, page, roi_map, list(roi_map)[:3])
+
+def mark_ready():
+    readiness['ready'] = True
+    readiness['startupSeconds'] = process_uptime_seconds()
+    metrics_registry.set_gauge('startup_seconds', readiness['startupSeconds'])
+
+def record_first_request(stage, seconds):
+    """Registra la latencia del primer mensaje de cada etapa del proceso"""
+    if stage in _first_requests:
+        return
+    _first_requests.add(stage)
+    readiness['firstRequests'][stage] = round(seconds, 3)
+    metrics_registry.set_gauge('first_request_seconds', seconds, stage=stage)
+    logger.info(f"Primer mensaje de {stage} atendido en {seconds:.2f}s")
@@ -2,15 +2,30 @@
 import pika
 import json
 import base64
-import numpy as np
 import cv2
 import traceback
 import os
 import time
 import threading
 import logging
-from algorithms.extractor import BallotExtractor
-from algorithms.processing import check_if_ballot, preprocess_image, preprocess_image_for_anthropic
+import functools
+import signal
+from algorithms.extractor import BallotExtractor, StagedImage
+from algorithms.processing import check_if_ballot, preprocess_image_for_anthropic, normalize_page, ANTHROPIC_MAX_DIMENSION
+from algorithms.template_matching import identify_acta_structure
+from algorithms.data_extraction import uncertain_fields, merge_field_values, OCR_EXTRACTION_MODE
+from algorithms.mosaic import build_field_mosaic
+from algorithms.decoding import decode_image, decode_for_validation, sniff_image_header, pack_binary_image
+from algorithms.results import BallotResult, BallotResults
+from algorithms.quality import QUALITY_GATE_ENABLED, assess_image_quality, quality_reason
+from algorithms.near_duplicates import NEAR_DUPLICATE_MODE, dhash, content_signature, format_hash, find_near_duplicate, get_near_duplicate_index
+from algorithms.stage_cache import get_stage_cache
+from algorithms.memory import ImageTooLargeError, RssTracker, get_buffer_pool
+from metrics import registry as metrics_registry
+import profiling
+from retries import TransientError, declare_retry_queues, is_transient_error, retry_or_dead_letter
+import warmup
+from lanes import LaneScheduler, QUEUE_MAX_PRIORITY, lane_properties, message_lane, queue_wait_seconds
 
 # Configurar logging
 logging.basicConfig(
@@ -31,14 +46,113 @@ IMAGE_PROCESSING_QUEUE = os.environ.get('IMAGE_PROCESSING_QUEUE', 'image_process
 OCR_PROCESSING_QUEUE = os.environ.get('OCR_PROCESSING_QUEUE', 'ocr_processing_queue')
 ANTHROPIC_FALLBACK_QUEUE = os.environ.get('ANTHROPIC_FALLBACK_QUEUE', 'anthropic_fallback_queue')
 RESULTS_QUEUE = os.environ.get('RESULTS_QUEUE', 'results_queue')
+ANTHROPIC_BATCH_QUEUE = os.environ.get('ANTHROPIC_BATCH_QUEUE', 'anthropic_batch_queue')
+ANTHROPIC_BATCH_WAIT_QUEUE = f"{ANTHROPIC_BATCH_QUEUE}.wait"
+ANTHROPIC_PARKING_QUEUE = f"{ANTHROPIC_FALLBACK_QUEUE}.parking"
 
-# Inicializar extractor
-ballot_extractor = BallotExtractor()
+# Codificación de la imagen procesada enviada a OCR: 'packbits' (sin pérdida, 1 bit
+# por píxel) o 'jpeg' (formato anterior). El consumidor acepta ambas. En modo
+# 'roi' se envía la página alineada en gris, en PNG (sin pérdida) o en JPEG
+# si se elige 'jpeg'
+PROCESSED_IMAGE_ENCODING = os.environ.get('PROCESSED_IMAGE_ENCODING', 'packbits').lower()
+
+# Fallback por mosaico: enviar a Anthropic solo las casillas dudosas cuando son
+# como máximo ANTHROPIC_MOSAIC_MAX_FIELDS; si hay más se envía la página completa
+ANTHROPIC_MOSAIC_MODE = os.environ.get('ANTHROPIC_MOSAIC_MODE', 'true').lower() == 'true'
+ANTHROPIC_MOSAIC_MAX_FIELDS = int(os.environ.get('ANTHROPIC_MOSAIC_MAX_FIELDS', '6'))
+
+# Modo por lotes del fallback: con ANTHROPIC_BATCH_THRESHOLD o más mensajes en
+# la cola de fallback (0 lo desactiva) los trabajos se envían en lotes de hasta
+# ANTHROPIC_BATCH_SIZE mediante la API de lotes, consultando su estado cada
+# ANTHROPIC_BATCH_POLL_SECONDS
+ANTHROPIC_BATCH_THRESHOLD = int(os.environ.get('ANTHROPIC_BATCH_THRESHOLD', '200'))
+ANTHROPIC_BATCH_SIZE = int(os.environ.get('ANTHROPIC_BATCH_SIZE', '100'))
+ANTHROPIC_BATCH_POLL_SECONDS = int(os.environ.get('ANTHROPIC_BATCH_POLL_SECONDS', '60'))
+ANTHROPIC_BATCH_CHECK_SECONDS = float(os.environ.get('ANTHROPIC_BATCH_CHECK_SECONDS', '10'))
+
+# Consultas máximas de un lote antes de darlo por perdido (la API termina o
+# expira los lotes en 24 horas; el valor por defecto cubre 25 horas a 60s)
+ANTHROPIC_BATCH_MAX_POLLS = int(os.environ.get('ANTHROPIC_BATCH_MAX_POLLS', '1500'))
+
+# 'split': la validación publica la página procesada en la cola de OCR, que
+# puede escalarse por separado. 'fused': el mismo consumidor valida y extrae
+# en memoria y publica solo en 'results' o 'anthropic_fallback'
+PIPELINE_MODE = os.environ.get('PIPELINE_MODE', 'split').lower()
+
+# Colas que consume este proceso: 'validation', 'ocr', 'fallback' y/o 'batch'
+# separadas por comas (por defecto todas). El supervisor lanza un proceso por cola
+WORKER_QUEUES = [
+    name.strip() for name in os.environ.get('WORKER_QUEUES', 'validation,ocr,fallback,batch').split(',') if name.strip()
+]
+
+# Reparto ponderado por carriles (ver lanes.py): cada consumidor recibe hasta
+# LANE_PREFETCH mensajes que el worker atiende según el peso de su carril.
+# Con LANE_SCHEDULING=false se atienden en orden de llegada, de uno en uno
+LANE_SCHEDULING = os.environ.get('LANE_SCHEDULING', 'true').lower() == 'true'
+LANE_PREFETCH = int(os.environ.get('LANE_PREFETCH', '4'))
+
+# Mientras el circuito de Anthropic está abierto
+# los mensajes de fallback esperan ANTHROPIC_PARK_SECONDS en la cola de
+# aparcamiento, hasta ANTHROPIC_MAX_PARKS veces antes de ir a la DLQ
+ANTHROPIC_PARK_SECONDS = int(os.environ.get('ANTHROPIC_PARK_SECONDS', '30'))
+ANTHROPIC_MAX_PARKS = int(os.environ.get('ANTHROPIC_MAX_PARKS', '40'))
+
+# Estado del modo de fallback (interactivo o por lotes)
+_fallback_mode = {'checkedAt': 0.0, 'batch': False}
+
+# Extractor compartido, creado al primer uso (importar el módulo no inicializa nada)
+_ballot_extractor = None
+
+def get_ballot_extractor():
+    global _ballot_extractor
+    if _ballot_extractor is None:
+        _ballot_extractor = BallotExtractor()
+    return _ballot_extractor
 
 # Variables globales para RabbitMQ
 connection = None
 channel = None
 
+# Se activa con SIGTERM/SIGINT: terminar los mensajes en curso y salir
+stop_requested = threading.Event()
+
+def encode_processed_image(processed_img, kind='binary'):
+    """Codifica para la cola de OCR la página alineada en gris (kind='page')
+    o la binarizada (kind='binary')
+    """
+    if kind == 'binary' and PROCESSED_IMAGE_ENCODING == 'packbits':
+        return pack_binary_image(processed_img)
+    if kind == 'page' and PROCESSED_IMAGE_ENCODING != 'jpeg':
+        _, buffer = cv2.imencode('.png', processed_img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return buffer.tobytes()
+    _, buffer = cv2.imencode('.jpg', processed_img)
+    return buffer.tobytes()
+
+def declare_work_queue(queue_name, with_priority=True):
+    """Declara una cola con su DLQ, y con prioridades si se solicita.
+
+    Una cola ya existente sin x-max-priority no puede redeclararse con otros
+    argumentos (PRECONDITION_FAILED): en ese caso se mantiene sin prioridades
+    hasta que se elimine y se vuelva a crear.
+    """
+    global channel
+    arguments = {
+        'x-dead-letter-exchange': 'dlx',
+        'x-dead-letter-routing-key': f"{queue_name}.dlq"
+    }
+    if with_priority and QUEUE_MAX_PRIORITY:
+        try:
+            channel.queue_declare(queue=queue_name, durable=True,
+                arguments={**arguments, 'x-max-priority': QUEUE_MAX_PRIORITY})
+            return
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code != 406:
+                raise
+            logger.warning(f"La cola {queue_name} ya existe sin prioridades; se usa sin carriles en el broker")
+            # El broker cierra el canal al rechazar la declaración
+            channel = connection.channel()
+    channel.queue_declare(queue=queue_name, durable=True, arguments=arguments)
+
 def connect_to_rabbitmq():
     """Establece conexión con RabbitMQ"""
     global connection, channel
@@ -67,14 +181,9 @@ def connect_to_rabbitmq():
         # Declarar DLX
         channel.exchange_declare(exchange='dlx', exchange_type='direct', durable=True)
 
-        # Declarar colas
+        # Declarar colas (las de procesamiento con prioridades por carril)
         for queue_name in [IMAGE_PROCESSING_QUEUE, OCR_PROCESSING_QUEUE, ANTHROPIC_FALLBACK_QUEUE, RESULTS_QUEUE]:
-            channel.queue_declare(queue=queue_name, durable=True,
-                arguments={
-                    'x-dead-letter-exchange': 'dlx',
-                    'x-dead-letter-routing-key': f"{queue_name}.dlq"
-                }
-            )
+            declare_work_queue(queue_name, with_priority=queue_name != RESULTS_QUEUE)
             
             # Declarar DLQ correspondiente
             channel.queue_declare(queue=f"{queue_name}.dlq", durable=True)
@@ -86,10 +195,47 @@ def connect_to_rabbitmq():
                 routing_key=f"{queue_name}.dlq"
             )
 
+        # Niveles de reintento con espera creciente de las colas de procesamiento
+        for queue_name in [IMAGE_PROCESSING_QUEUE, OCR_PROCESSING_QUEUE, ANTHROPIC_FALLBACK_QUEUE]:
+            declare_retry_queues(channel, queue_name)
+
+        # Seguimiento de lotes de Anthropic: la cola de espera devuelve cada
+        # mensaje a la cola de lotes cuando vence su TTL (intervalo de consulta)
+        channel.queue_declare(queue=ANTHROPIC_BATCH_QUEUE, durable=True,
+            arguments={
+                'x-dead-letter-exchange': 'dlx',
+                'x-dead-letter-routing-key': f"{ANTHROPIC_BATCH_QUEUE}.dlq"
+            }
+        )
+        channel.queue_declare(queue=f"{ANTHROPIC_BATCH_QUEUE}.dlq", durable=True)
+        channel.queue_bind(
+            queue=f"{ANTHROPIC_BATCH_QUEUE}.dlq",
+            exchange='dlx',
+            routing_key=f"{ANTHROPIC_BATCH_QUEUE}.dlq"
+        )
+        channel.queue_declare(queue=ANTHROPIC_BATCH_WAIT_QUEUE, durable=True,
+            arguments={
+                'x-message-ttl': ANTHROPIC_BATCH_POLL_SECONDS * 1000,
+                'x-dead-letter-exchange': BALLOT_PROCESSING_EXCHANGE,
+                'x-dead-letter-routing-key': 'anthropic_batch'
+            }
+        )
+
+        # Aparcamiento del fallback: al vencer el TTL el mensaje vuelve a la
+        # cola de fallback a través del exchange principal
+        channel.queue_declare(queue=ANTHROPIC_PARKING_QUEUE, durable=True,
+            arguments={
+                'x-message-ttl': ANTHROPIC_PARK_SECONDS * 1000,
+                'x-dead-letter-exchange': BALLOT_PROCESSING_EXCHANGE,
+                'x-dead-letter-routing-key': 'anthropic_fallback'
+            }
+        )
+
         bindings = {
             IMAGE_PROCESSING_QUEUE: 'image_processing',
             OCR_PROCESSING_QUEUE: 'ocr_processing',
             ANTHROPIC_FALLBACK_QUEUE: 'anthropic_fallback',
+            ANTHROPIC_BATCH_QUEUE: 'anthropic_batch',
             RESULTS_QUEUE: 'results'  # Este es el binding crítico que falta
         }
 
@@ -117,31 +263,99 @@ def process_image_validation(ch, method, properties, body):
         image_base64 = message.get('imageBuffer')
         
         logger.info(f"Procesando validación de acta: {ballot_id}")
+        rss = RssTracker()
         
         # Decodificar imagen desde base64
         image_data = base64.b64decode(image_base64)
-        img_array = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+        header = sniff_image_header(image_data)
+        if header is not None:
+            logger.info(f"Cabecera de imagen: formato={header[0]}, {header[1]}x{header[2]}")
+        
+        # 1. Decodificar en gris a escala reducida, suficiente para validación.
+        # Las imágenes que exceden el presupuesto de píxeles se rechazan aquí
+        oversize_reason = None
+        try:
+            gray = decode_for_validation(image_data)
+        except ImageTooLargeError as size_error:
+            gray, oversize_reason = None, str(size_error)
         
-        if img is None:
+        if gray is None and oversize_reason is None:
             raise ValueError("No se pudo decodificar la imagen")
+        rss.sample('decode')
         
-        # 1. Generar hash para identificación única
+        # 2. Generar hash para identificación única
         import hashlib
         image_hash = hashlib.sha256(image_data).hexdigest()
         
-        # 2. Convertir a escala de grises para validación
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # 3. Control de calidad sobre una miniatura: las fotos borrosas, mal
+        # expuestas o mal encuadradas se rechazan antes de todo el pipeline
+        quality = assess_image_quality(gray) if QUALITY_GATE_ENABLED and gray is not None else None
+        if quality is not None and not quality['passed']:
+            for issue in quality['issues']:
+                metrics_registry.inc('quality_rejections_total', issue=issue['code'])
         
-        # 3. Validar si es un acta electoral (usando imagen en gris sin procesar mucho)
-        is_valid, confidence, reason = check_if_ballot(gray)
+        # 4. Validar si es un acta electoral (usando imagen en gris sin procesar mucho)
+        if oversize_reason:
+            is_valid, confidence, reason = False, 0.0, oversize_reason
+        elif quality is not None and not quality['passed']:
+            is_valid, confidence, reason = False, 0.0, quality_reason(quality)
+        else:
+            is_valid, confidence, reason = check_if_ballot(gray)
+        # Liberar cada intermedio en cuanto termina su etapa
+        del gray
+        rss.sample('validation')
         
         if is_valid:
             # Si es válida, publicar a la cola de OCR
             # IMPORTANTE: Mantener tanto la imagen original como la procesada
-            processed_img = preprocess_image(img)
-            _, buffer = cv2.imencode('.jpg', processed_img)
-            processed_image_base64 = base64.b64encode(buffer).decode('utf-8')
+            # Solo ahora se decodifica a resolución completa (en gris, que es
+            # lo que usa preprocess_image). Con la caché de etapas, un mensaje
+            # reentregado (worker caído) o reprocesado reutiliza la página ya
+            # filtrada sin decodificar de nuevo
+            staged = StagedImage(image_data, image_hash, get_stage_cache())
+            del image_data
+            # En modo 'roi' el OCR filtra solo las celdas: se le envía la página
+            # alineada en gris, sin filtrar ni binarizar la página completa
+            processed_kind = 'page' if OCR_EXTRACTION_MODE == 'roi' else 'binary'
+            if processed_kind == 'page':
+                processed_img = staged.page()
+            else:
+                processed_img = staged.binary(get_buffer_pool())
+            orientation = staged.orientation()
+            
+            # 5. Buscar actas casi idénticas ya recibidas (misma foto recomprimida
+            # o repetida), comparando la página ya alineada
+            duplicate_fields = {}
+            if NEAR_DUPLICATE_MODE != 'off':
+                duplicate_fields = check_near_duplicate(ballot_id, staged.page())
+                if reuse_near_duplicate(ballot_id, duplicate_fields):
+                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    return
+            if orientation and orientation['rotation']:
+                logger.info(f"Acta {ballot_id} enderezada {orientation['rotation']}° (confianza {orientation['confidence']:.2f})")
+                metrics_registry.inc('page_rotations_total', rotation=str(orientation['rotation']))
+            carried = {**near_duplicate_fields(duplicate_fields), **orientation_fields(orientation)}
+            rss.sample('preprocess')
+            
+            if PIPELINE_MODE == 'fused':
+                # Modo fusionado: la extracción sigue en este proceso sobre las
+                # mismas etapas ya calculadas (en modo 'roi' la página alineada,
+                # sin binarizar la página completa), sin pasar por la cola de OCR
+                del processed_img
+                extraction_result = get_ballot_extractor().extract_staged(staged, quality_gate=False)
+                del staged
+                rss.sample('ocr')
+                route_extraction_result(ballot_id, extraction_result, image_base64, carried, properties)
+                logger.info(f"Acta {ballot_id} validada (confianza: {confidence:.2f}) y extraída en el mismo proceso")
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                rss.report(metrics_registry, 'validation')
+                return
+            
+            del staged
+            processed_payload = encode_processed_image(processed_img, processed_kind)
+            del processed_img
+            processed_image_base64 = base64.b64encode(processed_payload).decode('utf-8')
+            del processed_payload
             
             channel.basic_publish(
                 exchange=BALLOT_PROCESSING_EXCHANGE,
@@ -150,13 +364,13 @@ def process_image_validation(ch, method, properties, body):
                     'ballotId': ballot_id,
                     'imageHash': image_hash,
                     'processedImageBuffer': processed_image_base64,
+                    'processedImageKind': processed_kind,
                     'originalImageBuffer': image_base64,  # Mantener imagen original
-                    'validationConfidence': confidence
+                    'validationConfidence': confidence,
+                    **carried
                 }),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Mensaje persistente
-                    content_type='application/json'
-                )
+                # Mensaje persistente en el mismo carril que la subida
+                properties=lane_properties(message_lane(properties), content_type='application/json')
             )
             
             logger.info(f"Acta {ballot_id} validada (confianza: {confidence:.2f}) y enviada a OCR")
@@ -169,7 +383,8 @@ def process_image_validation(ch, method, properties, body):
                     'ballotId': ballot_id,
                     'status': 'REJECTED',
                     'reason': reason,
-                    'confidence': confidence
+                    'confidence': confidence,
+                    **quality_fields(quality)
                 }),
                 properties=pika.BasicProperties(
                     delivery_mode=2,
@@ -181,10 +396,105 @@ def process_image_validation(ch, method, properties, body):
         
         # Confirmar procesamiento
         ch.basic_ack(delivery_tag=method.delivery_tag)
+        rss.sample('publish')
+        rss.report(metrics_registry, 'validation')
+        logger.info(f"Pico de memoria para acta {ballot_id}: {rss.peak / (1024 * 1024):.1f} MB")
     except Exception as e:
         logger.error(f"Error procesando validación: {str(e)}")
-        # Rechazar mensaje y enviar a DLQ
-        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+        # Reintentar si el fallo es transitorio; si no, enviar a DLQ
+        retry_or_dead_letter(ch, method, properties, body, IMAGE_PROCESSING_QUEUE, e)
+
+def quality_fields(quality):
+    """Detalle del control de calidad para un rechazo, si fue la causa"""
+    if quality is None or quality['passed']:
+        return {}
+    return {'qualityIssues': quality['issues'], 'qualityMetrics': quality['metrics']}
+
+def check_near_duplicate(ballot_id, page):
+    """Registra el hash perceptual de la página alineada y busca una acta
+    previa casi idéntica, confirmada por la tinta de las celdas que lee el OCR.
+
+    Devuelve los campos que acompañan a la acta por el pipeline: su hash y,
+    si la hay, la acta original (con su resultado si ya se conoce).
+    """
+    perceptual_hash = dhash(page)
+    signature = content_signature(page, identify_acta_structure(page))
+    index = get_near_duplicate_index()
+    near_duplicate = find_near_duplicate(index, perceptual_hash, ballot_id, signature)
+    index.add(perceptual_hash, ballot_id, signature=signature)
+    
+    fields = {'perceptualHash': format_hash(perceptual_hash)}
+    if near_duplicate:
+        logger.info(f"Acta {ballot_id} casi idéntica a {near_duplicate['ballotId']} (distancia {near_duplicate['distance']})")
+        metrics_registry.inc('near_duplicates_total')
+        fields['nearDuplicateOf'] = near_duplicate
+    return fields
+
+def reuse_near_duplicate(ballot_id, duplicate_fields):
+    """En modo 'reuse', publica el resultado de la acta original sin repetir
+    OCR ni fallback. Devuelve False si no hay resultado que reutilizar.
+    """
+    near_duplicate = duplicate_fields.get('nearDuplicateOf')
+    if NEAR_DUPLICATE_MODE != 'reuse' or not near_duplicate or not near_duplicate.get('result'):
+        return False
+    
+    prior = near_duplicate['result']
+    result = BallotResult(
+        ballot_id,
+        BallotResults.from_dict(prior['results']),
+        prior['confidence'],
+        'near_duplicate',
+        prior['needsHumanVerification'],
+        {
+            'perceptualHash': duplicate_fields['perceptualHash'],
+            'nearDuplicateOf': {'ballotId': near_duplicate['ballotId'], 'distance': near_duplicate['distance']}
+        }
+    )
+    channel.basic_publish(
+        exchange=BALLOT_PROCESSING_EXCHANGE,
+        routing_key='results',
+        body=result.to_json(),
+        properties=pika.BasicProperties(delivery_mode=2)
+    )
+    metrics_registry.inc('near_duplicates_reused_total')
+    logger.info(f"Acta {ballot_id}: reutilizado el resultado de {near_duplicate['ballotId']}")
+    return True
+
+def near_duplicate_fields(message):
+    """Campos de casi-duplicado que viajan con la acta hasta el resultado final"""
+    fields = {key: message[key] for key in ('perceptualHash', 'nearDuplicateOf') if message.get(key)}
+    if 'nearDuplicateOf' in fields:
+        # El resultado de la acta original no se reenvía en cada etapa
+        fields['nearDuplicateOf'] = {
+            key: value for key, value in fields['nearDuplicateOf'].items() if key != 'result'
+        }
+    return fields
+
+def orientation_fields(orientation):
+    """Rotación aplicada a la página (StagedImage.orientation), si se conoce"""
+    return {'pageRotation': orientation['rotation']} if orientation else {}
+
+def carried_fields(message):
+    """Campos que viajan con la acta de una etapa a otra hasta el resultado final"""
+    fields = near_duplicate_fields(message)
+    if message.get('pageRotation') is not None:
+        fields['pageRotation'] = message['pageRotation']
+    return fields
+
+def remember_result(result):
+    """En modo 'reuse', guarda el resultado final junto al hash perceptual de la acta"""
+    perceptual_hash = result.extra.get('perceptualHash')
+    if NEAR_DUPLICATE_MODE != 'reuse' or not perceptual_hash:
+        return
+    get_near_duplicate_index().add(
+        int(perceptual_hash, 16),
+        result.ballot_id,
+        {
+            'results': result.results.to_dict(),
+            'confidence': result.confidence,
+            'needsHumanVerification': result.needs_human_verification
+        }
+    )
 
 def process_ocr_extraction(ch, method, properties, body):
     """Procesa un mensaje de extracción OCR"""
@@ -200,189 +510,419 @@ def process_ocr_extraction(ch, method, properties, body):
         # Decodificar imagen procesada
         image_data = base64.b64decode(processed_image_base64)
         
-        # Iniciar extracción de datos
-        extraction_result = ballot_extractor.extract_data(image_data)
-        
-        # IMPORTANTE: Convertir tipos NumPy a tipos nativos de Python
-        def numpy_to_python(obj):
-            if isinstance(obj, dict):
-                return {k: numpy_to_python(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [numpy_to_python(item) for item in obj]
-            elif isinstance(obj, (np.integer, np.int64, np.int32, np.int16, np.int8)):
-                return int(obj)
-            elif isinstance(obj, (np.floating, np.float64, np.float32)):
-                return float(obj)
-            elif isinstance(obj, (np.bool_, np.bool)):
-                return bool(obj)
-            elif isinstance(obj, np.ndarray):
-                return numpy_to_python(obj.tolist())
-            else:
-                return obj
-        
-        # Convertir el resultado completo
-        extraction_result = numpy_to_python(extraction_result)
-        
-        if not extraction_result['success']:
-            logger.error(f"Error en extracción: {extraction_result.get('errorMessage', 'Desconocido')}")
-            # Enviar a anthropic si falla la extracción local
-            channel.basic_publish(
-                exchange=BALLOT_PROCESSING_EXCHANGE,
-                routing_key='anthropic_fallback',
-                body=json.dumps({
-                    'ballotId': ballot_id,
-                    'imageBuffer': original_image_base64,  # Usar imagen original para Anthropic
-                    'error': extraction_result.get('errorMessage', 'Error en extracción')
-                }),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-        elif extraction_result['confidence'] < 0.8 and 'anthropic' not in extraction_result.get('source', ''):
-            # Si la confianza es baja y no viene de Anthropic, enviar a fallback
-            logger.info(f"Baja confianza en extracción ({extraction_result['confidence']:.2f}), enviando a Anthropic")
-            channel.basic_publish(
-                exchange=BALLOT_PROCESSING_EXCHANGE,
-                routing_key='anthropic_fallback',
-                body=json.dumps({
-                    'ballotId': ballot_id,
-                    'imageBuffer': original_image_base64,  # Usar imagen original para Anthropic
-                    'ocrResult': extraction_result
-                }),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
+        # Iniciar extracción de datos (la calidad ya se controló en la validación)
+        if message.get('processedImageKind') == 'page':
+            # Página alineada en gris: el OCR filtra y binariza solo las celdas
+            page = decode_image(image_data, grayscale=True)
+            if page is None:
+                raise ValueError("No se pudo decodificar la página")
+            staged = StagedImage.from_page(page, message.get('imageHash'), get_stage_cache())
+            extraction_result = get_ballot_extractor().extract_staged(staged, quality_gate=False)
         else:
-            # Enviar resultados finales
-            logger.info(f"Extracción completada con éxito (fuente: {extraction_result.get('source', 'ocr')})")
-            channel.basic_publish(
-                exchange=BALLOT_PROCESSING_EXCHANGE,
-                routing_key='results',
-                body=json.dumps({
-                    'ballotId': ballot_id,
-                    'status': 'COMPLETED',
-                    'results': {
-                        'tableCode': extraction_result['results'].get('tableCode', ''),
-                        'tableNumber': extraction_result['results'].get('tableNumber', ''),
-                        'votes': extraction_result['results'].get('votes', {}),
-                        'location': extraction_result['results'].get('location', {
-                            'department': '',
-                            'province': '',
-                            'municipality': '',
-                            'locality': '',
-                            'pollingPlace': ''
-                        }),
-                    },
-                    'confidence': extraction_result['confidence'],
-                    'source': extraction_result.get('source', 'ocr'),
-                    'needsHumanVerification': extraction_result.get('needsHumanVerification', extraction_result['confidence'] < 0.7)
-                }),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
+            # Página binarizada (modo 'full' o mensajes anteriores al cambio)
+            extraction_result = get_ballot_extractor().extract_data(image_data, quality_gate=False)
+        
+        route_extraction_result(ballot_id, extraction_result, original_image_base64,
+                                carried_fields(message), properties)
 
         # Confirmar procesamiento
         ch.basic_ack(delivery_tag=method.delivery_tag)
     except Exception as e:
         logger.error(f"Error en procesamiento OCR: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
-        # Rechazar mensaje
-        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+        # Reintentar si el fallo es transitorio; si no, enviar a DLQ
+        retry_or_dead_letter(ch, method, properties, body, OCR_PROCESSING_QUEUE, e)
+
+def route_extraction_result(ballot_id, extraction_result, original_image_base64, extra_fields, properties):
+    """Publica el resultado del OCR local en 'results', o la acta en
+    'anthropic_fallback' si la extracción falló o su confianza es baja
+    """
+    if not extraction_result['success']:
+        logger.error(f"Error en extracción: {extraction_result.get('errorMessage', 'Desconocido')}")
+        # Enviar a anthropic si falla la extracción local
+        channel.basic_publish(
+            exchange=BALLOT_PROCESSING_EXCHANGE,
+            routing_key='anthropic_fallback',
+            body=json.dumps({
+                'ballotId': ballot_id,
+                'imageBuffer': original_image_base64,  # Usar imagen original para Anthropic
+                'error': extraction_result.get('errorMessage', 'Error en extracción'),
+                **extra_fields
+            }),
+            properties=lane_properties(message_lane(properties))
+        )
+    elif extraction_result['confidence'] < 0.8 and 'anthropic' not in extraction_result.get('source', ''):
+        # Si la confianza es baja y no viene de Anthropic, enviar a fallback
+        logger.info(f"Baja confianza en extracción ({extraction_result['confidence']:.2f}), enviando a Anthropic")
+        channel.basic_publish(
+            exchange=BALLOT_PROCESSING_EXCHANGE,
+            routing_key='anthropic_fallback',
+            body=json.dumps({
+                'ballotId': ballot_id,
+                'imageBuffer': original_image_base64,  # Usar imagen original para Anthropic
+                'ocrResult': extraction_result,
+                **extra_fields
+            }),
+            properties=lane_properties(message_lane(properties))
+        )
+    else:
+        # Enviar resultados finales
+        logger.info(f"Extracción completada con éxito (fuente: {extraction_result.get('source', 'ocr')})")
+        result = BallotResult.from_extraction(ballot_id, extraction_result, 'ocr', extra_fields)
+        channel.basic_publish(
+            exchange=BALLOT_PROCESSING_EXCHANGE,
+            routing_key='results',
+            body=result.to_json(),
+            properties=pika.BasicProperties(delivery_mode=2)
+        )
+        remember_result(result)
 
 def process_anthropic_fallback(ch, method, properties, body):
     """Procesa un mensaje de fallback a Anthropic"""
     try:
+        from algorithms.anthropic_fallback import AnthropicExtractor, ANTHROPIC_CALLER
+        
+        # Con el circuito abierto no tiene sentido llamar al servicio
+        if ANTHROPIC_CALLER.breaker.is_open():
+            park_fallback_message(ch, method, properties, body, 'circuito abierto')
+            return
+        
+        # Con la cola acumulada, agrupar los trabajos en un lote
+        if fallback_backlog_mode(ch):
+            drain_fallback_batch(ch, method, body)
+            return
+        
         message = json.loads(body)
         ballot_id = message.get('ballotId')
-        image_base64 = message.get('imageBuffer')
         
         logger.info(f"Procesando fallback Anthropic para acta: {ballot_id}")
         
-        # Decodificar imagen original
-        image_data = base64.b64decode(image_base64)
-        img_array = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+        img = decode_fallback_image(message)
         
-        # Aplicar preprocesamiento mínimo para Anthropic
-        from algorithms.processing import preprocess_image_for_anthropic
-        img_for_anthropic = preprocess_image_for_anthropic(img)
+        extractor = AnthropicExtractor()
         
-        # Codificar imagen procesada minimamente
-        _, buffer = cv2.imencode('.jpg', img_for_anthropic, [cv2.IMWRITE_JPEG_QUALITY, 95])
-        processed_image_data = buffer.tobytes()
+        # Si el OCR local dejó pocas casillas dudosas, consultar solo esas
+        result = None
+        ocr_result = message.get('ocrResult')
+        if ANTHROPIC_MOSAIC_MODE and ocr_result:
+            result = extract_uncertain_fields(extractor, img, ocr_result)
         
-        # Usar el fallback de Anthropic con imagen mínimamente procesada
-        from algorithms.anthropic_fallback import AnthropicExtractor
-        extractor = AnthropicExtractor()
-        result = extractor.extract_data_from_image(processed_image_data)
-        
-        # Convertir tipos NumPy a tipos Python nativos
-        def numpy_to_python(obj):
-            if isinstance(obj, dict):
-                return {k: numpy_to_python(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [numpy_to_python(item) for item in obj]
-            elif isinstance(obj, (np.integer, np.int64, np.int32, np.int16, np.int8)):
-                return int(obj)
-            elif isinstance(obj, (np.floating, np.float64, np.float32)):
-                return float(obj)
-            elif isinstance(obj, (np.bool_, np.bool)):
-                return bool(obj)
-            elif isinstance(obj, np.ndarray):
-                return numpy_to_python(obj.tolist())
-            else:
-                return obj
+        if result is None:
+            # Usar el fallback de Anthropic con imagen mínimamente procesada
+            result = extractor.extract_data_from_image(encode_page_for_anthropic(img))
         
-        result = numpy_to_python(result)
-        print(result['results'])
+        # Circuito semiabierto con la prueba en curso: se aparca como con el
+        # circuito abierto, sin gastar los niveles de reintento
+        if result.get('circuitOpen'):
+            park_fallback_message(ch, method, properties, body, 'circuito semiabierto')
+            return
         
-        if 'results' in result and result['results']:
-            # Enviar resultados finales
-            channel.basic_publish(
-                exchange=BALLOT_PROCESSING_EXCHANGE,
-                routing_key='results',
-                body=json.dumps({
-                    'ballotId': ballot_id,
-                    'status': 'COMPLETED',
-                    'results': {
-                        'tableCode': result['results'].get('tableCode', ''),
-                        'tableNumber': result['results']['tableNumber'],
-                        'votes': result['results']['votes'],
-                        'location': result['results'].get('location', {
-                            'department': '',
-                            'province': '',
-                            'municipality': '',
-                            'locality': '',
-                            'pollingPlace': ''
-                        }),
-                    },
-                    'confidence': result['confidence'],
-                    'source': 'anthropic',
-                    'needsHumanVerification': result.get('needsHumanVerification', result['confidence'] < 0.7)
-                }),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            logger.info(f"Extracción Anthropic completada con éxito")
+        # Fallo del servicio (no de la acta): reintentar con espera creciente
+        if result.get('retryable'):
+            raise TransientError(result.get('error'))
+        
+        if publish_fallback_result(ballot_id, result, carried_fields(message)):
             # Confirmar solo si tuvimos éxito
             ch.basic_ack(delivery_tag=method.delivery_tag)
         else:
-            # Si falló Anthropic, informar error y rechazar mensaje para enviarlo a DLQ
-            channel.basic_publish(
-                exchange=BALLOT_PROCESSING_EXCHANGE,
-                routing_key='results',
-                body=json.dumps({
-                    'ballotId': ballot_id,
-                    'status': 'EXTRACTION_FAILED',
-                    'error': result.get('error', 'Error en extracción Anthropic'),
-                    'source': 'anthropic_error'
-                }),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            logger.error(f"Error en extracción Anthropic: {result.get('error', 'Desconocido')}")
             # CAMBIO: Rechazamos el mensaje para enviarlo a DLQ
             ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
         
     except Exception as e:
         logger.error(f"Error en fallback Anthropic: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
-        # Rechazar mensaje
+        # Reintentar si el fallo es transitorio; si no, enviar a DLQ
+        retry_or_dead_letter(ch, method, properties, body, ANTHROPIC_FALLBACK_QUEUE, e)
+
+def park_fallback_message(ch, method, properties, body, reason):
+    """Aparca un mensaje de fallback mientras Anthropic no está disponible.
+
+    El número de aparcamientos viaja en la cabecera x-park-count; al superar
+    ANTHROPIC_MAX_PARKS se informa el fallo y el mensaje va a la DLQ.
+    """
+    headers = dict((properties.headers if properties else None) or {})
+    parks = int(headers.get('x-park-count', 0)) + 1
+    
+    if parks > ANTHROPIC_MAX_PARKS:
+        logger.error(f"Fallback aparcado {parks - 1} veces, enviando a DLQ: {reason}")
+        ballot_id = json.loads(body).get('ballotId')
+        publish_fallback_result(ballot_id, {'results': None, 'error': f"Anthropic no disponible: {reason}"})
         ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+        return
+    
+    headers['x-park-count'] = parks
+    ch.basic_publish(
+        exchange='',
+        routing_key=ANTHROPIC_PARKING_QUEUE,
+        body=body,
+        properties=lane_properties(message_lane(properties), headers)
+    )
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    metrics_registry.inc('fallback_parked_total')
+    logger.warning(f"Fallback aparcado ({parks}/{ANTHROPIC_MAX_PARKS}): {reason}")
+
+def publish_fallback_result(ballot_id, result, extra_fields=None):
+    """Publica el resultado de Anthropic en 'results'. Devuelve True si hubo extracción"""
+    if 'results' in result and result['results']:
+        # Enviar resultados finales
+        ballot_result = BallotResult.from_extraction(ballot_id, result, 'anthropic', extra_fields)
+        channel.basic_publish(
+            exchange=BALLOT_PROCESSING_EXCHANGE,
+            routing_key='results',
+            body=ballot_result.to_json(),
+            properties=pika.BasicProperties(delivery_mode=2)
+        )
+        remember_result(ballot_result)
+        logger.info(f"Extracción Anthropic completada con éxito")
+        return True
+    
+    # Si falló Anthropic, informar error
+    channel.basic_publish(
+        exchange=BALLOT_PROCESSING_EXCHANGE,
+        routing_key='results',
+        body=json.dumps({
+            'ballotId': ballot_id,
+            'status': 'EXTRACTION_FAILED',
+            'error': result.get('error', 'Error en extracción Anthropic'),
+            'source': 'anthropic_error'
+        }),
+        properties=pika.BasicProperties(delivery_mode=2)
+    )
+    logger.error(f"Error en extracción Anthropic: {result.get('error', 'Desconocido')}")
+    return False
+
+def decode_fallback_image(message):
+    """Decodifica la imagen original de un mensaje de fallback"""
+    # Decodificar imagen original, reducida solo si sigue superando el
+    # tamaño máximo que se envía a Anthropic
+    image_data = base64.b64decode(message.get('imageBuffer'))
+    img = decode_image(image_data, min_long_side=ANTHROPIC_MAX_DIMENSION)
+    
+    if img is None:
+        raise ValueError("No se pudo decodificar la imagen")
+    return img
+
+def encode_page_for_anthropic(img):
+    """Aplica el preprocesamiento mínimo y codifica la página completa para Anthropic"""
+    img_for_anthropic = preprocess_image_for_anthropic(img)
+    _, buffer = cv2.imencode('.jpg', img_for_anthropic, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return buffer.tobytes()
+
+def build_uncertain_mosaic(img, ocr_result):
+    """Mosaico PNG de las casillas dudosas y sus ids, o (None, None) si no aplica"""
+    field_ids = uncertain_fields(ocr_result)
+    if not field_ids or len(field_ids) > ANTHROPIC_MOSAIC_MAX_FIELDS:
+        return None, None
+    
+    page = normalize_page(img)
+    roi_map = identify_acta_structure(page)
+    field_ids = [field_id for field_id in field_ids if field_id in roi_map]
+    mosaic = build_field_mosaic(page, roi_map, field_ids)
+    if mosaic is None:
+        return None, None
+    
+    _, buffer = cv2.imencode('.png', mosaic)
+    return buffer.tobytes(), field_ids
+
+def merge_mosaic_result(ocr_result, response):
+    """Combina los valores leídos en el mosaico con el resultado OCR local"""
+    merged = merge_field_values(ocr_result, response['results'], response['confidence'])
+    merged['source'] = 'ocr+anthropic_mosaic'
+    merged['needsHumanVerification'] = merged['confidence'] < 0.7
+    return merged
+
+def extract_uncertain_fields(extractor, img, ocr_result):
+    """Consulta a Anthropic solo las casillas dudosas mediante un mosaico de recortes.
+
+    Devuelve el resultado OCR con esas casillas reemplazadas, o None si hay
+    demasiadas casillas dudosas o la consulta falla (se usa la página completa).
+    Si el servicio no está disponible devuelve el error para aparcar el mensaje.
+    """
+    mosaic, field_ids = build_uncertain_mosaic(img, ocr_result)
+    if mosaic is None:
+        return None
+    
+    logger.info(f"Enviando mosaico de {len(field_ids)} casillas a Anthropic ({len(mosaic)} bytes)")
+    response = extractor.extract_fields_from_mosaic(mosaic, field_ids)
+    if response.get('retryable'):
+        # Servicio no disponible: la página completa fallaría igual
+        return response
+    if not response['results']:
+        logger.warning(f"Mosaico sin resultado ({response.get('error', 'Desconocido')}), usando página completa")
+        return None
+    
+    return merge_mosaic_result(ocr_result, response)
+
+def fallback_backlog_mode(ch):
+    """Indica si la cola de fallback está acumulada y conviene procesar por lotes.
+
+    La profundidad de la cola se consulta como máximo una vez cada
+    ANTHROPIC_BATCH_CHECK_SECONDS para no añadir una ida y vuelta por mensaje.
+    """
+    if ANTHROPIC_BATCH_THRESHOLD <= 0:
+        return False
+    
+    now = time.monotonic()
+    if now - _fallback_mode['checkedAt'] >= ANTHROPIC_BATCH_CHECK_SECONDS:
+        depth = ch.queue_declare(queue=ANTHROPIC_FALLBACK_QUEUE, passive=True).method.message_count
+        batch_mode = depth >= ANTHROPIC_BATCH_THRESHOLD
+        if batch_mode != _fallback_mode['batch']:
+            logger.info(f"Fallback en modo {'lote' if batch_mode else 'interactivo'} (cola: {depth} mensajes)")
+        _fallback_mode.update(checkedAt=now, batch=batch_mode)
+        metrics_registry.set_gauge('fallback_batch_mode', int(batch_mode))
+    return _fallback_mode['batch']
+
+def prepare_fallback_job(extractor, message):
+    """Prepara la solicitud de un mensaje de fallback: (parámetros, datos del trabajo)"""
+    img = decode_fallback_image(message)
+    ocr_result = message.get('ocrResult')
+    job = {'ballotId': message.get('ballotId'), 'kind': 'page', **carried_fields(message)}
+    
+    if ANTHROPIC_MOSAIC_MODE and ocr_result:
+        mosaic, field_ids = build_uncertain_mosaic(img, ocr_result)
+        if mosaic is not None:
+            job.update(kind='mosaic', fieldIds=field_ids, ocrResult=ocr_result)
+            return extractor.mosaic_request_params(mosaic, field_ids), job
+    
+    return extractor.page_request_params(encode_page_for_anthropic(img)), job
+
+def drain_fallback_batch(ch, method, body):
+    """Acumula mensajes de fallback y los envía a Anthropic como un único lote.
+
+    El seguimiento del lote se publica en la cola de espera de lotes antes de
+    confirmar los mensajes originales, de modo que un reinicio del worker no
+    pierde trabajos. Si el lote no puede crearse, los mensajes vuelven a la cola.
+    """
+    from algorithms.anthropic_batch import AnthropicBatchClient
+    
+    # 1. Tomar más mensajes de la cola hasta completar el lote
+    deliveries = [(method.delivery_tag, body)]
+    while len(deliveries) < ANTHROPIC_BATCH_SIZE:
+        get_method, _, get_body = ch.basic_get(ANTHROPIC_FALLBACK_QUEUE, auto_ack=False)
+        if get_method is None:
+            break
+        deliveries.append((get_method.delivery_tag, get_body))
+    
+    # 2. Preparar una solicitud por mensaje
+    batch_client = AnthropicBatchClient()
+    requests_by_id, jobs, invalid_tags = {}, {}, []
+    for index, (delivery_tag, job_body) in enumerate(deliveries):
+        try:
+            params, job = prepare_fallback_job(batch_client.extractor, json.loads(job_body))
+            custom_id = f"job-{index}"
+            requests_by_id[custom_id] = params
+            jobs[custom_id] = job
+        except Exception as e:
+            logger.error(f"Mensaje de fallback inválido para lote: {e}")
+            invalid_tags.append(delivery_tag)
+    
+    # 3. Crear el lote y registrar su seguimiento
+    if requests_by_id:
+        try:
+            batch_id = batch_client.submit(requests_by_id)
+        except Exception as e:
+            logger.error(f"No se pudo crear el lote, devolviendo {len(deliveries)} mensajes a la cola: {e}")
+            for delivery_tag, _ in deliveries:
+                ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            # Volver al modo interactivo hasta la próxima verificación
+            _fallback_mode.update(checkedAt=time.monotonic(), batch=False)
+            return
+        schedule_batch_poll({'batchId': batch_id, 'jobs': jobs, 'polls': 0})
+        metrics_registry.inc('fallback_batch_jobs_total', len(jobs))
+    
+    # 4. Confirmar los mensajes incluidos y enviar los inválidos a DLQ
+    for delivery_tag, _ in deliveries:
+        if delivery_tag in invalid_tags:
+            ch.basic_reject(delivery_tag=delivery_tag, requeue=False)
+        else:
+            ch.basic_ack(delivery_tag=delivery_tag)
+
+def schedule_batch_poll(tracking):
+    """Publica el seguimiento de un lote en la cola de espera (vuelve tras el TTL)"""
+    channel.basic_publish(
+        exchange='',
+        routing_key=ANTHROPIC_BATCH_WAIT_QUEUE,
+        body=json.dumps(tracking),
+        properties=pika.BasicProperties(delivery_mode=2, content_type='application/json')
+    )
+
+def process_anthropic_batch(ch, method, properties, body):
+    """Consulta un lote pendiente; al terminar reparte los resultados a 'results'.
+
+    Los fallos transitorios al consultar el estado o descargar los resultados
+    se tratan como un lote aún en proceso: el seguimiento vuelve a la cola de
+    espera. Solo un error permanente lo envía a la DLQ, después de informar el
+    fallo de cada acta aún sin resultado: sus mensajes de fallback ya se
+    confirmaron al enviar el lote y no volverán a procesarse.
+    """
+    tracking = None
+    published = set()
+    try:
+        tracking = json.loads(body)
+        from algorithms.anthropic_batch import AnthropicBatchClient
+        batch_client = AnthropicBatchClient()
+        
+        try:
+            batch = batch_client.status(tracking['batchId'])
+            ended = batch['processing_status'] == 'ended'
+            results = batch_client.results(batch) if ended else None
+        except Exception as e:
+            if not is_transient_error(e):
+                raise
+            logger.warning(f"No se pudo consultar el lote {tracking['batchId']}: {e}")
+            results = None
+        
+        if results is None:
+            # Aún en proceso: volver a consultar después del intervalo de espera
+            repoll_batch(ch, method, tracking)
+            return
+        
+        logger.info(f"Lote {tracking['batchId']} terminado, publicando {len(tracking['jobs'])} resultados")
+        for custom_id, job in tracking['jobs'].items():
+            # Una entrada que no se puede interpretar no detiene el resto del lote
+            try:
+                entry = results.get(custom_id, {'type': 'expired'})
+                result = batch_client.parse_result(entry, job['kind'], job.get('fieldIds'))
+                if job['kind'] == 'mosaic' and result['results']:
+                    result = merge_mosaic_result(job['ocrResult'], result)
+                publish_fallback_result(job['ballotId'], result, carried_fields(job))
+            except Exception as e:
+                logger.error(f"Resultado inválido para la acta {job['ballotId']} del lote {tracking['batchId']}: {e}")
+                publish_fallback_result(job['ballotId'], {'results': None, 'error': f"Resultado de lote inválido: {e}"})
+            published.add(custom_id)
+        
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+    except Exception as e:
+        logger.error(f"Error procesando lote de Anthropic: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        if tracking is not None:
+            fail_batch_jobs(tracking, f"Error en el lote de Anthropic: {e}", published)
+        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+
+def fail_batch_jobs(tracking, error, published=()):
+    """Publica EXTRACTION_FAILED para cada acta del lote aún sin resultado"""
+    for custom_id, job in tracking.get('jobs', {}).items():
+        if custom_id in published:
+            continue
+        try:
+            publish_fallback_result(job['ballotId'], {'results': None, 'error': error})
+        except Exception as e:
+            logger.error(f"No se pudo informar el fallo de la acta {job.get('ballotId')}: {e}")
+
+def repoll_batch(ch, method, tracking):
+    """Devuelve el seguimiento de un lote a la cola de espera.
+
+    Tras ANTHROPIC_BATCH_MAX_POLLS consultas se informa el fallo de cada acta
+    del lote y el seguimiento va a la DLQ.
+    """
+    tracking['polls'] = tracking.get('polls', 0) + 1
+    if tracking['polls'] > ANTHROPIC_BATCH_MAX_POLLS:
+        logger.error(f"Lote {tracking['batchId']} sin resultados tras {tracking['polls'] - 1} consultas, enviando a DLQ")
+        fail_batch_jobs(tracking, 'Lote de Anthropic sin resultados')
+        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+        return
+    schedule_batch_poll(tracking)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
 
 def start_consuming():
     """Inicia el consumo de mensajes de las colas"""
@@ -390,35 +930,120 @@ def start_consuming():
         logger.error("No hay conexión a RabbitMQ para iniciar consumo")
         return False
     
+    consumers = {
+        'validation': (IMAGE_PROCESSING_QUEUE, process_image_validation),
+        'ocr': (OCR_PROCESSING_QUEUE, process_ocr_extraction),
+        'fallback': (ANTHROPIC_FALLBACK_QUEUE, process_anthropic_fallback),
+        'batch': (ANTHROPIC_BATCH_QUEUE, process_anthropic_batch),
+    }
+    consumers = [consumers[name] for name in WORKER_QUEUES if name in consumers]
+    
     try:
-        # Configurar consumidores con prefetch para no sobrecargarse
-        channel.basic_qos(prefetch_count=1)
-        
-        # Consumidor para cada cola
-        channel.basic_consume(
-            queue=IMAGE_PROCESSING_QUEUE,
-            on_message_callback=process_image_validation
-        )
-        
-        channel.basic_consume(
-            queue=OCR_PROCESSING_QUEUE,
-            on_message_callback=process_ocr_extraction
-        )
+        if not LANE_SCHEDULING:
+            # Configurar consumidores con prefetch para no sobrecargarse
+            channel.basic_qos(prefetch_count=1)
+            
+            # Consumidor para cada cola
+            for queue_name, handler in consumers:
+                channel.basic_consume(queue=queue_name, on_message_callback=timed_handler(queue_name, handler))
+            
+            logger.info("Iniciando consumo de mensajes...")
+            channel.start_consuming()
+            return
         
-        channel.basic_consume(
-            queue=ANTHROPIC_FALLBACK_QUEUE,
-            on_message_callback=process_anthropic_fallback
-        )
+        # Los consumidores solo reciben; los mensajes se atienden por carril
+        channel.basic_qos(prefetch_count=LANE_PREFETCH)
+        scheduler = LaneScheduler()
+        consumer_tags = [
+            channel.basic_consume(
+                queue=queue_name,
+                on_message_callback=functools.partial(
+                    schedule_delivery, scheduler, queue_name, timed_handler(queue_name, handler)
+                )
+            )
+            for queue_name, handler in consumers
+        ]
         
-        logger.info("Iniciando consumo de mensajes...")
-        channel.start_consuming()
+        logger.info("Iniciando consumo de mensajes por carriles...")
+        run_lane_scheduler(scheduler, consumer_tags)
     except Exception as e:
         logger.error(f"Error al iniciar consumo: {e}")
         return False
 
+def timed_handler(queue_name, handler):
+    """Envuelve un consumidor para medir su duración y la del primer mensaje.
+
+    Uno de cada PROFILE_EVERY_N mensajes se perfila además con el muestreador
+    de profiling.py (pilas colapsadas y, opcionalmente, tracemalloc).
+    """
+    @functools.wraps(handler)
+    def wrapper(ch, method, properties, body):
+        started = time.monotonic()
+        try:
+            if profiling.should_profile():
+                with profiling.MessageProfile(profiling.message_ballot_id(body), queue_name):
+                    return handler(ch, method, properties, body)
+            return handler(ch, method, properties, body)
+        finally:
+            elapsed = time.monotonic() - started
+            metrics_registry.observe('message_processing_seconds', elapsed, queue=queue_name)
+            warmup.record_first_request(queue_name, elapsed)
+    return wrapper
+
+def schedule_delivery(scheduler, queue_name, handler, ch, method, properties, body):
+    """Guarda una entrega en el carril de su mensaje hasta que le toque turno"""
+    scheduler.push(message_lane(properties), (queue_name, handler, ch, method, properties, body))
+
+def run_lane_scheduler(scheduler, consumer_tags=()):
+    """Atiende los mensajes recibidos según el reparto ponderado por carriles.
+
+    Al pedirse la parada se cancelan los consumidores (pika devuelve a la cola
+    las entregas aún no despachadas) y se terminan los mensajes ya recibidos.
+    """
+    draining = False
+    while True:
+        if stop_requested.is_set() and not draining:
+            logger.info(f"Parada solicitada, terminando {scheduler.pending()} mensajes recibidos")
+            for consumer_tag in consumer_tags:
+                channel.basic_cancel(consumer_tag)
+            draining = True
+        
+        if draining:
+            if not scheduler.pending():
+                return
+        else:
+            # Recibir entregas; sin trabajo pendiente se espera hasta 1 segundo
+            connection.process_data_events(time_limit=0 if scheduler.pending() else 1)
+        
+        entry = scheduler.pop()
+        if entry is None:
+            continue
+        
+        lane, received_at, (queue_name, handler, ch, method, properties, body) = entry
+        broker_wait = queue_wait_seconds(properties) or 0.0
+        metrics_registry.observe('lane_wait_seconds', broker_wait + time.monotonic() - received_at,
+                                 lane=lane, queue=queue_name)
+        
+        handler(ch, method, properties, body)
+        
+        metrics_registry.observe('lane_latency_seconds', broker_wait + time.monotonic() - received_at,
+                                 lane=lane, queue=queue_name)
+        for lane_name, lane_queue in scheduler.queues.items():
+            metrics_registry.set_gauge('lane_buffered_messages', len(lane_queue), lane=lane_name)
+
+def request_stop(signum=None, frame=None):
+    """Pide al worker que termine los mensajes en curso y se detenga"""
+    stop_requested.set()
+    if not LANE_SCHEDULING and connection and connection.is_open:
+        # start_consuming solo puede detenerse desde el hilo de la conexión
+        connection.add_callback_threadsafe(channel.stop_consuming)
+
 def run_worker():
     """Función principal para ejecutar el worker"""
-    while True:
+    # Calentar antes de consumir: la primera acta real no paga las inicializaciones
+    warmup.warm_up(get_ballot_extractor())
+    
+    while not stop_requested.is_set():
         try:
             if connect_to_rabbitmq():
                 start_consuming()
@@ -427,9 +1052,16 @@ def run_worker():
         except Exception as e:
             logger.error(f"Error en el worker: {e}")
         
+        if stop_requested.is_set():
+            break
+        
         # Si llegamos aquí, es porque hubo un error o se cerró la conexión
         logger.info("Reintentando conexión en 5 segundos...")
         time.sleep(5)
+    
+    if connection and connection.is_open:
+        connection.close()
+    logger.info("Worker detenido")
 
 # Iniciar worker en hilo independiente
 def start_worker_thread():
@@ -440,4 +1072,6 @@ def start_worker_thread():
 
 if __name__ == "__main__":
     # Cuando se ejecuta directamente, solo inicia el worker
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
     run_worker()
\ No newline at end of file
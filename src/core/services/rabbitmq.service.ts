@@ -14,6 +14,25 @@ import { ConfigService } from '@nestjs/config';
 import * as amqp from 'amqplib';
 import { resolve } from 'path';
 
+// Carriles de trabajo: prioridad AMQP con la que se publica cada tipo de mensaje.
+// Debe coincidir con image_processor/lanes.py
+export type MessageLane = 'live' | 'retry' | 'replay' | 'bulk';
+
+export const LANE_PRIORITIES: Record<MessageLane, number> = {
+  live: 9,
+  retry: 6,
+  replay: 3,
+  bulk: 1,
+};
+
+function laneOptions(lane: MessageLane): amqp.Options.Publish {
+  return {
+    persistent: true,
+    priority: LANE_PRIORITIES[lane],
+    headers: { 'x-lane': lane, 'x-enqueued-at': Date.now() },
+  };
+}
+
 @Injectable()
 export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
   private connection: amqp.Connection | null = null;
@@ -131,7 +150,12 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
     }
   }
 
-  async publishMessage(exchange: string, routingKey: string, message: any) {
+  async publishMessage(
+    exchange: string,
+    routingKey: string,
+    message: any,
+    lane: MessageLane = 'live',
+  ) {
     try {
       if (!this.channel) {
         this.logger.error('No se puede publicar mensaje: Canal nulo');
@@ -165,7 +189,7 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
         exchange,
         routingKey,
         Buffer.from(JSON.stringify(message)),
-        { persistent: true },
+        laneOptions(lane),
       );
 
       this.logger.log(
@@ -296,10 +320,13 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
       }
 
       try {
-        // Publicar a la cola original
-        this.channel.publish('', targetQueue, message.content, {
-          persistent: true,
-        });
+        // Publicar a la cola original en el carril de reenvíos
+        this.channel.publish(
+          '',
+          targetQueue,
+          message.content,
+          laneOptions('replay'),
+        );
 
         // Confirmar procesamiento
         this.channel.ack(message);